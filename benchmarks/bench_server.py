@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""MCPサーバーのオフラインベンチマーク
+
+benchmarks/fake_claude.pyをClaude CLIとして使い、APIを呼び出さずに
+stdioトランスポート経由でサーバーのツールを実行して以下を計測する:
+
+    overhead    1回の呼び出しにかかる時間（CLIの待ち時間0秒、サーバー側とトランスポート側の内訳）
+    throughput  同時実行数ごとのスループット（名前付きセッションに分散）
+    context     大きなコンテキストファイルを送る場合の時間とサーバーのメモリ使用量（Linuxのみ）
+    logging     CLAUDE_MCP_LOG_LEVEL=INFOとDEBUGの比較（大きな応答でのログ出力のコスト）
+    failures    空の応答・error_during_executionが混ざる場合の時間と成功率
+
+使い方:
+    python3 benchmarks/bench_server.py
+    python3 benchmarks/bench_server.py --only overhead,throughput --calls 100 --json bench.json
+
+CLAUDE_MCP_MAX_CONCURRENCYなどサーバーの環境変数は、このスクリプトの環境からそのまま引き継がれる。
+Windows（WSL経由のClaude CLI）には対応していない。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(BENCH_DIR, "..", "src", "claude_cli_server.py")
+FAKE_CLAUDE = os.path.join(BENCH_DIR, "fake_claude.py")
+
+
+def install_fake_claude(workdir: str) -> str:
+    """fake_claude.pyを起動するclaudeコマンドを作業ディレクトリに作成し、そのパスを返す"""
+    bin_dir = os.path.join(workdir, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, "claude")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_CLAUDE}" "$@"\n')
+    os.chmod(path, 0o755)
+    return path
+
+
+def server_env(workdir: str, claude_path: str, overrides: Dict[str, str]) -> Dict[str, str]:
+    """サーバーの環境変数（データ・ログ・セッションの記録・Claude CLIのパスを作業ディレクトリに向ける）"""
+    os.makedirs(os.path.join(workdir, "transcripts"), exist_ok=True)
+    env = dict(os.environ)
+    env.update({
+        "CLAUDE_PATH": claude_path,
+        # Claude CLIの探索ではwhichの結果が優先されるため、PATHの先頭にも置く
+        "PATH": os.path.dirname(claude_path) + os.pathsep + env.get("PATH", ""),
+        "CLAUDE_MCP_DATA_DIR": os.path.join(workdir, "data"),
+        "CLAUDE_MCP_LOG_FILE": os.path.join(workdir, "server.log"),
+        # 失敗からの回復でセッションの記録を読むため、実行者の~/.claude/projectsではなく空のディレクトリを使う
+        "CLAUDE_MCP_TRANSCRIPT_DIR": os.path.join(workdir, "transcripts"),
+        "FAKE_CLAUDE_LATENCY": "0",
+        "FAKE_CLAUDE_RESPONSE_BYTES": "200",
+        "FAKE_CLAUDE_EMPTY_RATE": "0",
+        "FAKE_CLAUDE_ERROR_RATE": "0"
+    })
+    env.update(overrides)
+    return env
+
+
+def find_server_pid() -> Optional[int]:
+    """このプロセスが起動したサーバーのPIDを/procから探す（Linux以外ではNone）"""
+    if not os.path.isdir("/proc"):
+        return None
+    found = None
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", encoding="utf-8") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{name}/cmdline", "rb") as f:
+                cmdline = f.read()
+        except (OSError, ValueError, IndexError):
+            continue
+        if ppid == os.getpid() and b"claude_cli_server.py" in cmdline:
+            found = max(found or 0, int(name))
+    return found
+
+
+def read_memory_mb(pid: Optional[int]) -> Tuple[Optional[float], Optional[float]]:
+    """プロセスの現在と最大の常駐メモリ（MB）を返す（取得できない場合はNone）"""
+    if pid is None:
+        return None, None
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    values[key] = int(value.split()[0]) / 1024
+    except OSError:
+        return None, None
+    return values.get("VmRSS"), values.get("VmHWM")
+
+
+@asynccontextmanager
+async def mcp_server(workdir: str, claude_path: str, overrides: Optional[Dict[str, str]] = None):
+    """設定ごとに新しいサーバーを起動し、(ClientSession, PID)を返す"""
+    params = StdioServerParameters(
+        command=sys.executable,
+        args=[os.path.abspath(SERVER_SCRIPT)],
+        env=server_env(workdir, claude_path, overrides or {})
+    )
+    # サーバーの標準エラー出力（リクエストごとのログ）は作業ディレクトリに書き出す
+    with open(os.path.join(workdir, "server.stderr"), "a", encoding="utf-8") as errlog:
+        async with stdio_client(params, errlog=errlog) as (read, write):
+            async with ClientSession(read, write) as session:
+                await session.initialize()
+                yield session, find_server_pid()
+
+
+async def call_tool(session: ClientSession, name: str, arguments: Dict) -> Tuple[float, Dict]:
+    """ツールを呼び出し、(クライアントから見た時間, 返り値)を返す"""
+    start = time.perf_counter()
+    response = await session.call_tool(name, arguments)
+    elapsed = time.perf_counter() - start
+    return elapsed, json.loads(response.content[0].text)
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """ミリ秒単位の平均・中央値・p95・最大"""
+    ordered = sorted(values)
+    return {
+        "mean_ms": statistics.mean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max_ms": ordered[-1] * 1000
+    }
+
+
+async def bench_overhead(workdir: str, claude_path: str, args: argparse.Namespace) -> Dict:
+    async with mcp_server(workdir, claude_path) as (session, _):
+        # 初回はClaude CLIの探索を含むため計測しない
+        await call_tool(session, "execute_claude", {"prompt": "warmup"})
+        totals, server_times = [], []
+        for i in range(args.calls):
+            elapsed, result = await call_tool(session, "execute_claude", {"prompt": f"overhead {i}"})
+            totals.append(elapsed)
+            server_times.append(result["execution_time"])
+    return {
+        "calls": args.calls,
+        "total": summarize(totals),
+        "server": summarize(server_times),
+        "transport": summarize([total - server for total, server in zip(totals, server_times)])
+    }
+
+
+async def bench_throughput(workdir: str, claude_path: str, args: argparse.Namespace) -> Dict:
+    levels = {}
+    overrides = {"FAKE_CLAUDE_LATENCY": str(args.latency)}
+    async with mcp_server(workdir, claude_path, overrides) as (session, _):
+        await call_tool(session, "execute_claude", {"prompt": "warmup"})
+        for level in args.concurrency:
+            semaphore = asyncio.Semaphore(level)
+
+            async def one(i: int) -> float:
+                async with semaphore:
+                    # 同じセッションへの呼び出しは直列になるため、同時実行数と同じ数のセッションに分散する
+                    elapsed, _ = await call_tool(session, "execute_claude", {"prompt": f"throughput {i}", "session": f"bench-{i % level}"})
+                    return elapsed
+
+            start = time.perf_counter()
+            latencies = await asyncio.gather(*(one(i) for i in range(args.calls)))
+            wall = time.perf_counter() - start
+            levels[str(level)] = {
+                "calls_per_sec": args.calls / wall,
+                "ideal_calls_per_sec": level / args.latency if args.latency else None,
+                "latency": summarize(list(latencies))
+            }
+    return {"cli_latency": args.latency, "calls": args.calls, "levels": levels}
+
+
+async def bench_context(workdir: str, claude_path: str, args: argparse.Namespace) -> Dict:
+    path = os.path.join(workdir, "context.log")
+    line = "2024-01-01T00:00:00 INFO request handled path=/api/items status=200 elapsed_ms=12\n"
+    size = args.context_mb * 1024 * 1024
+    with open(path, "w", encoding="utf-8") as f:
+        for _ in range(size // len(line) + 1):
+            f.write(line)
+    size = os.path.getsize(path)
+
+    async with mcp_server(workdir, claude_path) as (session, pid):
+        await call_tool(session, "execute_claude", {"prompt": "warmup"})
+        rss_before, _ = read_memory_mb(pid)
+        elapsed, result = await call_tool(session, "execute_claude_with_context", {
+            "prompt": "Summarize this log",
+            "file_path": path,
+            "max_bytes": size
+        })
+        rss_after, peak = read_memory_mb(pid)
+    return {
+        "context_bytes": result.get("context_bytes"),
+        "success": result["success"],
+        "elapsed_ms": elapsed * 1000,
+        "mb_per_sec": size / 1024 / 1024 / elapsed,
+        "rss_before_mb": rss_before,
+        "rss_after_mb": rss_after,
+        "peak_rss_mb": peak
+    }
+
+
+async def bench_logging(workdir: str, claude_path: str, args: argparse.Namespace) -> Dict:
+    levels = {}
+    for level in ("INFO", "DEBUG"):
+        log_file = os.path.join(workdir, f"server-{level.lower()}.log")
+        overrides = {
+            "CLAUDE_MCP_LOG_LEVEL": level,
+            "CLAUDE_MCP_LOG_FILE": log_file,
+            "FAKE_CLAUDE_RESPONSE_BYTES": str(args.response_bytes)
+        }
+        async with mcp_server(workdir, claude_path, overrides) as (session, _):
+            await call_tool(session, "execute_claude", {"prompt": "warmup"})
+            totals = []
+            for i in range(args.calls):
+                elapsed, _ = await call_tool(session, "execute_claude", {"prompt": f"logging {i}"})
+                totals.append(elapsed)
+        levels[level] = {
+            "total": summarize(totals),
+            "log_bytes": os.path.getsize(log_file) if os.path.exists(log_file) else 0
+        }
+    levels["debug_cost_ms"] = levels["DEBUG"]["total"]["mean_ms"] - levels["INFO"]["total"]["mean_ms"]
+    return {"response_bytes": args.response_bytes, "calls": args.calls, "levels": levels}
+
+
+async def bench_failures(workdir: str, claude_path: str, args: argparse.Namespace) -> Dict:
+    overrides = {
+        "FAKE_CLAUDE_EMPTY_RATE": str(args.empty_rate),
+        "FAKE_CLAUDE_ERROR_RATE": str(args.error_rate)
+    }
+    async with mcp_server(workdir, claude_path, overrides) as (session, _):
+        totals, succeeded = [], 0
+        for i in range(args.calls):
+            elapsed, result = await call_tool(session, "execute_claude", {"prompt": f"failures {i}"})
+            totals.append(elapsed)
+            succeeded += 1 if result["success"] else 0
+    return {
+        "empty_rate": args.empty_rate,
+        "error_rate": args.error_rate,
+        "calls": args.calls,
+        "success_rate": succeeded / args.calls,
+        "total": summarize(totals)
+    }
+
+
+SCENARIOS = {
+    "overhead": bench_overhead,
+    "throughput": bench_throughput,
+    "context": bench_context,
+    "logging": bench_logging,
+    "failures": bench_failures
+}
+
+
+def print_report(name: str, result: Dict):
+    """結果を読みやすい形で表示する"""
+    print(f"== {name}")
+
+    def walk(prefix: str, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                walk(f"{prefix}.{key}" if prefix else key, item)
+        elif isinstance(value, float):
+            print(f"  {prefix:40s} {value:12.2f}")
+        else:
+            print(f"  {prefix:40s} {value!s:>12}")
+
+    walk("", result)
+
+
+async def main(args: argparse.Namespace) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="claude-mcp-bench-")
+    try:
+        claude_path = install_fake_claude(workdir)
+        results = {}
+        for name in args.only:
+            results[name] = await SCENARIOS[name](workdir, claude_path, args)
+            print_report(name, results[name])
+        return results
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"work directory: {workdir}")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmark for the Claude CLI MCP server")
+    parser.add_argument("--only", default=",".join(SCENARIOS), help="comma separated scenarios (%(default)s)")
+    parser.add_argument("--calls", type=int, default=30, help="calls per scenario or concurrency level")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="concurrency levels for throughput")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake CLI latency in seconds for throughput")
+    parser.add_argument("--context-mb", type=int, default=50, help="context file size in MB")
+    parser.add_argument("--response-bytes", type=int, default=20000, help="response size for the logging scenario")
+    parser.add_argument("--empty-rate", type=float, default=0.3, help="share of empty results for the failures scenario")
+    parser.add_argument("--error-rate", type=float, default=0.1, help="share of error_during_execution for the failures scenario")
+    parser.add_argument("--json", help="write results to this JSON file")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory (logs, data)")
+    args = parser.parse_args(argv)
+    args.only = [name.strip() for name in args.only.split(",") if name.strip()]
+    unknown = [name for name in args.only if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+    return args
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    report = asyncio.run(main(arguments))
+    if arguments.json:
+        with open(arguments.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
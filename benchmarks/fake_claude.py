@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""ベンチマーク用のClaude CLIの代替
+
+APIを呼び出さずに、Claude CLIと同じ形式のJSONを返す。
+動作は環境変数で調整する（MCPサーバーの環境変数がそのまま引き継がれる）:
+
+    FAKE_CLAUDE_LATENCY         応答までの時間（秒、デフォルト: 0）
+    FAKE_CLAUDE_RESPONSE_BYTES  resultの大きさ（バイト、デフォルト: 200）
+    FAKE_CLAUDE_EMPTY_RATE      空のresultを返す割合（0-1、デフォルト: 0）
+    FAKE_CLAUDE_ERROR_RATE      error_during_executionを返す割合（0-1、デフォルト: 0）
+"""
+
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+LATENCY = float(os.environ.get("FAKE_CLAUDE_LATENCY", "0"))
+RESPONSE_BYTES = int(os.environ.get("FAKE_CLAUDE_RESPONSE_BYTES", "200"))
+EMPTY_RATE = float(os.environ.get("FAKE_CLAUDE_EMPTY_RATE", "0"))
+ERROR_RATE = float(os.environ.get("FAKE_CLAUDE_ERROR_RATE", "0"))
+
+
+def _option(args, name, default=None):
+    """コマンドライン引数から値付きオプションを取得する"""
+    if name in args:
+        index = args.index(name)
+        if index + 1 < len(args):
+            return args[index + 1]
+    return default
+
+
+def _response_text(prompt, input_bytes):
+    """RESPONSE_BYTESの大きさの応答本文を作る"""
+    head = f"Answer to: {prompt[:80]} (context {input_bytes} bytes). "
+    filler = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. "
+    text = head + filler * (max(0, RESPONSE_BYTES - len(head)) // len(filler) + 1)
+    return text[:max(RESPONSE_BYTES, len(head))]
+
+
+def _result_event(session_id, prompt, input_bytes, started):
+    """Claude CLIの--output-format jsonと同じ形式のresultイベントを作る"""
+    draw = random.random()
+    if draw < ERROR_RATE:
+        subtype, is_error, text = "error_during_execution", True, ""
+    elif draw < ERROR_RATE + EMPTY_RATE:
+        subtype, is_error, text = "success", False, ""
+    else:
+        subtype, is_error, text = "success", False, _response_text(prompt, input_bytes)
+    duration_ms = int((time.time() - started) * 1000)
+    event = {
+        "type": "result",
+        "subtype": subtype,
+        "is_error": is_error,
+        "duration_ms": duration_ms,
+        "duration_api_ms": int(LATENCY * 1000),
+        "num_turns": 1,
+        "session_id": session_id,
+        "total_cost_usd": 0.0001 * (1 + input_bytes // 4000),
+        "usage": {
+            "input_tokens": len(prompt) // 4 + input_bytes // 4,
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0,
+            "output_tokens": len(text) // 4,
+            "service_tier": "standard"
+        }
+    }
+    if subtype == "success":
+        event["result"] = text
+    return event
+
+
+def _emit(event):
+    sys.stdout.write(json.dumps(event, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+def _run_stream_input(session_id):
+    """--input-format stream-json（常駐ワーカーモード）: 1行のユーザーメッセージごとに1ターン応答する"""
+    _emit({"type": "system", "subtype": "init", "session_id": session_id})
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        started = time.time()
+        message = json.loads(line)
+        prompt = "".join(part.get("text", "") for part in message["message"]["content"])
+        time.sleep(LATENCY)
+        event = _result_event(session_id, prompt, 0, started)
+        if event.get("result"):
+            _emit({"type": "assistant", "message": {"content": [{"type": "text", "text": event["result"]}]}, "session_id": session_id})
+        _emit(event)
+
+
+def main():
+    args = sys.argv[1:]
+    if "--version" in args:
+        print("1.0.0 (Claude Code)")
+        return
+
+    session_id = _option(args, "--resume") or str(uuid.uuid4())
+    if _option(args, "--input-format") == "stream-json":
+        _run_stream_input(session_id)
+        return
+
+    started = time.time()
+    prompt = _option(args, "-p", "")
+    # コンテキストは標準入力で渡される（読み切らないとサーバー側の書き込みが止まる）
+    input_bytes = 0
+    if not sys.stdin.isatty():
+        while True:
+            chunk = sys.stdin.buffer.read(65536)
+            if not chunk:
+                break
+            input_bytes += len(chunk)
+    time.sleep(LATENCY)
+    event = _result_event(session_id, prompt, input_bytes, started)
+
+    if _option(args, "--output-format") == "stream-json":
+        _emit({"type": "system", "subtype": "init", "session_id": session_id})
+        if event.get("result"):
+            _emit({"type": "assistant", "message": {"content": [{"type": "text", "text": event["result"]}]}, "session_id": session_id})
+        _emit(event)
+    else:
+        print(json.dumps(event, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
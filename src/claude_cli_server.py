@@ -1,691 +1,4897 @@
 #!/usr/bin/env python3
 """Claude CLI MCP Server - Claude CLIをプログラム内部から呼び出すMCPサーバー"""
 
+import argparse
 import asyncio
+import atexit
+import base64
 import json
+import logging
+import logging.handlers
 import os
+import queue
 import platform
 import glob
+import hashlib
+import itertools
+import signal
+import sqlite3
+import struct
+import sys
 import time
-import subprocess
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime
-from typing import Dict, List, Optional, Union
-from mcp.server.fastmcp import FastMCP
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+from mcp.server.fastmcp import Context, FastMCP
+
+try:
+    import orjson  # 任意: インストールされている場合はCLIの出力の解析に使う（高速）
+except ImportError:
+    orjson = None
 
 # 定数
 DEFAULT_TIMEOUT = 300  # デフォルトタイムアウト（秒）
+PROCESS_KILL_GRACE = 2  # タイムアウト・キャンセル時にSIGTERMからSIGKILLまで待つ時間（秒）
+DEFAULT_SESSION_NAME = "default"  # session引数を省略した場合のセッション名
 
-# FastMCPインスタンスの作成
-mcp = FastMCP("claude-cli-server")
+# デバッグログ設定
+LOG_FILE = os.environ.get("CLAUDE_MCP_LOG_FILE", os.path.join(os.path.dirname(__file__), '..', 'claude_command_debug.log'))
+LOG_LEVEL = os.environ.get("CLAUDE_MCP_LOG_LEVEL", "INFO").upper()  # DEBUGで生の出力やJSONも記録
+LOG_MAX_BYTES = int(os.environ.get("CLAUDE_MCP_LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # ローテーションするサイズ（バイト）
+LOG_BACKUP_COUNT = int(os.environ.get("CLAUDE_MCP_LOG_BACKUP_COUNT", "3"))  # 保持する古いログファイル数
+LOG_PAYLOAD_LIMIT = int(os.environ.get("CLAUDE_MCP_LOG_PAYLOAD_LIMIT", "500"))  # ログに記録する出力・JSONの最大文字数
 
+# 永続データ（実行履歴など）の保存先
+DATA_DIR = os.environ.get("CLAUDE_MCP_DATA_DIR", os.path.expanduser("~/.mcp-claude-context-continuity"))
+HISTORY_DB = os.environ.get("CLAUDE_MCP_HISTORY_DB", os.path.join(DATA_DIR, "history.db"))
+HISTORY_MAX_LIMIT = 1000  # get_execution_historyで1回に取得できる履歴数の上限
+DISCOVERY_CACHE = os.environ.get("CLAUDE_MCP_DISCOVERY_CACHE", os.path.join(DATA_DIR, "claude_path.json"))  # Claude CLIのパスのキャッシュ
 
-class ClaudeSessionManager:
-    """Claude CLIのセッション管理クラス"""
+# 応答キャッシュ（cache引数を指定した呼び出しのみ使用）
+CACHE_SCOPES = ("stateless", "session")
+CACHE_DB = os.environ.get("CLAUDE_MCP_CACHE_DB", os.path.join(DATA_DIR, "cache.db"))
+CACHE_MAX_ENTRIES = int(os.environ.get("CLAUDE_MCP_CACHE_MAX_ENTRIES", "256"))  # メモリ上に保持するエントリ数
+CACHE_MAX_DISK_ENTRIES = int(os.environ.get("CLAUDE_MCP_CACHE_MAX_DISK_ENTRIES", "10000"))  # ディスクに保持するエントリ数
+CACHE_TTL = float(os.environ.get("CLAUDE_MCP_CACHE_TTL", "3600"))  # 有効期限（秒）
+
+# バックグラウンドジョブ（submit_claude_jobで投入、完了した結果はSQLiteに保存）
+JOBS_DB = os.environ.get("CLAUDE_MCP_JOBS_DB", os.path.join(DATA_DIR, "jobs.db"))
+JOB_TTL = float(os.environ.get("CLAUDE_MCP_JOB_TTL", "86400"))  # 完了したジョブの結果を保持する期間（秒）
+JOB_MAX_ENTRIES = int(os.environ.get("CLAUDE_MCP_JOB_MAX_ENTRIES", "1000"))  # 保持するジョブ数
+
+# メトリクス（get_metricsで参照、CLAUDE_MCP_METRICS_FILE指定時はPrometheus形式で書き出す）
+METRICS_FILE = os.environ.get("CLAUDE_MCP_METRICS_FILE")  # Prometheusのtextfile形式で書き出すファイル（省略時は書き出さない）
+METRICS_EXPORT_INTERVAL = float(os.environ.get("CLAUDE_MCP_METRICS_INTERVAL", "15"))  # 書き出し間隔（秒）
+METRICS_SAMPLES = 1000  # パーセンタイルの計算に使う直近のサンプル数
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300)  # レイテンシのヒストグラムの境界（秒）
+SLOW_CALL_SECONDS = float(os.environ.get("CLAUDE_MCP_SLOW_CALL_SECONDS", "30"))  # これを超えた実行を警告する（秒）
+
+# コンテキストファイル（execute_claude_with_contextで標準入力に渡すファイル）
+CONTEXT_MAX_BYTES = int(os.environ.get("CLAUDE_MCP_CONTEXT_MAX_BYTES", str(10 * 1024 * 1024)))  # 標準入力に渡す最大サイズ（バイト）
+CONTEXT_CHUNK_SIZE = 256 * 1024  # 標準入力へ書き込む1回あたりのサイズ（バイト）
+CONTEXT_TRUNCATE_MODES = ("head", "tail", "head_tail")
+CONTEXT_BYTES_PER_TOKEN = 4  # トークン数からバイト数を見積もる際の係数（概算）
+
+# セッションの状態の共有（有効にすると会話位置をSQLiteに保存し、同じホストの複数のサーバープロセスや再起動後も会話を継続する）
+SESSION_STATE = os.environ.get("CLAUDE_MCP_SESSION_STATE", "").lower() in ("1", "true", "yes")
+SESSION_STATE_DB = os.environ.get("CLAUDE_MCP_SESSION_STATE_DB", os.path.join(DATA_DIR, "session_state.db"))
+SESSION_LEASE_TIMEOUT = float(os.environ.get("CLAUDE_MCP_SESSION_LEASE_TIMEOUT", "900"))  # 他のプロセスの使用中の印をこの秒数で無効とみなす（プロセスの生存を確認できない場合の保険）
+SESSION_LEASE_POLL = 0.2  # 他のプロセスが使用中のセッションを待つ間隔（秒）
+
+# セッションの記録（Claude CLIが書き出すJSONL）。空の結果を追加のモデル呼び出しなしで復元するために読む
+TRANSCRIPT_DIR = os.environ.get("CLAUDE_MCP_TRANSCRIPT_DIR")  # 省略時は$CLAUDE_CONFIG_DIR/projects（未設定なら~/.claude/projects）。Windowsでは\\wsl$\...のパスを指定
+TRANSCRIPT_TAIL_BYTES = 1024 * 1024  # 記録の末尾から読み込む最大サイズ（バイト）
+SESSION_INDEX_DB = os.environ.get("CLAUDE_MCP_SESSION_INDEX_DB", os.path.join(DATA_DIR, "sessions.db"))  # list_sessions / search_sessionsのインデックス
+SESSION_INDEX_READ_SIZE = 4 * 1024 * 1024  # インデックス更新時に1回に読み込むサイズ（バイト）
+
+# map-reduceモード（大きなファイルを分割して並行に問い合わせ、最後に統合する）
+MAP_CHUNK_BYTES = int(os.environ.get("CLAUDE_MCP_MAP_CHUNK_BYTES", "200000"))  # 1チャンクの最大サイズ（バイト）
+MAP_OVERLAP_BYTES = int(os.environ.get("CLAUDE_MCP_MAP_OVERLAP_BYTES", "2000"))  # 隣接チャンクと重複させるサイズ（バイト）
+MAP_CONCURRENCY = int(os.environ.get("CLAUDE_MCP_MAP_CONCURRENCY", "4"))  # 同時に実行するチャンク数の上限
+MAP_RETRIES = int(os.environ.get("CLAUDE_MCP_MAP_RETRIES", "1"))  # 失敗したチャンクを再実行する回数
+
+# スケジューラ（同時に実行するClaude CLIの数と順序を制御する）
+SCHEDULER_PRIORITIES = ("interactive", "batch")  # 優先度の高い順
+SCHEDULER_MAX_CONCURRENCY = int(os.environ.get("CLAUDE_MCP_MAX_CONCURRENCY", "4"))  # 全体の同時実行数の上限
+SCHEDULER_MAX_PER_SESSION = int(os.environ.get("CLAUDE_MCP_MAX_PER_SESSION", str(SCHEDULER_MAX_CONCURRENCY)))  # セッション名ごとの同時実行数の上限
+SCHEDULER_MAX_QUEUE = int(os.environ.get("CLAUDE_MCP_MAX_QUEUE", "64"))  # 待機できる呼び出し数の上限（超えた場合は即座にエラー）
+
+# バッチ実行（execute_claude_batch / execute_claude_fanout）
+BATCH_CONCURRENCY = int(os.environ.get("CLAUDE_MCP_BATCH_CONCURRENCY", "4"))  # 同時に実行するプロンプト数のデフォルト
+
+# セッションの分岐（fork_session / execute_claude_fanout）。空にすると付けない（分岐に対応していない古いCLI用）
+FORK_SESSION_FLAG = os.environ.get("CLAUDE_MCP_FORK_SESSION_FLAG", "--fork-session")  # 分岐したセッションを再開する際に--resumeに付けるオプション
+
+# セッションの圧縮（--resumeは毎ターン会話全体を読み込むため、会話が長いほど遅く高くなる）
+COMPACT_MODES = ("summary", "off")  # summary: しきい値を超えたら要約で始めた新しいセッションに自動で切り替え / off: 自動で圧縮しない
+COMPACT_MODE = os.environ.get("CLAUDE_MCP_COMPACT_MODE", "off").lower()
+COMPACT_CONTEXT_TOKENS = int(os.environ.get("CLAUDE_MCP_COMPACT_TOKENS", "100000"))  # 1回のAPI呼び出しで読み込んだトークン数がこれを超えたら圧縮（0で無効）
+COMPACT_LATENCY = float(os.environ.get("CLAUDE_MCP_COMPACT_LATENCY", "0"))  # 直近のターンの平均実行時間がこれを超えたら圧縮（秒、0で無効）
+COMPACT_MIN_TURNS = 3  # 平均実行時間の計算に使うターン数（圧縮後、次に自動で圧縮するまでの最小ターン数）
+COMPACT_SUMMARY_PROMPT = (
+    "これまでの会話を、別のセッションで作業を続けるための引き継ぎ資料として要約してください。"
+    "目的、決定事項とその理由、現在の状態、扱っているファイルや識別子、未解決の課題と次の手順を漏れなく含め、"
+    "挨拶や前置きは書かないでください。"
+)
+COMPACT_SEED_PROMPT = (
+    "以下は以前の会話の要約です。この内容を前提として会話を続けます。"
+    "内容を把握したら「了解しました」とだけ答えてください。\n\n{summary}"
+)
+
+# 常駐ワーカーモード（CLIプロセスをセッションごとに使い回す）
+WORKER_MODE = os.environ.get("CLAUDE_MCP_WORKER_MODE", "").lower() in ("1", "true", "yes")
+WORKER_IDLE_TIMEOUT = float(os.environ.get("CLAUDE_MCP_WORKER_IDLE_TIMEOUT", "600"))  # アイドル状態のワーカーを終了するまでの時間（秒）
+WORKER_MAX_PROCESSES = int(os.environ.get("CLAUDE_MCP_WORKER_MAX_PROCESSES", "4"))  # 同時に保持するワーカー数の上限
+
+# ブリッジモード（WSL内に常駐するブリッジ経由でコマンドを実行し、呼び出しごとのwsl.exe起動を省く）
+BRIDGE_MODE = os.environ.get("CLAUDE_MCP_BRIDGE_MODE", "").lower() in ("1", "true", "yes")
+
+# トランスポート（stdio: クライアントごとにサーバープロセスを起動 / http・sse: 1つのプロセスで複数のクライアントに応答）
+TRANSPORTS = ("stdio", "http", "sse")
+TRANSPORT = os.environ.get("CLAUDE_MCP_TRANSPORT", "stdio").lower()  # --transportで上書き可能
+HTTP_HOST = os.environ.get("CLAUDE_MCP_HOST", "127.0.0.1")  # http・sseで待ち受けるアドレス（--hostで上書き可能）
+HTTP_PORT = int(os.environ.get("CLAUDE_MCP_PORT", "8000"))  # http・sseで待ち受けるポート（--portで上書き可能）
+
+# FastMCPインスタンスの作成（localhostで待ち受ける場合はDNSリバインディング対策が有効になる）
+mcp = FastMCP("claude-cli-server", host=HTTP_HOST, port=HTTP_PORT)
+
+
+def _setup_logger() -> logging.Logger:
+    """デバッグログ用のロガーを作成する
+
+    ファイルへの書き込みはQueueListenerのバックグラウンドスレッドで行うため、
+    ログを出力する側（イベントループ）ではディスクI/Oが発生しない。
+    stdioトランスポートを壊さないよう、標準出力には一切出力しない。
+    """
+    log = logging.getLogger("claude_cli_server")
+    log.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    log.propagate = False
+    if log.handlers:
+        return log
+
+    try:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE,
+            maxBytes=LOG_MAX_BYTES,
+            backupCount=LOG_BACKUP_COUNT,
+            encoding='utf-8',
+            delay=True
+        )
+    except OSError:
+        # ログファイルを作成できない環境ではログを無効化する
+        log.addHandler(logging.NullHandler())
+        return log
+    file_handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s"))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return log
+
+
+def _truncate(text: str, limit: int = LOG_PAYLOAD_LIMIT) -> str:
+    """ログ出力用に文字列を切り詰める"""
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... ({len(text)} chars)"
+
+
+def _truncate_bytes(data: bytes, limit: int = LOG_PAYLOAD_LIMIT) -> str:
+    """ログ出力用にバイト列の先頭だけをデコードする（全体はデコードしない）"""
+    text = data[:limit].decode('utf-8', errors='replace')
+    if len(data) <= limit:
+        return text
+    return f"{text}... ({len(data)} bytes)"
+
+
+logger = _setup_logger()
+
+
+class ExecutionHistoryStore:
+    """実行履歴の永続ストア（SQLite）
     
-    def __init__(self):
-        self.before_session_id: Optional[str] = None  # 前回のセッションID
-        self.history: List[Dict] = []
-        self.claude_command: Optional[Union[str, List[str]]] = None  # キャッシュ
-        self.is_manually_set: bool = False  # 手動設定されたセッションかどうか
+    履歴はSQLiteに追記され、セッション名・セッションID・タイムスタンプで検索できる。
+    メモリ上には履歴を保持せず、取得時はDBから必要な件数だけ読み出す。
+    SQLiteへのアクセスは専用スレッドで直列に行うため、イベントループをブロックしない。
+    """
+    
+    def __init__(self, db_path: str = HISTORY_DB):
+        self.db_path = db_path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        self._conn: Optional[sqlite3.Connection] = None
         
-    def _add_history(self, entry: Dict):
-        """履歴に操作を追加"""
-        self.history.append(entry)
-        # 最新100件のみ保持
-        if len(self.history) > 100:
-            self.history = self.history[-100:]
+    def _connect(self) -> sqlite3.Connection:
+        """DBに接続しテーブルを作成する（履歴スレッド内でのみ呼ぶ）"""
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+                # 複数のサーバープロセスが同じDBに書き込む場合、ロック中は失敗せずに待つ
+                conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+            except (OSError, sqlite3.Error) as e:
+                # 保存先が使えない場合はプロセス内のみで保持する
+                logger.warning("History DB unavailable (%s), using in-memory history: %s", self.db_path, e)
+                conn = sqlite3.connect(":memory:", check_same_thread=False)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY,
+                    timestamp TEXT NOT NULL,
+                    tool_name TEXT,
+                    session TEXT,
+                    session_id TEXT,
+                    success INTEGER,
+                    entry TEXT NOT NULL,
+                    client TEXT
+                )
+            """)
+            # 以前のバージョンで作成したDBにはクライアントIDの列がない
+            if "client" not in {row[1] for row in conn.execute("PRAGMA table_info(history)")}:
+                conn.execute("ALTER TABLE history ADD COLUMN client TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_session ON history (session, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_session_id ON history (session_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
     
-    def build_claude_command(self, claude_cmd: Union[str, List[str]], prompt: str, include_resume: bool = True) -> List[str]:
-        """Claude CLIコマンドを構築する共通関数
+    def _insert(self, entry: Dict):
+        """履歴を1件追加する（IDはSQLiteが採番し、取得時に行のIDを付ける）"""
+        conn = self._connect()
+        stored = dict(entry)
+        stored.pop("id", None)
+        with conn:
+            conn.execute(
+                "INSERT INTO history (timestamp, tool_name, session, session_id, success, entry, client) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    stored.get("timestamp", datetime.now().isoformat()),
+                    stored.get("tool_name"),
+                    stored.get("session"),
+                    stored.get("session_id"),
+                    1 if stored.get("success") else 0,
+                    json.dumps(stored, ensure_ascii=False),
+                    stored.get("client")
+                )
+            )
+    
+    def append(self, entry: Dict):
+        """履歴を追加する（書き込みはバックグラウンドで行う）"""
+        def write():
+            try:
+                self._insert(entry)
+            except sqlite3.Error as e:
+                logger.warning("Failed to write history: %s", e)
+        
+        self._executor.submit(write)
+    
+    def _query(self, limit: int, cursor: Optional[int], filters: Dict) -> Dict:
+        conn = self._connect()
+        conditions = []
+        params: List = []
+        for column in ("session", "session_id", "tool_name", "client"):
+            if filters.get(column) is not None:
+                conditions.append(f"{column} = ?")
+                params.append(filters[column])
+        if filters.get("success") is not None:
+            conditions.append("success = ?")
+            params.append(1 if filters["success"] else 0)
+        if filters.get("since") is not None:
+            conditions.append("timestamp >= ?")
+            params.append(filters["since"])
+        if filters.get("until") is not None:
+            conditions.append("timestamp < ?")
+            params.append(filters["until"])
+        where = " AND ".join(conditions) if conditions else "1 = 1"
+        
+        total = conn.execute(f"SELECT COUNT(*) FROM history WHERE {where}", params).fetchone()[0]
+        
+        page_where = where
+        page_params = list(params)
+        if cursor is not None:
+            page_where += " AND id < ?"
+            page_params.append(cursor)
+        sql = f"SELECT id, entry FROM history WHERE {page_where} ORDER BY id DESC"
+        if limit > 0:
+            # 次ページの有無を判定するため1件多く取得
+            sql += " LIMIT ?"
+            page_params.append(limit + 1)
+        rows = conn.execute(sql, page_params).fetchall()
+        
+        has_more = limit > 0 and len(rows) > limit
+        rows = rows[:limit] if limit > 0 else rows
+        entries = []
+        for row_id, entry_json in reversed(rows):
+            entry = json.loads(entry_json)
+            entry["id"] = row_id
+            entries.append(entry)
+        
+        return {
+            "entries": entries,
+            "total": total,
+            "next_cursor": rows[-1][0] if has_more else None
+        }
+    
+    async def query(self, limit: int = 10, cursor: Optional[int] = None, **filters) -> Dict:
+        """履歴を新しい順にページングして取得する
         
         Args:
-            claude_cmd: Claude実行コマンド（文字列またはリスト）
+            limit: 取得する件数（0以下の場合は条件に合うすべて）
+            cursor: 前回のnext_cursor（このIDより古い履歴を取得）
+            **filters: session, session_id, tool_name, success, since, until, client による絞り込み
+            
+        Returns:
+            entries（古い順）、total（条件に合う総数）、next_cursor（続きがない場合はNone）
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._query, limit, cursor, filters)
+    
+    def _clear(self, client: Optional[str]) -> int:
+        conn = self._connect()
+        where, params = ("client = ?", (client,)) if client is not None else ("1 = 1", ())
+        count = conn.execute(f"SELECT COUNT(*) FROM history WHERE {where}", params).fetchone()[0]
+        conn.execute(f"DELETE FROM history WHERE {where}", params)
+        conn.commit()
+        return count
+    
+    async def clear(self, client: Optional[str] = None) -> int:
+        """履歴を削除し、削除件数を返す（clientを指定した場合はそのクライアントの履歴のみ）"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._clear, client)
+
+
+class ResponseCache:
+    """プロンプトとファイル内容のハッシュをキーにした応答キャッシュ
+    
+    メモリ上のLRU（CACHE_MAX_ENTRIES件）とSQLiteのバックストアの2段構成で、
+    どちらもCACHE_TTL秒で期限切れになる。SQLiteへのアクセスは専用スレッドで行う。
+    """
+    
+    def __init__(self, db_path: str = CACHE_DB, max_entries: int = CACHE_MAX_ENTRIES, max_disk_entries: int = CACHE_MAX_DISK_ENTRIES, ttl: float = CACHE_TTL):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()  # キー -> (作成時刻, 値)
+        self.stats: Dict[str, int] = {
+            "hits": 0,
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expired": 0
+        }
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache")
+        self._conn: Optional[sqlite3.Connection] = None
+        
+    @staticmethod
+    def make_key(scope: str, prompt: str, content_hash: Optional[str] = None, session_id: Optional[str] = None) -> str:
+        """キャッシュキーを作成する
+        
+        Args:
+            scope: キャッシュスコープ（"stateless"または"session"）
             prompt: Claudeに送るプロンプト
-            include_resume: --resumeオプションを含めるかどうか
+            content_hash: コンテキストファイルの内容のハッシュ
+            session_id: "session"スコープの場合、再開元のセッションID
             
         Returns:
-            構築されたコマンドリスト
+            キャッシュキー（SHA-256の16進文字列）
         """
-        # 基本的な引数を構築
-        base_args = [
-            "--dangerously-skip-permissions",
-            "--output-format", "json"
-        ]
+        key_source = json.dumps([scope, session_id if scope == "session" else None, content_hash, prompt], ensure_ascii=False)
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """DBに接続しテーブルを作成する（キャッシュスレッド内でのみ呼ぶ）"""
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+                conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("Cache DB unavailable (%s), using in-memory cache only: %s", self.db_path, e)
+                conn = sqlite3.connect(":memory:", check_same_thread=False)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    created REAL NOT NULL,
+                    value TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_created ON cache (created)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+    
+    def _disk_get(self, key: str) -> Optional[Tuple[float, Dict]]:
+        row = self._connect().execute("SELECT created, value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+    
+    def _disk_put(self, key: str, created: float, value: Dict):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, created, value) VALUES (?, ?, ?)",
+            (key, created, json.dumps(value, ensure_ascii=False))
+        )
+        # 期限切れと上限超過分を削除
+        conn.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+        conn.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,)
+        )
+        conn.commit()
+    
+    def _disk_delete(self, key: str):
+        conn = self._connect()
+        conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+        conn.commit()
+    
+    def _disk_clear(self) -> int:
+        conn = self._connect()
+        count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        conn.execute("DELETE FROM cache")
+        conn.commit()
+        return count
+    
+    def _remember(self, key: str, created: float, value: Dict):
+        """メモリ上のLRUに追加し、上限を超えた分を追い出す"""
+        self.entries[key] = (created, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+    
+    async def get(self, key: str) -> Optional[Dict]:
+        """キャッシュを参照する（期限切れの場合はNone）"""
+        now = time.time()
+        item = self.entries.get(key)
+        if item is not None:
+            if now - item[0] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["memory_hits"] += 1
+                return item[1]
+            del self.entries[key]
+            self.stats["expired"] += 1
         
-        # before_session_idがある場合は --resume オプションを追加
-        if include_resume and self.before_session_id is not None:
-            base_args.extend(["--resume", self.before_session_id])
-            # デバッグ: resumeセッションIDをログに記録
-            debug_log_path = os.path.join(os.path.dirname(__file__), '..', 'claude_command_debug.log')
-            with open(debug_log_path, 'a', encoding='utf-8') as f:
-                f.write(f"[{datetime.now().isoformat()}] Using --resume with session_id: {self.before_session_id}\n")
+        loop = asyncio.get_event_loop()
+        try:
+            item = await loop.run_in_executor(self._executor, self._disk_get, key)
+        except sqlite3.Error as e:
+            logger.warning("Failed to read cache: %s", e)
+            item = None
+        if item is not None:
+            if now - item[0] <= self.ttl:
+                self._remember(key, item[0], item[1])
+                self.stats["hits"] += 1
+                self.stats["disk_hits"] += 1
+                return item[1]
+            self.stats["expired"] += 1
+            self._executor.submit(self._disk_delete, key)
         
-        # プロンプトを追加（UTF-8で処理）
-        base_args.extend(["-p", prompt])
+        self.stats["misses"] += 1
+        return None
+    
+    def put(self, key: str, value: Dict):
+        """キャッシュに保存する（ディスクへの書き込みはバックグラウンドで行う）"""
+        created = time.time()
+        self._remember(key, created, value)
+        self.stats["stores"] += 1
         
-        # コマンドを構築
-        if isinstance(claude_cmd, str):
-            # Unix系: '/path/to/claude' -> ['/path/to/claude', '--arg1', '--arg2', ...]
-            return [claude_cmd] + base_args
+        def write():
+            try:
+                self._disk_put(key, created, value)
+            except sqlite3.Error as e:
+                logger.warning("Failed to write cache: %s", e)
+        
+        self._executor.submit(write)
+    
+    async def clear(self) -> int:
+        """すべてのキャッシュを削除し、ディスク上の削除件数を返す"""
+        self.entries.clear()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._disk_clear)
+    
+    async def get_stats(self) -> Dict:
+        """ヒット率などの統計情報を返す"""
+        loop = asyncio.get_event_loop()
+        try:
+            disk_entries = await loop.run_in_executor(
+                self._executor,
+                lambda: self._connect().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            )
+        except sqlite3.Error:
+            disk_entries = None
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+            "memory_entries": len(self.entries),
+            "disk_entries": disk_entries,
+            "max_entries": self.max_entries,
+            "max_disk_entries": self.max_disk_entries,
+            "ttl": self.ttl
+        }
+
+
+class JobStore:
+    """バックグラウンドジョブの永続ストア（SQLite）
+    
+    投入時に実行中として記録し、完了時に結果を書き込む。結果はクライアントの再接続や
+    サーバーの再起動後も取得でき、完了からJOB_TTL秒で削除される。
+    SQLiteへのアクセスは専用スレッドで直列に行うため、イベントループをブロックしない。
+    """
+    
+    def __init__(self, db_path: str = JOBS_DB, ttl: float = JOB_TTL, max_entries: int = JOB_MAX_ENTRIES):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs")
+        self._conn: Optional[sqlite3.Connection] = None
+        
+    def _connect(self) -> sqlite3.Connection:
+        """DBに接続しテーブルを作成する（ジョブスレッド内でのみ呼ぶ）"""
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+                conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("Jobs DB unavailable (%s), keeping job results in memory: %s", self.db_path, e)
+                conn = sqlite3.connect(":memory:", check_same_thread=False)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    pid INTEGER,
+                    submitted REAL NOT NULL,
+                    finished REAL,
+                    job TEXT NOT NULL,
+                    client TEXT
+                )
+            """)
+            # 以前のバージョンで作成したDBにはクライアントIDの列がない
+            if "client" not in {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                conn.execute("ALTER TABLE jobs ADD COLUMN client TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_submitted ON jobs (submitted)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+    
+    def _put(self, job: Dict):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, status, pid, submitted, finished, job, client) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job["job_id"], job["status"], job["pid"], job["submitted"], job.get("finished"), json.dumps(job, ensure_ascii=False), job.get("client"))
+        )
+        # 期限切れと上限超過分の完了済みジョブを削除
+        conn.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (time.time() - self.ttl,))
+        conn.execute(
+            "DELETE FROM jobs WHERE job_id IN (SELECT job_id FROM jobs WHERE finished IS NOT NULL ORDER BY submitted DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        conn.commit()
+    
+    def _get(self, job_id: str) -> Optional[Dict]:
+        row = self._connect().execute("SELECT job FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+    
+    def _list(self, limit: int, client: Optional[str]) -> List[Dict]:
+        if client is not None:
+            rows = self._connect().execute("SELECT job FROM jobs WHERE client = ? ORDER BY submitted DESC LIMIT ?", (client, limit)).fetchall()
         else:
-            # Windows: ['wsl', '--', '/path/to/claude'] -> ['wsl', '--', '/path/to/claude', '--arg1', '--arg2', ...]
-            return claude_cmd + base_args
+            rows = self._connect().execute("SELECT job FROM jobs ORDER BY submitted DESC LIMIT ?", (limit,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
     
-    def build_claude_version_command(self, claude_cmd: Union[str, List[str]]) -> List[str]:
-        """Claude CLI --versionコマンドを構築する
+    def put(self, job: Dict):
+        """ジョブを保存する（書き込みはバックグラウンドで行い、後続のget・listより先に反映される）"""
+        stored = {k: v for k, v in job.items() if k != "task"}
+        
+        def write():
+            try:
+                self._put(stored)
+            except sqlite3.Error as e:
+                logger.warning("Failed to write job %s: %s", stored["job_id"], e)
+        
+        self._executor.submit(write)
+    
+    async def get(self, job_id: str) -> Optional[Dict]:
+        """ジョブを取得する（存在しない場合はNone）"""
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(self._executor, self._get, job_id)
+        except sqlite3.Error as e:
+            logger.warning("Failed to read job %s: %s", job_id, e)
+            return None
+    
+    async def list(self, limit: int = 20, client: Optional[str] = None) -> List[Dict]:
+        """新しい順にジョブを取得する（clientを指定した場合はそのクライアントのジョブのみ）"""
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(self._executor, self._list, limit, client)
+        except sqlite3.Error as e:
+            logger.warning("Failed to list jobs: %s", e)
+            return []
+
+
+class SessionStateStore:
+    """名前付きセッションの状態（会話位置と使用量）の共有ストア（SQLite）
+    
+    同じDBを使う複数のサーバープロセスで会話位置を共有する。CLIの実行中はセッションに
+    実行中のプロセスのpidを記録し、他のプロセスの同じセッションへの呼び出しはその完了を待つ。
+    更新はトランザクション内で行い、SQLiteのファイルロックにより原子的に反映される。
+    SQLiteへのアクセスは専用スレッドで直列に行うため、イベントループをブロックしない。
+    """
+    
+    def __init__(self, db_path: str = SESSION_STATE_DB, lease_timeout: float = SESSION_LEASE_TIMEOUT):
+        self.db_path = db_path
+        self.lease_timeout = lease_timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-state")
+        self._conn: Optional[sqlite3.Connection] = None
+        
+    def _connect(self) -> sqlite3.Connection:
+        """DBに接続しテーブルを作成する（状態スレッド内でのみ呼ぶ）"""
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+                # トランザクションは明示的に開始する（BEGIN IMMEDIATEで書き込みロックを先に取る）
+                conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("Session state DB unavailable (%s), sessions are not shared: %s", self.db_path, e)
+                conn = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    name TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    updated_at REAL NOT NULL,
+                    owner_pid INTEGER,
+                    owner_since REAL
+                )
+            """)
+            self._conn = conn
+        return self._conn
+    
+    def _owner_alive(self, pid: Optional[int], since: Optional[float]) -> bool:
+        if pid is None or pid == os.getpid():
+            return False
+        if since is not None and time.time() - since > self.lease_timeout:
+            return False
+        # プロセスの生存を確認できない場合は、期限までは使用中とみなす
+        return _pid_alive(pid) is not False
+    
+    def _try_acquire(self, name: str) -> Tuple[bool, Optional[Dict]]:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT state, owner_pid, owner_since FROM sessions WHERE name = ?", (name,)).fetchone()
+            if row is not None and self._owner_alive(row[1], row[2]):
+                conn.execute("ROLLBACK")
+                return False, None
+            if row is None:
+                conn.execute(
+                    "INSERT INTO sessions (name, state, version, updated_at, owner_pid, owner_since) VALUES (?, '{}', 0, ?, ?, ?)",
+                    (name, time.time(), os.getpid(), time.time())
+                )
+            else:
+                conn.execute("UPDATE sessions SET owner_pid = ?, owner_since = ? WHERE name = ?", (os.getpid(), time.time(), name))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return True, json.loads(row[0]) if row is not None else None
+    
+    def _put(self, name: str, state: Dict, release: bool):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO sessions (name, state, version, updated_at) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT(name) DO UPDATE SET state = excluded.state, version = version + 1, updated_at = excluded.updated_at",
+                (name, json.dumps(state, ensure_ascii=False), time.time())
+            )
+            if release:
+                conn.execute("UPDATE sessions SET owner_pid = NULL, owner_since = NULL WHERE name = ? AND owner_pid = ?", (name, os.getpid()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def _get(self, name: str) -> Optional[Dict]:
+        row = self._connect().execute("SELECT state FROM sessions WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+    
+    async def acquire(self, name: str) -> Optional[Dict]:
+        """セッションを使用中にして最新の状態を返す（他のプロセスが使用中の場合は完了を待つ）"""
+        loop = asyncio.get_event_loop()
+        waited = False
+        while True:
+            acquired, state = await loop.run_in_executor(self._executor, self._try_acquire, name)
+            if acquired:
+                if waited:
+                    logger.info("Session %s released by another process", name)
+                return state
+            if not waited:
+                logger.info("Session %s is in use by another process, waiting", name)
+                waited = True
+            await asyncio.sleep(SESSION_LEASE_POLL)
+    
+    async def release(self, name: str, state: Dict):
+        """状態を保存して使用中の印を外す"""
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._put, name, state, True)
+        except sqlite3.Error as e:
+            logger.warning("Failed to save session state %s: %s", name, e)
+    
+    def put(self, name: str, state: Dict):
+        """状態を保存する（書き込みはバックグラウンドで行い、後続のacquire・getより先に反映される）"""
+        def write():
+            try:
+                self._put(name, state, False)
+            except sqlite3.Error as e:
+                logger.warning("Failed to save session state %s: %s", name, e)
+        
+        self._executor.submit(write)
+    
+    async def get(self, name: str) -> Optional[Dict]:
+        """保存されている状態を返す（ない場合はNone）"""
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(self._executor, self._get, name)
+        except sqlite3.Error as e:
+            logger.warning("Failed to read session state %s: %s", name, e)
+            return None
+
+
+class TranscriptIndex:
+    """Claude CLIのセッションの記録（JSONL）の増分インデックス（SQLite）
+    
+    ファイルごとに解析済みのバイト位置・更新時刻・サイズを保持し、更新時は変更されたファイルの
+    追記された行だけを解析する。セッションごとに最初と最後のプロンプト、開始・最終活動時刻、
+    ターン数、トークン数を集計し、検索はSQLiteで行う。
+    SQLiteへのアクセスとファイルの読み込みは専用スレッドで直列に行う。
+    """
+    
+    COUNTERS = ("turns", "input_tokens", "output_tokens", "cache_creation_tokens", "cache_read_tokens")
+    
+    def __init__(self, db_path: str = SESSION_INDEX_DB):
+        self.db_path = db_path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sessions")
+        self._conn: Optional[sqlite3.Connection] = None
+        
+    def _connect(self) -> sqlite3.Connection:
+        """DBに接続しテーブルを作成する（インデックスのスレッド内でのみ呼ぶ）"""
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+                conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("Session index DB unavailable (%s), using in-memory index: %s", self.db_path, e)
+                conn = sqlite3.connect(":memory:", check_same_thread=False)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS transcripts (
+                    path TEXT PRIMARY KEY,
+                    session_id TEXT NOT NULL,
+                    project TEXT,
+                    cwd TEXT,
+                    summary TEXT,
+                    first_prompt TEXT,
+                    last_prompt TEXT,
+                    started_at TEXT,
+                    last_activity TEXT,
+                    turns INTEGER NOT NULL DEFAULT 0,
+                    input_tokens INTEGER NOT NULL DEFAULT 0,
+                    output_tokens INTEGER NOT NULL DEFAULT 0,
+                    cache_creation_tokens INTEGER NOT NULL DEFAULT 0,
+                    cache_read_tokens INTEGER NOT NULL DEFAULT 0,
+                    last_message_id TEXT,
+                    offset INTEGER NOT NULL DEFAULT 0,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    mtime REAL NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_transcripts_activity ON transcripts (last_activity)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_transcripts_session_id ON transcripts (session_id)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+    
+    @staticmethod
+    def _prompt_text(content) -> Optional[str]:
+        """ユーザーのメッセージからプロンプトのテキストを取り出す（ツールの結果の場合はNone）"""
+        if isinstance(content, str):
+            return content
+        if isinstance(content, list):
+            texts = [part.get("text", "") for part in content if isinstance(part, dict) and part.get("type") == "text"]
+            if texts:
+                return "\n".join(texts)
+        return None
+    
+    def _apply_line(self, row: Dict, line: bytes):
+        """記録の1行を集計に反映する"""
+        try:
+            event = _json_loads(line)
+        except ValueError:
+            return
+        if not isinstance(event, dict) or event.get("isSidechain"):
+            return
+        timestamp = event.get("timestamp")
+        if isinstance(timestamp, str):
+            if row["started_at"] is None or timestamp < row["started_at"]:
+                row["started_at"] = timestamp
+            if row["last_activity"] is None or timestamp > row["last_activity"]:
+                row["last_activity"] = timestamp
+        if row["cwd"] is None and isinstance(event.get("cwd"), str):
+            row["cwd"] = event["cwd"]
+        
+        kind = event.get("type")
+        if kind == "summary" and isinstance(event.get("summary"), str):
+            row["summary"] = event["summary"]
+            return
+        message = event.get("message")
+        if not isinstance(message, dict):
+            return
+        if kind == "user" and not event.get("isMeta"):
+            prompt = self._prompt_text(message.get("content"))
+            if prompt is not None:
+                row["turns"] += 1
+                row["last_prompt"] = _truncate(prompt, 500)
+                if row["first_prompt"] is None:
+                    row["first_prompt"] = row["last_prompt"]
+        elif kind == "assistant" and isinstance(message.get("usage"), dict):
+            # 1つの応答が内容ごとに複数行に分かれて同じusageを持つため、メッセージIDごとに1回だけ数える
+            message_id = message.get("id")
+            if message_id is not None and message_id == row["last_message_id"]:
+                return
+            row["last_message_id"] = message_id
+            usage = message["usage"]
+            row["input_tokens"] += usage.get("input_tokens") or 0
+            row["output_tokens"] += usage.get("output_tokens") or 0
+            row["cache_creation_tokens"] += usage.get("cache_creation_input_tokens") or 0
+            row["cache_read_tokens"] += usage.get("cache_read_input_tokens") or 0
+    
+    def _index_file(self, row: Dict, path: str, size: int):
+        """前回の位置から追記された完全な行だけを解析する"""
+        with open(path, "rb") as f:
+            f.seek(row["offset"])
+            pending = b""
+            while row["offset"] + len(pending) < size:
+                block = f.read(min(SESSION_INDEX_READ_SIZE, size - row["offset"] - len(pending)))
+                if not block:
+                    break
+                lines = (pending + block).split(b"\n")
+                # 最後の要素は書きかけの行の可能性があるため次回に回す
+                pending = lines.pop()
+                for line in lines:
+                    row["offset"] += len(line) + 1
+                    if line.strip():
+                        self._apply_line(row, line)
+    
+    def _refresh(self, base: str) -> Dict:
+        """記録のディレクトリを走査し、変更されたファイルだけインデックスを更新する"""
+        conn = self._connect()
+        columns = [d[0] for d in conn.execute("SELECT * FROM transcripts LIMIT 0").description]
+        known = {row[0]: dict(zip(columns, row)) for row in conn.execute("SELECT * FROM transcripts")}
+        stats = {"files": 0, "updated_files": 0, "parsed_bytes": 0, "removed_files": 0}
+        seen = set()
+        
+        try:
+            projects = [entry for entry in os.scandir(base) if entry.is_dir()]
+        except OSError:
+            projects = []
+        for project in projects:
+            try:
+                entries = [entry for entry in os.scandir(project.path) if entry.is_file() and entry.name.endswith(".jsonl")]
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                seen.add(entry.path)
+                stats["files"] += 1
+                row = known.get(entry.path)
+                if row is not None and row["size"] == st.st_size and row["mtime"] == st.st_mtime:
+                    continue
+                if row is None or st.st_size < row["offset"]:
+                    # 新しいファイル、または書き換えられたファイルは最初から解析する
+                    row = {column: None for column in columns}
+                    row.update({counter: 0 for counter in self.COUNTERS})
+                    row.update({"path": entry.path, "session_id": entry.name[:-len(".jsonl")], "project": project.name, "offset": 0})
+                start = row["offset"]
+                try:
+                    self._index_file(row, entry.path, st.st_size)
+                except OSError as e:
+                    logger.warning("Failed to index transcript %s: %s", entry.path, e)
+                    continue
+                row["size"] = st.st_size
+                row["mtime"] = st.st_mtime
+                stats["updated_files"] += 1
+                stats["parsed_bytes"] += row["offset"] - start
+                conn.execute(
+                    f"INSERT OR REPLACE INTO transcripts ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                    [row[column] for column in columns]
+                )
+        
+        removed = [path for path in known if path not in seen]
+        conn.executemany("DELETE FROM transcripts WHERE path = ?", [(path,) for path in removed])
+        stats["removed_files"] = len(removed)
+        conn.commit()
+        return stats
+    
+    def _search(self, base: str, query: Optional[str], project: Optional[str], since: Optional[str], limit: int) -> Tuple[List[Dict], Dict]:
+        start = time.time()
+        stats = self._refresh(base)
+        stats["refresh_time"] = time.time() - start
+        
+        conditions = []
+        params: List = []
+        if query:
+            # 大文字小文字を区別せず、プロンプト・要約・作業ディレクトリ・セッションIDを部分一致で検索
+            pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            conditions.append("(" + " OR ".join(f"{column} LIKE ? ESCAPE '\\'" for column in ("first_prompt", "last_prompt", "summary", "cwd", "session_id")) + ")")
+            params.extend([pattern] * 5)
+        if project:
+            conditions.append("project = ?")
+            params.append(project)
+        if since:
+            conditions.append("last_activity >= ?")
+            params.append(since)
+        where = " AND ".join(conditions) if conditions else "1 = 1"
+        conn = self._connect()
+        total = conn.execute(f"SELECT COUNT(*) FROM transcripts WHERE {where}", params).fetchone()[0]
+        cursor = conn.execute(
+            f"SELECT session_id, project, cwd, summary, first_prompt, last_prompt, started_at, last_activity, "
+            f"turns, input_tokens, output_tokens, cache_creation_tokens, cache_read_tokens "
+            f"FROM transcripts WHERE {where} ORDER BY last_activity DESC LIMIT ?",
+            params + [limit]
+        )
+        columns = [d[0] for d in cursor.description]
+        sessions = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        stats["total"] = total
+        return sessions, stats
+    
+    async def search(self, base: str, query: Optional[str] = None, project: Optional[str] = None, since: Optional[str] = None, limit: int = 20) -> Tuple[List[Dict], Dict]:
+        """インデックスを更新してから、最終活動時刻の新しい順にセッションを検索する
         
         Args:
-            claude_cmd: Claude実行コマンド（文字列またはリスト）
+            base: 記録のディレクトリ（プロジェクトごとのサブディレクトリを含む）
+            query: プロンプト・要約・作業ディレクトリ・セッションIDに含まれる文字列
+            project: プロジェクト（記録のサブディレクトリ名）
+            since: 最終活動時刻の下限（ISO形式）
+            limit: 取得する件数
             
         Returns:
-            構築されたコマンドリスト
+            (セッションのリスト, 更新の統計と条件に合う総数)
         """
-        if isinstance(claude_cmd, str):
-            # Unix系: '/path/to/claude' -> ['/path/to/claude', '--version']
-            return [claude_cmd, "--version"]
-        else:
-            # Windows: ['wsl', '--', '/path/to/claude'] -> ['wsl', '--', '/path/to/claude', '--version']
-            return claude_cmd + ["--version"]
-            
-    async def get_claude_command(self) -> Union[str, List[str]]:
-        """Claude実行コマンドを取得（キャッシュ付き）"""
-        if self.claude_command is None:
-            if platform.system() == "Windows":
-                self.claude_command = await self._find_claude_windows()
-            else:
-                self.claude_command = await self._find_claude_unix()
-                
-            if self.claude_command is None:
-                raise FileNotFoundError("Claude CLI not found. Please install Claude CLI or set CLAUDE_PATH environment variable.")
-                
-        return self.claude_command
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._search, base, query, project, since, limit)
+
+
+class LatencyHistogram:
+    """レイテンシのヒストグラム（Prometheus形式の累積バケットと、パーセンタイル用の直近サンプル）"""
     
-    async def _find_claude_unix(self) -> Optional[str]:
-        """Unix系OS（Linux/macOS/WSL）でClaude CLIを探す"""
-        # 1. whichコマンドで探す
-        try:
-            proc = await asyncio.create_subprocess_exec(
-                "which", "claude",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, _ = await proc.communicate()
-            if proc.returncode == 0 and stdout:
-                return stdout.decode().strip()
-        except (OSError, asyncio.TimeoutError):
-            pass
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.samples: deque = deque(maxlen=METRICS_SAMPLES)
         
-        # 2. よくある場所をチェック
-        common_paths = [
-            "/usr/local/bin/claude",
-            "/usr/bin/claude",
-            os.path.expanduser("~/.npm-global/bin/claude"),
-            os.path.expanduser("~/.yarn/bin/claude"),
-            os.path.expanduser("~/.volta/bin/claude"),
-        ]
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+    
+    def percentile(self, q: float) -> float:
+        """直近のサンプルからパーセンタイルを求める（サンプルがない場合は0）"""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+    
+    def summary(self) -> Dict:
+        return {
+            "count": self.count,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": max(self.samples) if self.samples else 0.0
+        }
+
+
+class ServerMetrics:
+    """ツール呼び出しとClaude CLI実行のメトリクス
+    
+    ツールごとのレイテンシ・エラー率と、CLIのJSON出力に含まれる
+    duration_ms / duration_api_ms / usage から、起動のオーバーヘッド・CLI内の処理時間・
+    API時間の内訳とトークン数を集計する。
+    """
+    
+    _TOKEN_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+    
+    def __init__(self):
+        self.started_at = time.time()
+        self.tools: Dict[str, Dict] = {}  # ツール名 -> 呼び出し数・エラー数・レイテンシ
+        self.cli_runs = 0
+        self.cli_latency = LatencyHistogram()
+        self.cli_seconds = {"overhead": 0.0, "cli": 0.0, "api": 0.0}  # 起動・待ち受けのオーバーヘッド / CLI内の処理 / API
+        self.tokens = {field: 0 for field in self._TOKEN_FIELDS}
+        self.cost_usd = 0.0
+        self._export_task: Optional[asyncio.Task] = None
         
-        # nvmのパスを追加
-        common_paths.extend(glob.glob(os.path.expanduser("~/.nvm/versions/node/*/bin/claude")))
-        # asdfのパスを追加
-        common_paths.extend(glob.glob(os.path.expanduser("~/.asdf/installs/nodejs/*/bin/claude")))
+    def observe_call(self, entry: Dict):
+        """ツール呼び出しの結果（履歴エントリ）を記録する"""
+        tool = self.tools.setdefault(entry.get("tool_name", "unknown"), {
+            "calls": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "empty_results": 0,
+            "cached": 0,
+            "latency": LatencyHistogram()
+        })
+        tool["calls"] += 1
+        error = entry.get("error") or ""
+        if not entry.get("success"):
+            if error.startswith("Timeout"):
+                tool["timeouts"] += 1
+            else:
+                tool["errors"] += 1
+        elif not entry.get("response"):
+            tool["empty_results"] += 1
+        if entry.get("cached"):
+            tool["cached"] += 1
+        else:
+            tool["latency"].observe(entry.get("execution_time") or 0.0)
+    
+    def record_cli_run(self, execution_time: float, response_json: Dict):
+        """CLIの1回の実行（JSON出力）を記録する
         
-        for path in common_paths:
-            if os.path.exists(path) and os.access(path, os.X_OK):
-                return path
+        Args:
+            execution_time: サーバー側で計測した実行時間（秒、プロセス起動を含む）
+            response_json: CLIが出力したJSON
+        """
+        self.cli_runs += 1
+        self.cli_latency.observe(execution_time)
+        duration = (response_json.get("duration_ms") or 0) / 1000
+        api_duration = (response_json.get("duration_api_ms") or 0) / 1000
+        if duration:
+            self.cli_seconds["overhead"] += max(0.0, execution_time - duration)
+            self.cli_seconds["cli"] += max(0.0, duration - api_duration)
+            self.cli_seconds["api"] += api_duration
+        usage = response_json.get("usage") or {}
+        for field in self._TOKEN_FIELDS:
+            self.tokens[field] += usage.get(field) or 0
+        self.cost_usd += response_json.get("total_cost_usd") or 0.0
+    
+    def snapshot(self) -> Dict:
+        """現在の集計値を辞書で返す"""
+        tools = {}
+        for name, tool in self.tools.items():
+            calls = tool["calls"]
+            tools[name] = {
+                "calls": calls,
+                "errors": tool["errors"],
+                "timeouts": tool["timeouts"],
+                "empty_results": tool["empty_results"],
+                "cached": tool["cached"],
+                "error_rate": tool["errors"] / calls if calls else 0.0,
+                "timeout_rate": tool["timeouts"] / calls if calls else 0.0,
+                "empty_rate": tool["empty_results"] / calls if calls else 0.0,
+                "latency": tool["latency"].summary()
+            }
+        return {
+            "uptime": time.time() - self.started_at,
+            "tools": tools,
+            "cli": {
+                "runs": self.cli_runs,
+                "latency": self.cli_latency.summary(),
+                "seconds": dict(self.cli_seconds),
+                "avg_seconds": {phase: total / self.cli_runs if self.cli_runs else 0.0 for phase, total in self.cli_seconds.items()}
+            },
+            "tokens": dict(self.tokens),
+            "cost_usd": self.cost_usd
+        }
+    
+    def render_prometheus(self, cache_stats: Optional[Dict] = None, queue_stats: Optional[Dict] = None) -> str:
+        """Prometheusのテキスト形式に変換する"""
+        lines = []
         
-        # 3. 環境変数をチェック
-        if "CLAUDE_PATH" in os.environ:
-            path = os.environ["CLAUDE_PATH"]
-            if os.path.exists(path) and os.access(path, os.X_OK):
-                return path
+        def metric(name: str, kind: str, help_text: str, samples: List[Tuple[str, float]]):
+            lines.append(f"# HELP claude_mcp_{name} {help_text}")
+            lines.append(f"# TYPE claude_mcp_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"claude_mcp_{name}{labels} {value}")
         
-        return None
+        metric("tool_calls_total", "counter", "Tool calls", [
+            (f'{{tool="{name}"}}', tool["calls"]) for name, tool in self.tools.items()
+        ])
+        metric("tool_failures_total", "counter", "Tool calls that failed, by kind", [
+            (f'{{tool="{name}",kind="{kind}"}}', tool[key])
+            for name, tool in self.tools.items()
+            for kind, key in (("error", "errors"), ("timeout", "timeouts"), ("empty", "empty_results"))
+        ])
+        latency_samples = []
+        for name, tool in self.tools.items():
+            histogram = tool["latency"]
+            for bound, count in zip(LATENCY_BUCKETS, histogram.bucket_counts):
+                latency_samples.append((f'_bucket{{tool="{name}",le="{bound}"}}', count))
+            latency_samples.append((f'_bucket{{tool="{name}",le="+Inf"}}', histogram.count))
+            latency_samples.append((f'_sum{{tool="{name}"}}', histogram.sum))
+            latency_samples.append((f'_count{{tool="{name}"}}', histogram.count))
+        metric("tool_latency_seconds", "histogram", "Tool call latency (cache hits excluded)", latency_samples)
+        metric("cli_runs_total", "counter", "Claude CLI runs with JSON output", [("", self.cli_runs)])
+        metric("cli_seconds_total", "counter", "Claude CLI time by phase (overhead = spawn and I/O outside the CLI)", [
+            (f'{{phase="{phase}"}}', total) for phase, total in self.cli_seconds.items()
+        ])
+        metric("tokens_total", "counter", "Tokens reported by the Claude CLI", [
+            (f'{{type="{field}"}}', count) for field, count in self.tokens.items()
+        ])
+        if cache_stats is not None:
+            metric("cache_lookups_total", "counter", "Response cache lookups", [
+                ('{result="hit"}', cache_stats.get("hits", 0)),
+                ('{result="miss"}', cache_stats.get("misses", 0))
+            ])
+        if queue_stats is not None:
+            metric("queue_running", "gauge", "Claude CLI runs holding a scheduler slot", [("", queue_stats["running"])])
+            metric("queue_waiting", "gauge", "Calls waiting for a scheduler slot", [
+                (f'{{priority="{priority}"}}', count) for priority, count in queue_stats["queued_by_priority"].items()
+            ])
+            metric("queue_rejected_total", "counter", "Calls rejected because the queue was full", [("", queue_stats["rejected"])])
+        return "\n".join(lines) + "\n"
+    
+    def start_export(self, path: str, interval: float = METRICS_EXPORT_INTERVAL):
+        """Prometheus形式のファイルを定期的に書き出すタスクを開始する"""
+        if self._export_task is None:
+            self._export_task = asyncio.ensure_future(self._export_loop(path, interval))
+    
+    async def _export_loop(self, path: str, interval: float):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                text = self.render_prometheus(
+                    await session_manager.response_cache.get_stats(),
+                    session_manager.scheduler.get_stats()
+                )
+                await loop.run_in_executor(None, _write_file_atomic, path, text)
+            except OSError as e:
+                logger.warning("Failed to export metrics: %s", e)
+            await asyncio.sleep(interval)
+
+
+def _write_file_atomic(path: str, text: str):
+    """一時ファイルに書き込んでから置き換える（読み手が書きかけの内容を読まないようにする）"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class ContextFile:
+    """標準入力に渡すコンテキストファイル
+    
+    ファイル全体をメモリに読み込まず、送信時にチャンク単位で読み出す。
+    内容はデコードせずバイト列のまま渡すため、UTF-8以外のテキストもそのまま扱える。
+    サイズ上限を超える場合は先頭・末尾のみを送る（truncate指定時）。
+    """
+    
+    _BINARY_SNIFF_BYTES = 8192  # バイナリ判定に使用する先頭のバイト数
+    _BOUNDARY_SEARCH_BYTES = 4096  # 切り詰め位置を行境界に合わせる際の探索範囲
+    
+    def __init__(self, path: str, size: int, segments: List[Tuple[int, int]]):
+        self.path = path
+        self.size = size  # ファイル全体のサイズ
+        self.segments = segments  # 送信する範囲 (オフセット, 長さ) のリスト
+        
+    @property
+    def truncated(self) -> bool:
+        """サイズ上限により一部を省略したかどうか"""
+        return self.sent_bytes < self.size
+    
+    @property
+    def omitted_marker(self) -> bytes:
+        """省略した位置に挿入する目印"""
+        return f"\n\n... [{self.size - self.sent_bytes} bytes omitted] ...\n\n".encode('utf-8')
+    
+    @property
+    def sent_bytes(self) -> int:
+        """送信するファイル内容のサイズ（省略の目印を除く）"""
+        return sum(length for _, length in self.segments)
+    
+    @classmethod
+    def open(cls, path: str, max_bytes: int, truncate: Optional[str] = None) -> "ContextFile":
+        """ファイルを検査し、送信する範囲を決める（ブロッキング処理）
+        
+        Args:
+            path: ファイルのパス
+            max_bytes: 送信する最大サイズ（バイト）
+            truncate: 上限を超えた場合の切り詰め方法（"head" / "tail" / "head_tail"、Noneの場合はエラー）
+            
+        Returns:
+            ContextFile
+            
+        Raises:
+            ValueError: バイナリファイル、またはサイズ上限を超えていてtruncate未指定の場合
+            OSError: ファイルを読み込めない場合
+        """
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if b"\0" in f.read(cls._BINARY_SNIFF_BYTES):
+                raise ValueError(f"Binary file is not supported: {path}")
+            
+            if size <= max_bytes:
+                return cls(path, size, [(0, size)])
+            if truncate is None:
+                raise ValueError(
+                    f"File too large: {size} bytes (limit {max_bytes} bytes). "
+                    f"Specify truncate ({', '.join(CONTEXT_TRUNCATE_MODES)}) to send part of the file"
+                )
+            
+            if truncate == "head":
+                head_bytes, tail_bytes = max_bytes, 0
+            elif truncate == "tail":
+                head_bytes, tail_bytes = 0, max_bytes
+            else:
+                head_bytes = max_bytes // 2
+                tail_bytes = max_bytes - head_bytes
+            
+            segments = []
+            if head_bytes:
+                segments.append((0, cls._head_boundary(f, head_bytes)))
+            if tail_bytes:
+                start = cls._tail_boundary(f, size - tail_bytes)
+                segments.append((start, size - start))
+            return cls(path, size, segments)
+    
+    def split(self, chunk_bytes: int, overlap: int = 0) -> List["ContextFile"]:
+        """送信する範囲を行境界で分割する（ブロッキング処理）
+        
+        Args:
+            chunk_bytes: 1チャンクの最大サイズ（バイト）
+            overlap: 隣接チャンクと重複させるサイズ（バイト、行境界に合わせる）
+            
+        Returns:
+            チャンクごとのContextFileのリスト
+        """
+        chunks = []
+        overlap = min(overlap, chunk_bytes // 2)  # 重複が大きすぎるとチャンク数が増え続けるため上限を設ける
+        with open(self.path, 'rb') as f:
+            for offset, length in self.segments:
+                start = offset
+                segment_end = offset + length
+                while segment_end - start > chunk_bytes:
+                    end = self._head_boundary(f, start + chunk_bytes, lower=start)
+                    if end <= start:
+                        end = start + chunk_bytes
+                    chunks.append(ContextFile(self.path, self.size, [(start, end - start)]))
+                    next_start = self._tail_boundary(f, max(start + 1, end - overlap)) if overlap else end
+                    # 行境界が見つからず重複部分を作れない場合は重複させない
+                    start = next_start if next_start <= end else end
+                chunks.append(ContextFile(self.path, self.size, [(start, segment_end - start)]))
+        return chunks
+    
+    @classmethod
+    def _head_boundary(cls, f, end: int, lower: int = 0) -> int:
+        """先頭部分の終端を直前の改行（なければUTF-8の文字境界）に合わせる"""
+        start = max(lower, end - cls._BOUNDARY_SEARCH_BYTES)
+        f.seek(start)
+        window = f.read(end - start + 1)
+        newline = window.rfind(b"\n", 0, end - start)
+        if newline >= 0:
+            return start + newline + 1
+        # 末尾がUTF-8のマルチバイト文字の途中にならないようにする
+        while end > start and end - start < len(window) and 0x80 <= window[end - start] < 0xC0:
+            end -= 1
+        return end
+    
+    @classmethod
+    def _tail_boundary(cls, f, start: int) -> int:
+        """末尾部分の開始位置を直後の改行（なければUTF-8の文字境界）に合わせる"""
+        f.seek(start)
+        window = f.read(cls._BOUNDARY_SEARCH_BYTES)
+        newline = window.find(b"\n")
+        if newline >= 0:
+            return start + newline + 1
+        offset = 0
+        while offset < len(window) and 0x80 <= window[offset] < 0xC0:
+            offset += 1
+        return start + offset
+    
+    async def iter_chunks(self):
+        """送信する内容をチャンク単位で返す非同期ジェネレーター（読み込みはスレッドで実行）"""
+        loop = asyncio.get_event_loop()
+        f = await loop.run_in_executor(None, open, self.path, 'rb')
+        try:
+            for index, (offset, length) in enumerate(self.segments):
+                if index > 0:
+                    yield self.omitted_marker
+                await loop.run_in_executor(None, f.seek, offset)
+                remaining = length
+                while remaining > 0:
+                    chunk = await loop.run_in_executor(None, f.read, min(CONTEXT_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+        finally:
+            f.close()
+    
+    async def sha256(self) -> str:
+        """送信する内容のSHA-256（キャッシュキー用）"""
+        digest = hashlib.sha256()
+        async for chunk in self.iter_chunks():
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+async def _iter_input(input_data: Union[bytes, ContextFile]):
+    """標準入力に渡すデータをチャンク単位で返す非同期ジェネレーター"""
+    if isinstance(input_data, ContextFile):
+        async for chunk in input_data.iter_chunks():
+            yield chunk
+    else:
+        for offset in range(0, len(input_data), 65536):
+            yield input_data[offset:offset + 65536]
+
+
+async def _feed_stdin(proc: asyncio.subprocess.Process, input_data: Union[bytes, ContextFile]):
+    """子プロセスの標準入力にデータを書き込んで閉じる（書き込みごとにdrainしてメモリ使用量を抑える）"""
+    try:
+        async for chunk in _iter_input(input_data):
+            proc.stdin.write(chunk)
+            await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        proc.stdin.close()
+
+
+class ClaudeSchedulerFullError(Exception):
+    """スケジューラの待ち行列が満杯の場合の例外"""
+
+
+class ClaudeScheduler:
+    """Claude CLIの実行枠を割り当てるスケジューラ
+    
+    全体とセッション名ごとの同時実行数を制限し、空きがない場合は優先度順
+    （同じ優先度では到着順）に待たせる。待ち行列が上限に達している場合は
+    待たずにClaudeSchedulerFullErrorを送出する。
+    """
+    
+    _WAIT_SAMPLES = 1000  # 待ち時間の統計に使う直近のサンプル数
+    
+    def __init__(self, max_concurrency: int = SCHEDULER_MAX_CONCURRENCY, max_per_session: int = SCHEDULER_MAX_PER_SESSION, max_queue: int = SCHEDULER_MAX_QUEUE):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_per_session = max(1, max_per_session)
+        self.max_queue = max_queue
+        self.running = 0
+        self.running_by_session: Dict[str, int] = {}
+        self.queues: Dict[str, deque] = {priority: deque() for priority in SCHEDULER_PRIORITIES}  # (future, セッション名) の待ち行列
+        self.wait_times: deque = deque(maxlen=self._WAIT_SAMPLES)
+        self.admitted = 0
+        self.rejected = 0
+        
+    def queued(self) -> int:
+        """待機中の呼び出し数"""
+        return sum(len(waiters) for waiters in self.queues.values())
+    
+    def _can_run(self, session_name: str) -> bool:
+        return self.running < self.max_concurrency and self.running_by_session.get(session_name, 0) < self.max_per_session
+    
+    def _start(self, session_name: str):
+        self.running += 1
+        self.running_by_session[session_name] = self.running_by_session.get(session_name, 0) + 1
+        self.admitted += 1
+    
+    def _release(self, session_name: str):
+        self.running -= 1
+        count = self.running_by_session.get(session_name, 0) - 1
+        if count > 0:
+            self.running_by_session[session_name] = count
+        else:
+            self.running_by_session.pop(session_name, None)
+        self._dispatch()
+    
+    def _dispatch(self):
+        """空いた枠を優先度順に待機中の呼び出しへ割り当てる（セッションの上限に達しているものは飛ばす）"""
+        for priority in SCHEDULER_PRIORITIES:
+            waiters = self.queues[priority]
+            for waiter in list(waiters):
+                if self.running >= self.max_concurrency:
+                    return
+                future, session_name = waiter
+                if future.done():
+                    waiters.remove(waiter)
+                elif self._can_run(session_name):
+                    waiters.remove(waiter)
+                    self._start(session_name)
+                    future.set_result(None)
+    
+    @asynccontextmanager
+    async def slot(self, session_name: str, priority: str = "interactive"):
+        """実行枠を確保するコンテキストマネージャ
+        
+        Args:
+            session_name: セッション名（セッションごとの上限に使用）
+            priority: 優先度（SCHEDULER_PRIORITIESのいずれか）
+            
+        Raises:
+            ClaudeSchedulerFullError: 待ち行列が満杯の場合
+        """
+        start_time = time.time()
+        future = asyncio.get_event_loop().create_future()
+        waiter = (future, session_name)
+        self.queues[priority].append(waiter)
+        self._dispatch()
+        if not future.done() and self.queued() > self.max_queue:
+            self.queues[priority].remove(waiter)
+            self.rejected += 1
+            raise ClaudeSchedulerFullError(
+                f"Server busy: {self.running} running, {self.queued()} queued (limit {self.max_queue})"
+            )
+        try:
+            await future
+        except asyncio.CancelledError:
+            if waiter in self.queues[priority]:
+                self.queues[priority].remove(waiter)
+            elif future.done() and not future.cancelled():
+                # 枠が割り当てられた直後にキャンセルされた場合は返却する
+                self._release(session_name)
+            raise
+        self.wait_times.append(time.time() - start_time)
+        try:
+            yield
+        finally:
+            self._release(session_name)
+    
+    def get_stats(self) -> Dict:
+        """実行中・待機中の数と待ち時間の統計を返す"""
+        waits = sorted(self.wait_times)
+        return {
+            "running": self.running,
+            "queued": self.queued(),
+            "queued_by_priority": {priority: len(waiters) for priority, waiters in self.queues.items()},
+            "running_by_session": dict(self.running_by_session),
+            "max_concurrency": self.max_concurrency,
+            "max_per_session": self.max_per_session,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_time_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_time_p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+            "wait_time_max": waits[-1] if waits else 0.0
+        }
+
+
+class ClaudeSession:
+    """名前付きセッションの状態
+    
+    呼び出し側が指定したセッション名ごとに独立した会話を保持する。
+    同じセッションへの呼び出しはlockで1つずつ実行される。
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.before_session_id: Optional[str] = None  # 前回のセッションID
+        self.is_manually_set: bool = False  # 手動設定されたセッションかどうか
+        self.fork_on_resume: bool = False  # 次回の再開時に元の会話から分岐するかどうか（元のセッションの記録に追記しない）
+        self._lock: Optional[asyncio.Lock] = None
+        # 使用量（CLIのJSON出力のusageから集計）
+        self.usage: Dict[str, float] = {field: 0 for field in ServerMetrics._TOKEN_FIELDS}  # 累計トークン数
+        self.turns = 0  # CLIの実行回数
+        self.total_time = 0.0  # 実行時間の累計（秒）
+        self.cost_usd = 0.0
+        self.context_tokens = 0  # 直近のターンで1回のAPI呼び出しあたりに読み込んだトークン数（会話の大きさ）
+        self.recent_latencies: deque = deque(maxlen=COMPACT_MIN_TURNS)  # 直近のターンの実行時間（秒）
+        self.last_compaction_turn: Optional[int] = None  # 最後に圧縮を試みた時点のturns
+        self.compactions = 0
+        self.compact_task: Optional[asyncio.Future] = None  # 実行中の圧縮
+        
+    @property
+    def lock(self) -> asyncio.Lock:
+        """セッション単位のロック（イベントループ上で初めて使われた時に作成）"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+    
+    def record_turn(self, execution_time: float, response_json: Dict):
+        """CLIの1回の実行の使用量を記録する
+        
+        Args:
+            execution_time: 実行時間（秒）
+            response_json: CLIが出力したJSON
+        """
+        usage = response_json.get("usage") or {}
+        for field in self.usage:
+            self.usage[field] += usage.get(field) or 0
+        self.turns += 1
+        self.total_time += execution_time
+        self.cost_usd += response_json.get("total_cost_usd") or 0.0
+        self.recent_latencies.append(execution_time)
+        # usageはターン内のAPI呼び出し（ツール使用の往復）の合計なので、1回あたりに直す
+        loaded = (usage.get("input_tokens") or 0) + (usage.get("cache_creation_input_tokens") or 0) + (usage.get("cache_read_input_tokens") or 0)
+        self.context_tokens = loaded // max(1, response_json.get("num_turns") or 1)
+    
+    def reset_context_stats(self):
+        """会話が切り替わった場合に、会話の大きさと直近の実行時間を忘れる（累計は残す）"""
+        self.context_tokens = 0
+        self.recent_latencies.clear()
+    
+    def compaction_reason(self) -> Optional[str]:
+        """自動で圧縮すべき場合はその理由を返す"""
+        if COMPACT_MODE != "summary":
+            return None
+        if self.last_compaction_turn is not None and self.turns - self.last_compaction_turn < COMPACT_MIN_TURNS:
+            return None
+        if COMPACT_CONTEXT_TOKENS > 0 and self.context_tokens > COMPACT_CONTEXT_TOKENS:
+            return f"context {self.context_tokens} tokens > {COMPACT_CONTEXT_TOKENS}"
+        if COMPACT_LATENCY > 0 and len(self.recent_latencies) == self.recent_latencies.maxlen:
+            average = sum(self.recent_latencies) / len(self.recent_latencies)
+            if average > COMPACT_LATENCY:
+                return f"average latency {average:.1f}s > {COMPACT_LATENCY}s"
+        return None
+    
+    def usage_summary(self) -> Dict:
+        """get_current_sessionで返す使用量"""
+        return {
+            "turns": self.turns,
+            "tokens": dict(self.usage),
+            "cost_usd": self.cost_usd,
+            "avg_latency": self.total_time / self.turns if self.turns else 0.0,
+            "recent_latency": sum(self.recent_latencies) / len(self.recent_latencies) if self.recent_latencies else 0.0,
+            "context_tokens": self.context_tokens,
+            "compactions": self.compactions,
+            "compacting": self.compact_task is not None and not self.compact_task.done()
+        }
+    
+    _STATE_FIELDS = ("before_session_id", "is_manually_set", "fork_on_resume", "usage", "turns", "total_time",
+                     "cost_usd", "context_tokens", "last_compaction_turn", "compactions")
+    
+    def to_state(self) -> Dict:
+        """SessionStateStoreに保存する状態"""
+        state = {field: getattr(self, field) for field in self._STATE_FIELDS}
+        state["usage"] = dict(self.usage)
+        state["recent_latencies"] = list(self.recent_latencies)
+        return state
+    
+    def load_state(self, state: Dict):
+        """SessionStateStoreから読み込んだ状態を反映する"""
+        for field in self._STATE_FIELDS:
+            if field in state:
+                setattr(self, field, state[field])
+        self.usage = dict(self.usage)
+        self.recent_latencies = deque(state.get("recent_latencies", ()), maxlen=COMPACT_MIN_TURNS)
+
+
+class ClaudeSessionManager:
+    """Claude CLIのセッション管理クラス"""
+    
+    def __init__(self):
+        self.client_scoped = False  # Trueの場合はセッション名をクライアントごとに分ける（http・sseトランスポート）
+        self.client_sessions: Dict[Optional[str], Dict[str, ClaudeSession]] = {}  # クライアントID -> (セッション名 -> セッション状態)
+        self.history = ExecutionHistoryStore()  # 実行履歴（SQLiteに永続化）
+        self.response_cache = ResponseCache()  # 応答キャッシュ（cache引数指定時のみ使用）
+        self.claude_command: Optional[Union[str, List[str]]] = None  # キャッシュ
+        self._discovery_task: Optional[asyncio.Future] = None  # 実行中のClaude CLI探索
+        self.worker_pool = ClaudeWorkerPool()  # 常駐ワーカー（WORKER_MODE時のみ使用）
+        self.bridge = ClaudeBridge()  # コマンド実行ブリッジ（BRIDGE_MODE時のみ使用）
+        self.scheduler = ClaudeScheduler()  # Claude CLIの実行枠
+        self.metrics = ServerMetrics()  # get_metricsで参照するメトリクス
+        self.executions: Dict[str, Dict] = {}  # 実行ID -> 実行中のタスクと概要（cancel_execution用）
+        self.jobs: Dict[str, Dict] = {}  # ジョブID -> このプロセスで実行中のジョブ
+        self.job_store = JobStore()  # バックグラウンドジョブ（SQLiteに永続化）
+        self.transcript_index = TranscriptIndex()  # セッションの記録のインデックス（list_sessions / search_sessions）
+        self.state_store = SessionStateStore() if SESSION_STATE else None  # 他のプロセスと共有する会話位置（CLAUDE_MCP_SESSION_STATE時のみ）
+    
+    @property
+    def sessions(self) -> Dict[str, ClaudeSession]:
+        """現在のリクエストのクライアントのセッション（stdioではクライアントは1つ）"""
+        return self.client_sessions.setdefault(_client_scope(), {})
+    
+    def drop_client(self, scope: str):
+        """切断したクライアントのセッションを破棄する"""
+        sessions = self.client_sessions.pop(scope, None)
+        if sessions:
+            logger.info("Client %s disconnected, dropped %d sessions", scope, len(sessions))
+        
+    def get_session(self, name: Optional[str] = None) -> ClaudeSession:
+        """セッション名に対応するセッション状態を取得（なければ作成）
+        
+        Args:
+            name: セッション名（省略時はDEFAULT_SESSION_NAME）
+            
+        Returns:
+            セッション状態
+        """
+        if not name:
+            name = DEFAULT_SESSION_NAME
+        if name not in self.sessions:
+            self.sessions[name] = ClaudeSession(name)
+        return self.sessions[name]
+        
+    def _is_shared(self, session: ClaudeSession) -> bool:
+        """状態を他のプロセスと共有するセッションか（http・sseのクライアントごとのセッションと使い捨てのセッションは共有しない）"""
+        return self.state_store is not None and _client_scope() is None and self.sessions.get(session.name) is session
+    
+    @asynccontextmanager
+    async def hold(self, session: ClaudeSession):
+        """セッションのロックを取得し、最新の状態でセッションを使用する
+        
+        状態を共有している場合は、他のプロセスの同じセッションの使用が終わるのを待って
+        保存されている状態を読み込み、終了時に状態を保存する。
+        """
+        async with session.lock:
+            if not self._is_shared(session):
+                yield
+                return
+            try:
+                state = await self.state_store.acquire(session.name)
+            except sqlite3.Error as e:
+                # DBが使えない場合はこのプロセス内のロックだけで実行する（状態は保存しない）
+                logger.warning("Session state unavailable for %s, using the in-process lock only: %s", session.name, e)
+                yield
+                return
+            if state:
+                session.load_state(state)
+            try:
+                yield
+            finally:
+                await self.state_store.release(session.name, session.to_state())
+    
+    async def refresh(self, session: ClaudeSession):
+        """共有している場合は保存されている最新の状態を読み込む（このプロセスで使用中の場合を除く）"""
+        if self._is_shared(session) and not session.lock.locked():
+            state = await self.state_store.get(session.name)
+            if state:
+                session.load_state(state)
+    
+    @asynccontextmanager
+    async def update(self, session: ClaudeSession):
+        """CLIを実行せずにセッションの状態を変更する（reset_session・set_current_session・fork_session用）
+        
+        このプロセスの呼び出しが使用中の場合は待たずに変更し、状態を保存する（使用中の印は
+        このプロセスのものなので、他のプロセスが古い状態で上書きすることはない）。
+        それ以外はholdと同じく他のプロセスの使用が終わるのを待ち、最新の状態に変更を加えて保存する。
+        """
+        if not session.lock.locked():
+            async with self.hold(session):
+                yield
+            return
+        yield
+        if self._is_shared(session):
+            self.state_store.put(session.name, session.to_state())
+    
+    def _add_history(self, entry: Dict):
+        """履歴に操作を追加（ディスクへの書き込みはバックグラウンドで行う）"""
+        scope = _client_scope()
+        if scope is not None:
+            entry = dict(entry, client=scope)
+        self.history.append(entry)
+        self.metrics.observe_call(entry)
+    
+    def record_turn(self, session: ClaudeSession, execution_time: float, response_json: Dict):
+        """セッションの使用量を記録し、しきい値を超えた名前付きセッションの圧縮を開始する"""
+        session.record_turn(execution_time, response_json)
+        # 使い捨てのセッション（stateless・バッチ・分岐・圧縮自体）は圧縮しない
+        if self.sessions.get(session.name) is not session:
+            return
+        reason = session.compaction_reason()
+        if reason is not None:
+            self.start_compaction(session, reason)
+    
+    def start_compaction(self, session: ClaudeSession, reason: str) -> asyncio.Future:
+        """セッションの圧縮をバックグラウンドで開始する（実行中の場合はそれを返す）
+        
+        圧縮はセッションのロック内で行うため、呼び出し中のターンの完了後に始まり、
+        次のターンは圧縮の完了を待ってから新しい会話位置で実行される。
+        """
+        if session.compact_task is None or session.compact_task.done():
+            logger.info("Compacting session %s (%s)", session.name, reason)
+            session.compact_task = asyncio.ensure_future(_compact_session(session, reason))
+        return session.compact_task
+    
+    def build_claude_command(self, claude_cmd: Union[str, List[str]], prompt: str, include_resume: bool = True, stream: bool = False, session: Optional[ClaudeSession] = None) -> List[str]:
+        """Claude CLIコマンドを構築する共通関数
+        
+        Args:
+            claude_cmd: Claude実行コマンド（文字列またはリスト）
+            prompt: Claudeに送るプロンプト
+            include_resume: --resumeオプションを含めるかどうか
+            stream: Trueの場合は行区切りのstream-json形式で出力させる
+            session: 対象のセッション（省略時はデフォルトセッション）
+            
+        Returns:
+            構築されたコマンドリスト
+        """
+        # 基本的な引数を構築
+        if stream:
+            # stream-jsonは-pと併用する場合--verboseが必須
+            base_args = [
+                "--dangerously-skip-permissions",
+                "--output-format", "stream-json",
+                "--verbose"
+            ]
+        else:
+            base_args = [
+                "--dangerously-skip-permissions",
+                "--output-format", "json"
+            ]
+        
+        # before_session_idがある場合は --resume オプションを追加
+        if session is None:
+            session = self.get_session()
+        if include_resume and session.before_session_id is not None:
+            base_args.extend(["--resume", session.before_session_id])
+            # デバッグ: resumeセッションIDをログに記録
+            logger.debug("Using --resume with session_id: %s (session: %s)", session.before_session_id, session.name)
+            if session.fork_on_resume and FORK_SESSION_FLAG:
+                # 分岐したセッション: 元の会話を引き継ぎ、新しいセッションIDで続ける
+                base_args.append(FORK_SESSION_FLAG)
+        
+        # プロンプトを追加（UTF-8で処理）
+        base_args.extend(["-p", prompt])
+        
+        # コマンドを構築
+        if isinstance(claude_cmd, str):
+            # Unix系: '/path/to/claude' -> ['/path/to/claude', '--arg1', '--arg2', ...]
+            return [claude_cmd] + base_args
+        else:
+            # Windows: ['wsl', '--', '/path/to/claude'] -> ['wsl', '--', '/path/to/claude', '--arg1', '--arg2', ...]
+            return claude_cmd + base_args
+    
+    def build_claude_version_command(self, claude_cmd: Union[str, List[str]]) -> List[str]:
+        """Claude CLI --versionコマンドを構築する
+        
+        Args:
+            claude_cmd: Claude実行コマンド（文字列またはリスト）
+            
+        Returns:
+            構築されたコマンドリスト
+        """
+        if isinstance(claude_cmd, str):
+            # Unix系: '/path/to/claude' -> ['/path/to/claude', '--version']
+            return [claude_cmd, "--version"]
+        else:
+            # Windows: ['wsl', '--', '/path/to/claude'] -> ['wsl', '--', '/path/to/claude', '--version']
+            return claude_cmd + ["--version"]
+            
+    def build_claude_worker_command(self, claude_cmd: Union[str, List[str]], session_id: Optional[str] = None) -> List[str]:
+        """常駐ワーカー用のClaude CLIコマンドを構築する
+        
+        プロンプトは引数ではなく、stream-json形式で標準入力から1行ずつ渡す。
+        
+        Args:
+            claude_cmd: Claude実行コマンド（文字列またはリスト）
+            session_id: 再開するセッションID（Noneの場合は新規セッション）
+            
+        Returns:
+            構築されたコマンドリスト
+        """
+        base_args = [
+            "--dangerously-skip-permissions",
+            "--input-format", "stream-json",
+            "--output-format", "stream-json",
+            "--verbose"
+        ]
+        
+        if session_id is not None:
+            base_args.extend(["--resume", session_id])
+        
+        base_args.append("-p")
+        
+        if isinstance(claude_cmd, str):
+            return [claude_cmd] + base_args
+        else:
+            return claude_cmd + base_args
+            
+    def start_discovery(self):
+        """Claude CLIの探索をバックグラウンドで開始する（サーバー起動時に呼ぶ）"""
+        if self.claude_command is None and self._discovery_task is None:
+            self._discovery_task = asyncio.ensure_future(self._discover_claude_command())
+    
+    async def get_claude_command(self) -> Union[str, List[str]]:
+        """Claude実行コマンドを取得（キャッシュ付き）
+        
+        探索が実行中の場合はその完了を待つ（同時に呼ばれても探索は1回だけ行う）。
+        """
+        if self.claude_command is None:
+            self.start_discovery()
+            task = self._discovery_task
+            try:
+                # 呼び出し元がキャンセルされても探索自体は継続させる
+                self.claude_command = await asyncio.shield(task)
+            finally:
+                if task.done() and (task.cancelled() or task.exception() is not None or task.result() is None):
+                    # 失敗した場合は次回の呼び出しで再探索する
+                    if self._discovery_task is task:
+                        self._discovery_task = None
+                
+            if self.claude_command is None:
+                raise FileNotFoundError("Claude CLI not found. Please install Claude CLI or set CLAUDE_PATH environment variable.")
+                
+        return self.claude_command
+    
+    async def _discover_claude_command(self) -> Optional[Union[str, List[str]]]:
+        """ディスク上のキャッシュを確認し、無効な場合のみClaude CLIを探索する"""
+        start_time = time.time()
+        loop = asyncio.get_event_loop()
+        
+        cached = await loop.run_in_executor(None, self._load_discovery_cache)
+        if cached is not None:
+            command, cached_mtime = cached
+            # 実行ファイルが更新・削除されていなければキャッシュを使用
+            if await self._get_command_mtime(command) == cached_mtime:
+                logger.info("Claude CLI found in discovery cache: %s (%.2fs)", command, time.time() - start_time)
+                return command
+        
+        if platform.system() == "Windows":
+            command = await self._find_claude_windows()
+        else:
+            command = await self._find_claude_unix()
+        
+        if command is not None:
+            mtime = await self._get_command_mtime(command)
+            if mtime is not None:
+                await loop.run_in_executor(None, self._save_discovery_cache, command, mtime)
+            logger.info("Claude CLI discovered: %s (%.2fs)", command, time.time() - start_time)
+        return command
+    
+    def _load_discovery_cache(self) -> Optional[Tuple[Union[str, List[str]], float]]:
+        """探索結果のキャッシュを読み込む（プラットフォームが異なる場合は無効）"""
+        try:
+            with open(DISCOVERY_CACHE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("platform") != platform.system():
+                return None
+            return data["command"], data["mtime"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+    
+    def _save_discovery_cache(self, command: Union[str, List[str]], mtime: float):
+        """探索結果をキャッシュに保存する（一時ファイル経由で置き換え）"""
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(DISCOVERY_CACHE)), exist_ok=True)
+            tmp_path = f"{DISCOVERY_CACHE}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"platform": platform.system(), "command": command, "mtime": mtime}, f)
+            os.replace(tmp_path, DISCOVERY_CACHE)
+        except OSError as e:
+            logger.warning("Failed to save discovery cache: %s", e)
+    
+    async def _get_command_mtime(self, command: Union[str, List[str]]) -> Optional[float]:
+        """Claude CLI実行ファイルの更新時刻を取得（存在しない・実行できない場合はNone）"""
+        if isinstance(command, str):
+            try:
+                if not os.access(command, os.X_OK):
+                    return None
+                return os.stat(command).st_mtime
+            except OSError:
+                return None
+        
+        # Windows: ['wsl', '--', '/path/to/claude'] の実行ファイルをWSL内で確認
+        try:
+            returncode, stdout, _ = await _run_subprocess(["wsl", "--", "stat", "-L", "-c", "%Y", command[-1]], timeout=5)
+            if returncode == 0 and stdout:
+                return float(_decode_output(stdout).strip())
+        except (OSError, ValueError, asyncio.TimeoutError):
+            pass
+        return None
+    
+    async def _which_claude(self, cmd: List[str], timeout: float = 5) -> Optional[str]:
+        """whichコマンドでClaude CLIのパスを取得（失敗・タイムアウト・デコードできない出力は見つからない扱い）"""
+        try:
+            returncode, stdout, _ = await _run_subprocess(cmd, timeout=timeout)
+            if returncode == 0 and stdout:
+                return _decode_output(stdout).strip() or None
+        except (OSError, asyncio.TimeoutError, UnicodeDecodeError):
+            pass
+        return None
+    
+    def _probe_unix_paths(self) -> Optional[str]:
+        """よくあるインストール場所と環境変数CLAUDE_PATHを優先順に確認する"""
+        # 2. よくある場所をチェック
+        common_paths = [
+            "/usr/local/bin/claude",
+            "/usr/bin/claude",
+            os.path.expanduser("~/.npm-global/bin/claude"),
+            os.path.expanduser("~/.yarn/bin/claude"),
+            os.path.expanduser("~/.volta/bin/claude"),
+        ]
+        
+        # nvmのパスを追加
+        common_paths.extend(glob.glob(os.path.expanduser("~/.nvm/versions/node/*/bin/claude")))
+        # asdfのパスを追加
+        common_paths.extend(glob.glob(os.path.expanduser("~/.asdf/installs/nodejs/*/bin/claude")))
+        
+        # 3. 環境変数をチェック
+        if "CLAUDE_PATH" in os.environ:
+            common_paths.append(os.environ["CLAUDE_PATH"])
+        
+        for path in common_paths:
+            if os.path.exists(path) and os.access(path, os.X_OK):
+                return path
+        
+        return None
+    
+    async def _find_claude_unix(self) -> Optional[str]:
+        """Unix系OS（Linux/macOS/WSL）でClaude CLIを探す
+        
+        whichコマンドとファイルシステム上の確認を並行して行い、whichの結果を優先する。
+        """
+        loop = asyncio.get_event_loop()
+        # 1. whichコマンドで探す / 2-3. よくある場所と環境変数をチェック
+        which_path, probed_path = await asyncio.gather(
+            self._which_claude(["which", "claude"]),
+            loop.run_in_executor(None, self._probe_unix_paths)
+        )
+        return which_path or probed_path
+    
+    async def _find_claude_windows(self) -> Optional[List[str]]:
+        """WindowsでWSL経由のClaude CLIを探す
+        
+        WSL内でのwhichとユーザー名の取得を並行して行い、whichの結果を優先する。
+        """
+        async def whoami() -> Optional[str]:
+            try:
+                returncode, stdout, _ = await _run_subprocess(["wsl", "--", "whoami"], timeout=5)
+                if returncode == 0 and stdout:
+                    return _decode_output(stdout).strip()
+            except (OSError, asyncio.TimeoutError):
+                pass
+            return None
+        
+        # 1. WSL内でbashを起動してwhichコマンドを実行 / 2. WSL内のユーザー名を取得
+        path, username = await asyncio.gather(
+            self._which_claude(["wsl", "--", "bash", "-lc", "which claude"]),
+            whoami()
+        )
+        if path:
+            return ["wsl", "--", path]
+        
+        # 2. よくあるnvmのパスを試す
+        # 一般的なnvmパスの例
+        nvm_paths = []
+        if username:
+            nvm_paths.append(f"/home/{username}/.nvm/versions/node/v22.17.0/bin/claude")
+        
+        for path in nvm_paths:
+            try:
+                returncode, _, _ = await _run_subprocess(["wsl", "--", "test", "-x", path], timeout=5)
+                if returncode == 0:
+                    return ["wsl", "--", path]
+            except (OSError, asyncio.TimeoutError):
+                pass
+        
+        return None
+
+
+class StreamJsonCollector:
+    """stream-json出力を1行ずつ解析するクラス
+    
+    assistantのテキストを進捗コールバックに渡し、最終のresultイベント
+    （--output-format jsonの出力と同じ形式）を解析済みの辞書として保持する。
+    """
+    
+    def __init__(self, progress_callback: Optional[Callable[[str], Awaitable[None]]] = None):
+        self.progress_callback = progress_callback
+        self.result_event: Optional[Dict] = None
+        self.session_id: Optional[str] = None
+        
+    async def feed(self, line: bytes) -> bool:
+        """1行分の出力を処理する
+        
+        Args:
+            line: stream-jsonの1行（改行を除くbytes）
+            
+        Returns:
+            resultイベントを受け取った場合はTrue
+        """
+        try:
+            event = _json_loads(line)
+        except ValueError:
+            return False
+        if not isinstance(event, dict):
+            return False
+        
+        if self.session_id is None and "session_id" in event:
+            # セッションIDは最初のイベントで判明する
+            self.session_id = event["session_id"]
+            logger.debug("Stream started, session_id: %s", self.session_id)
+            if self.progress_callback is not None:
+                await self.progress_callback(f"session_id: {self.session_id}")
+        
+        if event.get("type") == "result":
+            self.result_event = event
+            return True
+        
+        if self.progress_callback is not None:
+            text = _extract_stream_text(event)
+            if text:
+                await self.progress_callback(text)
+        return False
+
+
+class ClaudeWorkerError(Exception):
+    """常駐ワーカーのプロセスが応答前に終了した場合の例外"""
+
+
+class ClaudeWorker:
+    """stream-json入力で常駐させるClaude CLIプロセス
+    
+    プロンプトごとにNode.jsプロセスを起動せず、1つのプロセスに複数のターンを送る。
+    """
+    
+    def __init__(self, cmd: List[str]):
+        self.cmd = cmd
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.last_used: float = time.time()
+        self.stderr_tail: bytes = b""  # エラー表示用に標準エラー出力の末尾を保持
+        self._buffer: bytes = b""
+        self._stderr_task: Optional[asyncio.Task] = None
+        self._marker: Optional[str] = None  # WSL内のプロセスグループを特定するマーカー
+        
+    def is_alive(self) -> bool:
+        """プロセスが動作中かどうか"""
+        return self.proc is not None and self.proc.returncode is None
+    
+    async def start(self):
+        """CLIプロセスを起動する"""
+        self._buffer = b""
+        self.stderr_tail = b""
+        cmd, self._marker = _wrap_process_group(self.cmd)
+        self.proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=platform.system() != "Windows"
+        )
+        # 標準エラー出力を読み捨てないとパイプが詰まるため、末尾だけ保持しながら読み続ける
+        self._stderr_task = asyncio.ensure_future(self._drain_stderr(self.proc))
+        
+    async def _drain_stderr(self, proc: asyncio.subprocess.Process):
+        while True:
+            chunk = await proc.stderr.read(4096)
+            if not chunk:
+                break
+            self.stderr_tail = (self.stderr_tail + chunk)[-4096:]
+    
+    async def _readline(self) -> Optional[bytes]:
+        """標準出力から1行読む（EOFの場合はNone）"""
+        while b"\n" not in self._buffer:
+            chunk = await self.proc.stdout.read(65536)
+            if not chunk:
+                if self._buffer.strip():
+                    line, self._buffer = self._buffer, b""
+                    return line
+                return None
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return line
+    
+    async def run_turn(self, prompt: str, collector: StreamJsonCollector) -> Dict:
+        """1ターン分のプロンプトを送り、resultイベントを返す
+        
+        Args:
+            prompt: Claudeに送るプロンプト
+            collector: 出力を解析するStreamJsonCollector
+            
+        Returns:
+            resultイベント（解析済みの辞書）
+            
+        Raises:
+            ClaudeWorkerError: resultイベントを受け取る前にプロセスが終了した場合
+        """
+        message = {
+            "type": "user",
+            "message": {
+                "role": "user",
+                "content": [{"type": "text", "text": prompt}]
+            }
+        }
+        try:
+            self.proc.stdin.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b"\n")
+            await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise ClaudeWorkerError(f"Worker stdin closed: {e}")
+        
+        while True:
+            line = await self._readline()
+            if line is None:
+                await self.proc.wait()
+                # 末尾だけを保持しているため、先頭がマルチバイト文字の途中になりうる
+                error_msg = self.stderr_tail.decode('utf-8', errors='replace').strip() or "no output"
+                raise ClaudeWorkerError(f"Worker exited with code {self.proc.returncode}: {error_msg}")
+            if line.strip() and await collector.feed(line):
+                self.last_used = time.time()
+                return collector.result_event
+    
+    async def stop(self, force: bool = False):
+        """CLIプロセスを終了する
+        
+        Args:
+            force: Trueの場合は標準入力を閉じて待たず、すぐにプロセスグループごと終了する
+        """
+        if self.proc is None:
+            return
+        if force:
+            await _terminate_process(self.proc, self._marker)
+        if self.proc.returncode is None:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            try:
+                await asyncio.wait_for(self.proc.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                await _terminate_process(self.proc, self._marker)
+        if self._stderr_task is not None:
+            self._stderr_task.cancel()
+            self._stderr_task = None
+
+
+class ClaudeWorkerPool:
+    """セッションIDごとに常駐ワーカーを保持するプール
+    
+    ワーカーは使用中はプールから取り出されるため、同じワーカーに複数のターンが
+    同時に送られることはない。アイドル時間が長いワーカーは自動的に終了する。
+    """
+    
+    def __init__(self, idle_timeout: float = WORKER_IDLE_TIMEOUT, max_workers: int = WORKER_MAX_PROCESSES):
+        self.idle_timeout = idle_timeout
+        self.max_workers = max_workers
+        self.workers: Dict[str, ClaudeWorker] = {}  # セッションID -> 待機中のワーカー
+        self._sweeper_task: Optional[asyncio.Task] = None
+        
+    async def execute(self, claude_cmd: Union[str, List[str]], session_id: Optional[str], prompt: str, progress_callback: Optional[Callable[[str], Awaitable[None]]] = None, timeout: float = DEFAULT_TIMEOUT) -> Dict:
+        """ワーカーでプロンプトを実行し、resultイベントを返す
+        
+        セッションに対応するワーカーがなければ起動し、クラッシュしていれば再起動する。
+        出力前にワーカーが終了した場合は1回だけ再起動して再送する。
+        
+        Args:
+            claude_cmd: Claude実行コマンド（文字列またはリスト）
+            session_id: 再開するセッションID（Noneの場合は新規セッション）
+            prompt: Claudeに送るプロンプト
+            progress_callback: 途中経過のテキストを受け取る非同期コールバック
+            timeout: タイムアウト時間（秒）
+            
+        Returns:
+            resultイベント（解析済みの辞書）
+        """
+        worker = self.workers.pop(session_id, None) if session_id is not None else None
+        
+        for attempt in range(2):
+            if worker is None or not worker.is_alive():
+                if worker is not None:
+                    await worker.stop()
+                worker = ClaudeWorker(session_manager.build_claude_worker_command(claude_cmd, session_id))
+                await worker.start()
+            
+            collector = StreamJsonCollector(progress_callback)
+            try:
+                result_event = await asyncio.wait_for(worker.run_turn(prompt, collector), timeout=timeout)
+            except ClaudeWorkerError:
+                await worker.stop()
+                # 何も出力されていなければ再起動して再送（出力後の再送は二重実行になるため行わない）
+                if attempt == 0 and collector.session_id is None:
+                    worker = None
+                    continue
+                raise
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                # 実行中のターンを中断するため、子孫プロセスも含めて強制終了する
+                await worker.stop(force=True)
+                raise
+            
+            # 返されたセッションIDでワーカーをプールに戻す
+            new_session_id = collector.session_id or session_id
+            if new_session_id is not None:
+                await self._put(new_session_id, worker)
+            else:
+                await worker.stop()
+            return result_event
+        
+        raise ClaudeWorkerError("Worker failed to start")
+    
+    async def _put(self, session_id: str, worker: ClaudeWorker):
+        """ワーカーをプールに戻し、上限を超えた分は古いものから終了する"""
+        old_worker = self.workers.pop(session_id, None)
+        if old_worker is not None and old_worker is not worker:
+            await old_worker.stop()
+        self.workers[session_id] = worker
+        
+        while len(self.workers) > self.max_workers:
+            oldest_id = min(self.workers, key=lambda k: self.workers[k].last_used)
+            await self.workers.pop(oldest_id).stop()
+        
+        if self._sweeper_task is None or self._sweeper_task.done():
+            self._sweeper_task = asyncio.ensure_future(self._sweep_idle())
+    
+    async def _sweep_idle(self):
+        """アイドル時間がidle_timeoutを超えたワーカーを定期的に終了する"""
+        while self.workers:
+            await asyncio.sleep(min(self.idle_timeout, 60))
+            now = time.time()
+            for session_id in [k for k, w in self.workers.items() if now - w.last_used > self.idle_timeout]:
+                worker = self.workers.pop(session_id, None)
+                if worker is not None:
+                    await worker.stop()
+    
+    async def shutdown(self):
+        """すべてのワーカーを終了する"""
+        workers = list(self.workers.values())
+        self.workers.clear()
+        for worker in workers:
+            await worker.stop()
+        if self._sweeper_task is not None:
+            self._sweeper_task.cancel()
+            self._sweeper_task = None
+
+
+# ブリッジプロセス内で実行するスクリプト（WSL内またはローカルのpython3で動作）
+#
+# フレーム形式: 長さ(4バイト) + 種別(1バイト) + リクエストID(4バイト) + データ
+#   サーバー -> ブリッジ: R=実行要求(JSON), I=標準入力データ, E=標準入力終了, K=強制終了
+#   ブリッジ -> サーバー: O=標準出力, e=標準エラー出力, X=終了コード, F=起動失敗
+_BRIDGE_SCRIPT = r"""
+import json, os, queue, signal, struct, subprocess, sys, threading
+inp = sys.stdin.buffer
+out = sys.stdout.buffer
+out_lock = threading.Lock()
+procs = {}
+stdin_queues = {}
+
+def send(kind, rid, data=b""):
+    with out_lock:
+        out.write(struct.pack(">IcI", len(data), kind, rid) + data)
+        out.flush()
+
+def read_exact(n):
+    buf = b""
+    while len(buf) < n:
+        chunk = inp.read(n - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return buf
+
+def pump(rid, stream, kind):
+    while True:
+        chunk = os.read(stream.fileno(), 65536)
+        if not chunk:
+            break
+        send(kind, rid, chunk)
+
+def feed(proc, q):
+    try:
+        while True:
+            data = q.get()
+            if data is None:
+                break
+            proc.stdin.write(data)
+            proc.stdin.flush()
+    except OSError:
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+
+def wait(rid, proc, pumps):
+    for t in pumps:
+        t.join()
+    code = proc.wait()
+    procs.pop(rid, None)
+    stdin_queues.pop(rid, None)
+    send(b"X", rid, str(code).encode())
+
+while True:
+    header = read_exact(9)
+    if header is None:
+        break
+    length, kind, rid = struct.unpack(">IcI", header)
+    data = read_exact(length) if length else b""
+    if data is None:
+        break
+    if kind == b"R":
+        req = json.loads(data.decode("utf-8"))
+        try:
+            proc = subprocess.Popen(
+                req["argv"],
+                stdin=subprocess.PIPE if req.get("stdin") else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                start_new_session=True
+            )
+        except OSError as e:
+            send(b"F", rid, str(e).encode("utf-8", "replace"))
+            continue
+        procs[rid] = proc
+        if req.get("stdin"):
+            q = queue.Queue()
+            stdin_queues[rid] = q
+            threading.Thread(target=feed, args=(proc, q), daemon=True).start()
+        pumps = [
+            threading.Thread(target=pump, args=(rid, proc.stdout, b"O"), daemon=True),
+            threading.Thread(target=pump, args=(rid, proc.stderr, b"e"), daemon=True)
+        ]
+        for t in pumps:
+            t.start()
+        threading.Thread(target=wait, args=(rid, proc, pumps), daemon=True).start()
+    elif kind == b"I":
+        q = stdin_queues.get(rid)
+        if q is not None:
+            q.put(data)
+    elif kind == b"E":
+        q = stdin_queues.get(rid)
+        if q is not None:
+            q.put(None)
+    elif kind == b"K":
+        proc = procs.get(rid)
+        if proc is not None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+for proc in list(procs.values()):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+"""
+
+
+class ClaudeBridgeError(OSError):
+    """ブリッジプロセスとの通信に失敗した場合の例外"""
+
+
+class ClaudeBridge:
+    """WSL内（Linuxではローカル）に常駐させるコマンド実行ブリッジ
+    
+    1つのブリッジプロセスに長さ付きフレームでコマンドを送り、標準出力・標準エラー出力・
+    終了コードをフレームで受け取る。複数のコマンドを同時に実行でき、
+    ブリッジが終了していた場合は次の呼び出しで自動的に再起動する。
+    """
+    
+    _FRAME_HEADER = struct.Struct(">IcI")
+    
+    def __init__(self):
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self._requests: Dict[int, asyncio.Queue] = {}  # リクエストID -> 受信フレームのキュー
+        self._next_id = 1
+        self._start_lock: Optional[asyncio.Lock] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        
+    @staticmethod
+    def build_bridge_command() -> List[str]:
+        """ブリッジプロセスの起動コマンドを構築する"""
+        # 改行や空白を含まない引数にするため、スクリプトはbase64で渡す
+        encoded = base64.b64encode(_BRIDGE_SCRIPT.encode('utf-8')).decode('ascii')
+        code = f"exec(__import__('base64').b64decode('{encoded}'))"
+        if platform.system() == "Windows":
+            return ["wsl", "--", "python3", "-c", code]
+        return [sys.executable, "-c", code]
+    
+    @staticmethod
+    def to_bridge_argv(cmd: List[str]) -> List[str]:
+        """['wsl', '--', ...] 形式のコマンドをブリッジ内で実行するargvに変換する"""
+        if len(cmd) >= 2 and cmd[0] == "wsl" and cmd[1] == "--":
+            return cmd[2:]
+        return cmd
+    
+    def is_alive(self) -> bool:
+        """ブリッジプロセスが動作中かどうか"""
+        return self.proc is not None and self.proc.returncode is None
+    
+    async def _ensure_started(self):
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+            self._write_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self.is_alive():
+                return
+            self.proc = await asyncio.create_subprocess_exec(
+                *self.build_bridge_command(),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            self._reader_task = asyncio.ensure_future(self._read_frames(self.proc))
+            asyncio.ensure_future(self._drain_stderr(self.proc))
+            logger.info("Command bridge started (pid %s)", self.proc.pid)
+    
+    async def _drain_stderr(self, proc: asyncio.subprocess.Process):
+        while True:
+            line = await proc.stderr.readline()
+            if not line:
+                break
+            # デコードできないバイトで読み出しが止まるとパイプが詰まるため、置換して読み続ける
+            logger.warning("Bridge stderr: %s", _truncate(line.decode('utf-8', errors='replace').rstrip()))
+    
+    async def _read_frames(self, proc: asyncio.subprocess.Process):
+        """ブリッジからのフレームを読み、リクエストごとのキューに振り分ける"""
+        try:
+            while True:
+                header = await proc.stdout.readexactly(self._FRAME_HEADER.size)
+                length, kind, request_id = self._FRAME_HEADER.unpack(header)
+                data = await proc.stdout.readexactly(length) if length else b""
+                request_queue = self._requests.get(request_id)
+                if request_queue is not None:
+                    request_queue.put_nowait((kind, data))
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            # ブリッジが終了した場合、実行中のリクエストはすべて失敗させる
+            logger.warning("Command bridge exited")
+            for request_queue in self._requests.values():
+                request_queue.put_nowait((b"F", b"Command bridge exited"))
+    
+    async def _send(self, kind: bytes, request_id: int, data: bytes = b""):
+        async with self._write_lock:
+            try:
+                self.proc.stdin.write(self._FRAME_HEADER.pack(len(data), kind, request_id) + data)
+                await self.proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError) as e:
+                raise ClaudeBridgeError(f"Command bridge closed: {e}")
+    
+    async def run(self, cmd: List[str], on_stdout: Callable[[bytes], Awaitable[None]], input_data: Optional[Union[bytes, ContextFile]] = None, timeout: float = DEFAULT_TIMEOUT) -> Tuple[int, bytes]:
+        """ブリッジ経由でコマンドを実行する
+        
+        Args:
+            cmd: 実行するコマンド（['wsl', '--', ...] 形式の場合はブリッジ内で直接実行）
+            on_stdout: 標準出力のチャンクを受け取る非同期コールバック
+            input_data: 標準入力に渡すデータ（ContextFileの場合はチャンク単位で読み出して送る。Noneの場合は標準入力を閉じる）
+            timeout: タイムアウト時間（秒）
+            
+        Returns:
+            (リターンコード, 標準エラー出力) のタプル
+            
+        Raises:
+            ClaudeBridgeError: ブリッジが応答前に終了した、またはコマンドを起動できなかった場合
+        """
+        await self._ensure_started()
+        request_id = self._next_id
+        self._next_id = (self._next_id + 1) & 0xFFFFFFFF or 1
+        request_queue: asyncio.Queue = asyncio.Queue()
+        self._requests[request_id] = request_queue
+        
+        async def communicate() -> Tuple[int, bytes]:
+            request = {"argv": self.to_bridge_argv(cmd), "stdin": input_data is not None}
+            await self._send(b"R", request_id, json.dumps(request).encode('utf-8'))
+            if input_data is not None:
+                async for chunk in _iter_input(input_data):
+                    await self._send(b"I", request_id, chunk)
+                await self._send(b"E", request_id)
+            
+            stderr_chunks: List[bytes] = []
+            while True:
+                kind, data = await request_queue.get()
+                if kind == b"O":
+                    await on_stdout(data)
+                elif kind == b"e":
+                    stderr_chunks.append(data)
+                elif kind == b"X":
+                    return int(data), b"".join(stderr_chunks)
+                elif kind == b"F":
+                    raise ClaudeBridgeError(_decode_output(data))
+        
+        try:
+            return await asyncio.wait_for(communicate(), timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # タイムアウト・キャンセル時はブリッジ内のプロセスグループを終了させる
+            if self.is_alive():
+                try:
+                    await self._send(b"K", request_id)
+                except ClaudeBridgeError:
+                    pass
+            raise
+        finally:
+            self._requests.pop(request_id, None)
+    
+    async def shutdown(self):
+        """ブリッジプロセスを終了する（ブリッジ内の実行中コマンドも終了する）"""
+        if self.is_alive():
+            self.proc.stdin.close()
+            try:
+                await asyncio.wait_for(self.proc.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                self.proc.kill()
+                await self.proc.wait()
+
+
+# グローバルセッションマネージャー
+session_manager = ClaudeSessionManager()
+
+# http・sseトランスポートでのクライアントID（MCPの接続ごとに割り当て、接続の破棄時にセッションも破棄）
+_client_scopes: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _client_scope() -> Optional[str]:
+    """現在のリクエストを送ったクライアントのIDを返す（stdioトランスポートやリクエスト外ではNone）"""
+    if not session_manager.client_scoped:
+        return None
+    try:
+        client_session = mcp.get_context().request_context.session
+    except (LookupError, ValueError):
+        return None
+    scope = _client_scopes.get(client_session)
+    if scope is None:
+        scope = uuid.uuid4().hex[:8]
+        _client_scopes[client_session] = scope
+        weakref.finalize(client_session, session_manager.drop_client, scope)
+    return scope
+
+
+def _scheduler_key(session_name: str) -> str:
+    """スケジューラのセッションごとの上限に使うキー（同じセッション名でもクライアントごとに分ける）"""
+    scope = _client_scope()
+    return session_name if scope is None else f"{scope}/{session_name}"
+
+
+_throwaway_ids = itertools.count(1)
+
+
+def _throwaway_session(session_name: str) -> ClaudeSession:
+    """名前付きセッションとは独立した使い捨てのセッションを作る
+    
+    名前は"<セッション名>#<連番>"で、元のセッションや他の使い捨てのセッションと
+    スケジューラのセッションごとの上限を共有しない（互いに独立した呼び出しを直列化しない）。
+    """
+    return ClaudeSession(f"{session_name}#{next(_throwaway_ids)}")
+
+
+def _clamp_concurrency(requested: int) -> int:
+    """バッチ・分岐の同時実行数をスケジューラ全体の上限（CLAUDE_MCP_MAX_CONCURRENCY）に収める"""
+    return min(requested, session_manager.scheduler.max_concurrency)
+
+
+def _wrap_process_group(cmd: List[str]) -> Tuple[List[str], Optional[str]]:
+    """WSL経由のコマンドを、WSL内で独立したプロセスグループとして起動するコマンドに変換する
+    
+    wsl.exeを終了してもWSL内のclaudeや子プロセスは残るため、setsidで新しいグループを作り、
+    終了時にグループを特定できるようマーカーをシェルの引数に含める。
+    
+    Args:
+        cmd: 実行するコマンド
+        
+    Returns:
+        (起動するコマンド, 終了用のマーカー) のタプル（WSL経由でない場合はマーカーなし）
+    """
+    if platform.system() == "Windows" and len(cmd) >= 2 and cmd[0] == "wsl" and cmd[1] == "--":
+        marker = f"claude-mcp-{uuid.uuid4().hex}"
+        # sh -c '"$@"' はexecしないため、shがグループのリーダーとして残りマーカーで検索できる
+        return ["wsl", "--", "setsid", "-w", "sh", "-c", '"$@"', marker] + cmd[2:], marker
+    return cmd, None
+
+
+def _signal_process_group(proc: asyncio.subprocess.Process, sig: int):
+    """子プロセスのプロセスグループにシグナルを送る（Unix系のみ）"""
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def _terminate_process(proc: asyncio.subprocess.Process, marker: Optional[str] = None):
+    """子プロセスを子孫プロセスごと終了して回収する
+    
+    Unix系ではプロセスグループにSIGTERMを送り、PROCESS_KILL_GRACE秒待ってからSIGKILLを送る。
+    WindowsではWSL内のプロセスグループをマーカーで特定してSIGKILLを送り、wsl.exeも終了する。
+    
+    Args:
+        proc: 終了するプロセス（start_new_session=Trueまたは_wrap_process_groupで起動したもの）
+        marker: _wrap_process_groupが返したマーカー
+    """
+    if platform.system() == "Windows":
+        if marker is not None and proc.returncode is None:
+            # 自分自身に一致しないよう、先頭の文字を[]で囲んだパターンで検索する
+            pattern = f"[{marker[0]}]{marker[1:]}"
+            try:
+                kill_proc = await asyncio.create_subprocess_exec(
+                    "wsl", "--", "sh", "-c", 'pkill -KILL -g "$(pgrep -n -f "$1")"', "sh", pattern,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.DEVNULL
+                )
+                await asyncio.wait_for(kill_proc.wait(), timeout=5)
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning("Failed to kill WSL process group: %s", e)
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+        return
+    
+    if proc.returncode is None:
+        _signal_process_group(proc, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=PROCESS_KILL_GRACE)
+        except asyncio.TimeoutError:
+            pass
+    # リーダーが終了していても子孫が残っている場合があるため、グループ全体をSIGKILLする
+    _signal_process_group(proc, signal.SIGKILL)
+    await proc.wait()
+
+
+async def _run_subprocess(cmd: List[str], input_data: Optional[Union[bytes, ContextFile]] = None, timeout: float = DEFAULT_TIMEOUT) -> Tuple[int, bytes, bytes]:
+    """サブプロセスを非同期に実行する
+
+    asyncio.create_subprocess_execを使用するため、実行中もイベントループをブロックしない。
+    タイムアウト時は子プロセスをプロセスグループごと終了して回収した上でasyncio.TimeoutErrorを送出する。
+    BRIDGE_MODEの場合は常駐ブリッジ経由で実行する。
+
+    Args:
+        cmd: 実行するコマンド
+        input_data: 標準入力に渡すデータ（ContextFileの場合はチャンク単位で読み出して送る。Noneの場合は標準入力を閉じる）
+        timeout: タイムアウト時間（秒）
+
+    Returns:
+        (リターンコード, 標準出力, 標準エラー出力) のタプル
+    """
+    if BRIDGE_MODE:
+        stdout_chunks: List[bytes] = []
+        
+        async def collect(chunk: bytes):
+            stdout_chunks.append(chunk)
+        
+        returncode, stderr = await session_manager.bridge.run(cmd, collect, input_data, timeout)
+        return returncode, b"".join(stdout_chunks), stderr
+    
+    cmd, marker = _wrap_process_group(cmd)
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if input_data is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=platform.system() != "Windows"
+    )
+    async def communicate():
+        if input_data is None:
+            return await proc.communicate()
+        stdout, stderr, _ = await asyncio.gather(proc.stdout.read(), proc.stderr.read(), _feed_stdin(proc, input_data))
+        await proc.wait()
+        return stdout, stderr
+
+    try:
+        stdout, stderr = await asyncio.wait_for(communicate(), timeout=timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        # タイムアウト・キャンセル時は子孫プロセスも含めて残さない
+        await _terminate_process(proc, marker)
+        raise
+    return proc.returncode, stdout, stderr
+
+
+async def _run_subprocess_streaming(cmd: List[str], on_line: Callable[[bytes], Awaitable[None]], input_data: Optional[Union[bytes, ContextFile]] = None, timeout: float = DEFAULT_TIMEOUT) -> Tuple[int, bytes]:
+    """サブプロセスを非同期に実行し、標準出力を1行ずつコールバックに渡す
+
+    出力を待たずに到着した行から順に処理するため、stream-json形式の逐次解析に使用する。
+    タイムアウト時は子プロセスをプロセスグループごと終了して回収した上でasyncio.TimeoutErrorを送出する。
+    BRIDGE_MODEの場合は常駐ブリッジ経由で実行する。
+
+    Args:
+        cmd: 実行するコマンド
+        on_line: 標準出力の各行（改行を除くbytes）を受け取る非同期コールバック
+        input_data: 標準入力に渡すデータ（ContextFileの場合はチャンク単位で読み出して送る。Noneの場合は標準入力を閉じる）
+        timeout: タイムアウト時間（秒）
+
+    Returns:
+        (リターンコード, 標準エラー出力) のタプル
+    """
+    # StreamReader.readline()は64KBを超える行で失敗するため、自前で行を切り出す
+    buffer = b""
+
+    async def feed_lines(chunk: bytes):
+        nonlocal buffer
+        buffer += chunk
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            if line.strip():
+                await on_line(line)
+
+    if BRIDGE_MODE:
+        returncode, stderr = await session_manager.bridge.run(cmd, feed_lines, input_data, timeout)
+        if buffer.strip():
+            await on_line(buffer)
+        return returncode, stderr
+
+    cmd, marker = _wrap_process_group(cmd)
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if input_data is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=platform.system() != "Windows"
+    )
+
+    async def read_stdout():
+        while True:
+            chunk = await proc.stdout.read(65536)
+            if not chunk:
+                break
+            await feed_lines(chunk)
+        if buffer.strip():
+            await on_line(buffer)
+
+    async def communicate():
+        tasks = [read_stdout(), proc.stderr.read()]
+        if input_data is not None:
+            tasks.append(_feed_stdin(proc, input_data))
+        results = await asyncio.gather(*tasks)
+        await proc.wait()
+        return proc.returncode, results[1]
+
+    try:
+        return await asyncio.wait_for(communicate(), timeout=timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        # タイムアウト・キャンセル時は子孫プロセスも含めて残さない
+        await _terminate_process(proc, marker)
+        raise
+
+
+def _extract_stream_text(event: Dict) -> str:
+    """stream-jsonのイベントから進捗通知用のテキストを取り出す
+
+    Args:
+        event: stream-jsonの1行分をパースした辞書
+
+    Returns:
+        assistantメッセージのテキスト（ツール呼び出しはツール名）。該当しない場合は空文字列
+    """
+    if event.get("type") != "assistant":
+        return ""
+    content = event.get("message", {}).get("content", [])
+    if not isinstance(content, list):
+        return ""
+    parts = []
+    for block in content:
+        if not isinstance(block, dict):
+            continue
+        if block.get("type") == "text" and block.get("text"):
+            parts.append(block["text"])
+        elif block.get("type") == "tool_use":
+            parts.append(f"[tool_use: {block.get('name', 'unknown')}]")
+    return "\n".join(parts)
+
+
+def _make_progress_callback(ctx: Optional[Context]) -> Optional[Callable[[str], Awaitable[None]]]:
+    """MCPの進捗通知を送るコールバックを作成する
+
+    クライアントがprogressTokenを指定した場合のみストリーミングモードを有効にする。
+
+    Args:
+        ctx: FastMCPのリクエストコンテキスト
+
+    Returns:
+        進捗メッセージを受け取る非同期コールバック。進捗通知が不要な場合はNone
+    """
+    if ctx is None:
+        return None
+    try:
+        meta = ctx.request_context.meta
+    except ValueError:
+        # リクエスト外から呼ばれた場合
+        return None
+    if meta is None or meta.progressToken is None:
+        return None
+
+    progress_count = 0
+
+    async def report(message: str):
+        nonlocal progress_count
+        progress_count += 1
+        await ctx.report_progress(progress_count, message=message)
+
+    return report
+
+
+def _decode_output(data: bytes) -> str:
+    """サブプロセスの出力をデコードする（Windows環境では不正なバイトを置換）"""
+    if platform.system() == "Windows":
+        return data.decode('utf-8', errors='replace')
+    return data.decode('utf-8')
+
+
+def _json_loads(data: Union[bytes, str]):
+    """JSONを解析する（orjsonがインストールされていれば使用、不正な場合はValueError）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _parse_cli_output(stdout: bytes) -> Tuple[Optional[Dict], Optional[str]]:
+    """CLIの標準出力（--output-format jsonの結果）を1回だけ解析する
+    
+    バイト列のまま解析し、JSONオブジェクトでない場合のみ文字列にデコードする。
+    
+    Args:
+        stdout: CLIの標準出力
+        
+    Returns:
+        (JSONオブジェクト, None)、JSONオブジェクトでない場合は(None, 前後の空白を除いた出力)
+    """
+    start = 0
+    while start < len(stdout) and stdout[start] in b" \t\r\n":
+        start += 1
+    if stdout[start:start + 1] == b"{":
+        try:
+            response_json = _json_loads(stdout)
+        except ValueError:
+            response_json = None
+            if platform.system() == "Windows":
+                # 不正なバイトを置換してから解析する
+                try:
+                    response_json = json.loads(_decode_output(stdout))
+                except ValueError:
+                    pass
+        if isinstance(response_json, dict):
+            return response_json, None
+    return None, _decode_output(stdout).strip()
+
+
+def _describe_tool_use(part: Dict) -> str:
+    """tool_useを「ツール名: 対象」の1行にする"""
+    name = part.get("name", "tool")
+    tool_input = part.get("input")
+    if isinstance(tool_input, dict):
+        for key in ("file_path", "path", "command", "pattern", "url", "description"):
+            if isinstance(tool_input.get(key), str):
+                return f"{name}: {_truncate(tool_input[key], 200)}"
+    return name
+
+
+def _summarize_transcript_turn(data: bytes) -> Optional[str]:
+    """セッションの記録から最後のターンのアシスタントの出力と実行した操作をまとめる
+    
+    最後のユーザーのプロンプト（ツールの結果やメタ情報を除く）より後の
+    アシスタントのメッセージから、最後のテキストとtool_useの一覧を取り出す。
+    
+    Args:
+        data: 記録（JSONL）の末尾部分
+        
+    Returns:
+        復元した応答（取り出せるものがない場合はNone）
+    """
+    last_text = None
+    actions: List[str] = []
+    for line in reversed(data.split(b"\n")):
+        try:
+            event = _json_loads(line)
+        except ValueError:
+            continue
+        if not isinstance(event, dict) or event.get("isSidechain") or event.get("isMeta"):
+            continue
+        message = event.get("message")
+        if not isinstance(message, dict):
+            continue
+        content = message.get("content")
+        if event.get("type") == "user":
+            if isinstance(content, str) or (
+                isinstance(content, list) and any(isinstance(part, dict) and part.get("type") == "text" for part in content)
+            ):
+                # このターンのプロンプトに到達
+                break
+            continue
+        if event.get("type") != "assistant" or event.get("isApiErrorMessage") or not isinstance(content, list):
+            continue
+        for part in reversed(content):
+            if not isinstance(part, dict):
+                continue
+            if part.get("type") == "text" and last_text is None and part.get("text", "").strip():
+                last_text = part["text"]
+            elif part.get("type") == "tool_use":
+                actions.append(_describe_tool_use(part))
+    
+    if last_text is None and not actions:
+        return None
+    sections = []
+    if last_text is not None:
+        sections.append(last_text)
+    if actions:
+        sections.append("実行した操作:\n" + "\n".join(f"- {action}" for action in reversed(actions)))
+    return "\n\n".join(sections)
+
+
+def _transcript_dir() -> Optional[str]:
+    """このプロセスから読めるセッションの記録のディレクトリ（WindowsでCLAUDE_MCP_TRANSCRIPT_DIR未指定の場合はNone）"""
+    if TRANSCRIPT_DIR:
+        return TRANSCRIPT_DIR
+    if platform.system() == "Windows":
+        return None
+    return os.path.join(os.environ.get("CLAUDE_CONFIG_DIR", os.path.expanduser("~/.claude")), "projects")
+
+
+def _read_transcript_tail(base: str, session_id: str) -> Optional[bytes]:
+    """セッションの記録の末尾を読む（記録がない場合はNone）"""
+    paths = glob.glob(os.path.join(glob.escape(base), "*", f"{session_id}.jsonl"))
+    if not paths:
+        return None
+    path = max(paths, key=os.path.getmtime)
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - TRANSCRIPT_TAIL_BYTES))
+        return f.read()
+
+
+async def _recover_from_transcript(session_id: Optional[str]) -> Optional[str]:
+    """空の結果の代わりに、CLIが書き出したセッションの記録から応答を復元する
+    
+    WindowsでCLAUDE_MCP_TRANSCRIPT_DIRを指定していない場合は、wsl経由でWSL内の記録の末尾を読む。
+    
+    Args:
+        session_id: CLIが返したセッションID
+        
+    Returns:
+        復元した応答（記録がない、または取り出せるものがない場合はNone）
+    """
+    # セッションIDはファイル名に使うため、UUIDの文字のみ許可する
+    if not session_id or not all(c.isalnum() or c == "-" for c in session_id):
+        return None
+    base = _transcript_dir()
+    try:
+        if base is None:
+            returncode, data, _ = await _run_subprocess(
+                ["wsl", "--", "sh", "-c", f'tail -c {TRANSCRIPT_TAIL_BYTES} "$(ls -t "${{CLAUDE_CONFIG_DIR:-$HOME/.claude}}"/projects/*/"$1".jsonl | head -n 1)"', "sh", session_id],
+                timeout=10
+            )
+            if returncode != 0:
+                return None
+        else:
+            loop = asyncio.get_event_loop()
+            data = await loop.run_in_executor(None, _read_transcript_tail, base, session_id)
+    except (OSError, asyncio.TimeoutError) as e:
+        logger.warning("Failed to read transcript for %s: %s", session_id, e)
+        return None
+    if not data:
+        return None
+    # 先頭は途中から読んだ行の可能性があるが、解析できない行は読み飛ばす
+    return _summarize_transcript_turn(data)
+
+
+async def _handle_claude_output(output: Union[bytes, Dict], execution_time: float, retry_count: int = 0, progress_callback: Optional[Callable[[str], Awaitable[None]]] = None, session: Optional[ClaudeSession] = None) -> Dict:
+    """Claude CLIの出力（--output-format jsonの結果）を解析して結果を返す
+    
+    すべての実行経路（通常・ストリーミング・常駐ワーカー・標準入力付き）で共通の処理。
+    セッションIDの更新、空の結果に対する警告やClaudeへの問い合わせもここで行う。
+    
+    Args:
+        output: CLIの標準出力、またはストリーミングで解析済みのresultイベント
+        execution_time: 実行時間（秒）
+        retry_count: 現在のリトライ回数（1以上の場合は空の結果についてClaudeに問い合わせない）
+        progress_callback: 途中経過のテキストを受け取る非同期コールバック（ストリーミングモード）
+        session: 対象のセッション（省略時はデフォルトセッション）
+    """
+    if session is None:
+        session = session_manager.get_session()
+    
+    # デバッグ: 生の出力をログに記録（先頭のみ）
+    if logger.isEnabledFor(logging.DEBUG) and isinstance(output, bytes):
+        logger.debug("Raw output: %s", _truncate_bytes(output))
+    
+    if isinstance(output, dict):
+        response_json, text = output, None
+    else:
+        response_json, text = _parse_cli_output(output)
+    
+    if response_json is not None:
+        # デバッグ: JSONの構造をログに記録
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("JSON keys: %s", list(response_json.keys()))
+        
+        # session_idがあれば保存
+        if "session_id" in response_json:
+            new_session_id = response_json["session_id"]
+            old_session_id = session.before_session_id
+            
+            # 手動設定されたセッションの場合でも、新しいセッションIDに更新する
+            if session.is_manually_set:
+                logger.info("Manual session used once (%s): %s -> %s", session.name, old_session_id, new_session_id)
+                # 手動設定フラグをリセット
+                session.is_manually_set = False
+            else:
+                logger.info("Session updated (%s): %s -> %s", session.name, old_session_id, new_session_id)
+            
+            # セッションIDを更新（手動設定でも必ず更新）
+            session.before_session_id = new_session_id
+            session.fork_on_resume = False  # 分岐は最初の呼び出しで完了
+        
+        # resultフィールドの内容を確認
+        result_content = response_json.get("result", "")
+        
+        # resultフィールドの型を確認してログに記録
+        if logger.isEnabledFor(logging.DEBUG):
+            # 大きな応答全体のreprを作らないよう、先頭だけを記録する
+            preview = result_content[:LOG_PAYLOAD_LIMIT] if isinstance(result_content, str) else result_content
+            logger.debug("Result type: %s, value: %s", type(result_content).__name__, _truncate(repr(preview)))
+        
+        # resultが文字列でない場合の処理
+        if isinstance(result_content, (list, dict)):
+            # 配列やオブジェクトの場合はJSON文字列に変換
+            result_str = json.dumps(result_content, ensure_ascii=False)
+            logger.info("Result is %s, converting to string", type(result_content).__name__)
+        elif result_content is None:
+            # Noneの場合は空文字列にする
+            result_str = ""
+            logger.warning("Result is None, using empty string")
+        else:
+            # 文字列の場合はそのまま使用
+            result_str = str(result_content)
+        
+        # 空の応答の場合は警告をログに記録
+        if not result_str:
+            raw = _truncate_bytes(output) if isinstance(output, bytes) else _truncate(json.dumps(response_json, ensure_ascii=False))
+            logger.warning("Empty result detected. JSON: %s", raw)
+            # エラーチェック
+            if response_json.get("is_error", False):
+                logger.error("is_error=True, subtype=%s", response_json.get('subtype', 'unknown'))
+            # 実行時間情報
+            logger.warning("Duration info: duration_ms=%s, duration_api_ms=%s", response_json.get('duration_ms', 'N/A'), response_json.get('duration_api_ms', 'N/A'))
+        
+        session_manager.metrics.record_cli_run(execution_time, response_json)
+        session_manager.record_turn(session, execution_time, response_json)
+        
+        # 実行時間が長い場合も警告
+        if execution_time > SLOW_CALL_SECONDS:
+            logger.warning("Long execution time: %.2fs", execution_time)
+        
+        # 警告メッセージの構築
+        warning = None
+        if not result_str:
+            subtype = response_json.get("subtype", "unknown")
+            if response_json.get("is_error", False) or "error" in subtype:
+                warning = f"Claude CLI error: subtype={subtype}"
+                # error_during_executionの場合は特別な処理
+                if subtype == "error_during_execution":
+                    output_tokens = response_json.get("usage", {}).get("output_tokens", 0)
+                    if output_tokens > 0:
+                        warning += f" (generated {output_tokens} tokens but no result returned)"
+            else:
+                warning = "Empty response from Claude CLI"
+        elif execution_time > SLOW_CALL_SECONDS:
+            warning = f"Long execution time: {execution_time:.1f}s"
+        
+        # 手動設定セッションが見つからなかった場合の警告
+        if session.is_manually_set and "session_id" in response_json:
+            if session.before_session_id != response_json["session_id"]:
+                if warning:
+                    warning += "; "
+                else:
+                    warning = ""
+                warning += f"Manual session not found, new session created"
+        
+        # 空の応答でerror_during_executionの場合の処理
+        is_execution_error = not result_str and response_json.get("subtype") == "error_during_execution"
+        
+        if is_execution_error:
+            # まずCLIがローカルに書き出したセッションの記録から復元する（追加のモデル呼び出しなし）
+            recovered = await _recover_from_transcript(response_json.get("session_id"))
+            if recovered is not None:
+                logger.info("Empty result recovered from transcript (%s)", response_json.get("session_id"))
+                return {
+                    "success": True,
+                    "response": f"[実行は完了しましたが、結果が空でした。セッションの記録から復元:]\n{recovered}",
+                    "execution_time": execution_time,
+                    "warning": "Empty result; recovered from session transcript",
+                    "error": None
+                }
+        
+        if is_execution_error and retry_count < 1:
+            # 記録から復元できない場合は、Claude CLIに問題を報告して応答を求める
+            logger.info("Empty result detected, asking Claude about it...")
+            
+            # 問題の詳細を含むプロンプトを構築
+            output_tokens = response_json.get("usage", {}).get("output_tokens", 0)
+            duration_ms = response_json.get("duration_ms", 0)
+            
+            error_prompt = (
+                f"前回の実行でJSONレスポンスのresultフィールドが空でした。"
+                f"ただし、{output_tokens}トークンが生成され、実行時間は{duration_ms/1000:.1f}秒でした。"
+                f"ファイル出力などの処理を行いましたか？何を実行したか教えてください。"
+            )
+            
+            # エラー報告用のコマンドを構築（セッションを維持）
+            claude_cmd = await session_manager.get_claude_command()
+            error_cmd = session_manager.build_claude_command(
+                claude_cmd,  # WSLコマンド（リスト）もそのまま扱える
+                error_prompt,
+                include_resume=True,  # セッションを維持
+                stream=progress_callback is not None,
+                session=session
+            )
+            
+            # Claude CLIに問題を報告
+            error_result = await _execute_claude_command(error_cmd, retry_count + 1, progress_callback, session)
+            
+            # 元のエラー情報と組み合わせて返す
+            return {
+                "success": True,  # エラー報告は成功
+                "response": f"[実行は完了しましたが、結果が空でした。Claudeからの説明:]\n{error_result.get('response', 'エラー報告も失敗しました')}",
+                "execution_time": execution_time + error_result.get('execution_time', 0),
+                "warning": f"Empty result with {output_tokens} tokens generated",
+                "error": None
+            }
+        
+        return {
+            "success": not is_execution_error,
+            "response": result_str,
+            "execution_time": execution_time,
+            "warning": warning,
+            "error": "Claude CLI execution error" if is_execution_error else None
+        }
+    
+    # JSON形式でない場合は生の出力を返す
+    return {
+        "success": True,
+        "response": text,
+        "execution_time": execution_time
+    }
+
+
+async def _execute_claude_command(cmd: List[str], retry_count: int = 0, progress_callback: Optional[Callable[[str], Awaitable[None]]] = None, session: Optional[ClaudeSession] = None, priority: str = "interactive", timeout: float = DEFAULT_TIMEOUT) -> Dict:
+    """Claude CLIコマンドを実行して結果を返す
+    
+    CLIは非同期サブプロセスとして実行されるため、実行中も他のツール呼び出しに応答できる。
+    progress_callbackを指定した場合、cmdはstream=Trueで構築されている必要があり、
+    到着したイベントを逐次解析して途中経過をコールバックに渡す。
+    実行前にスケジューラの実行枠を確保する（待ち時間はexecution_timeに含めない）。
+    
+    Args:
+        cmd: 実行するコマンド
+        retry_count: 現在のリトライ回数（内部使用）
+        progress_callback: 途中経過のテキストを受け取る非同期コールバック（ストリーミングモード）
+        session: 対象のセッション（省略時はデフォルトセッション）
+        priority: スケジューラの優先度（"interactive"または"batch"）
+        timeout: タイムアウト時間（秒、枠の待ち時間は含まない）
+    """
+    start_time = time.time()
+    session_name = session.name if session is not None else DEFAULT_SESSION_NAME
+    
+    # デバッグ: 実行コマンドをログファイルに記録（プロンプトは切り詰める）
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Executing command: %s", _truncate(' '.join(cmd)))
+    
+    # 非同期サブプロセスとして実行（イベントループをブロックしない）
+    try:
+        async with session_manager.scheduler.slot(_scheduler_key(session_name), priority):
+            start_time = time.time()
+            # Windowsの場合、cmd は ['wsl', '--', '/path/to/claude', ...] の形式
+            # Unix系の場合、cmd は ['/path/to/claude', ...] の形式
+            if progress_callback is not None:
+                # ストリーミングモード: 最終のresultイベントは--output-format jsonの出力と同じ形式
+                collector = StreamJsonCollector(progress_callback)
+                returncode, stderr = await _run_subprocess_streaming(cmd, collector.feed, timeout=timeout)
+                stdout = collector.result_event if collector.result_event is not None else b""
+            else:
+                returncode, stdout, stderr = await _run_subprocess(cmd, timeout=timeout)
+        
+        execution_time = time.time() - start_time
+        
+        # デバッグ: 結果をログに記録
+        logger.info("Return code: %d, Time: %.2fs", returncode, execution_time)
+        
+        if returncode != 0:
+            error_msg = _decode_output(stderr).strip() if stderr else "Unknown error"
+            return {
+                "success": False,
+                "error": f"Command failed with code {returncode}: {error_msg}",
+                "execution_time": execution_time
+            }
+        
+        # 出力を処理
+        return await _handle_claude_output(stdout, execution_time, retry_count, progress_callback, session)
+            
+    except ClaudeSchedulerFullError as e:
+        return {
+            "success": False,
+            "error": str(e),
+            "execution_time": 0
+        }
+    except asyncio.TimeoutError:
+        return {
+            "success": False,
+            "error": f"Timeout after {timeout} seconds",
+            "execution_time": timeout
+        }
+    except Exception as e:
+        return {
+            "success": False,
+            "error": f"Unexpected error: {str(e)}",
+            "execution_time": time.time() - start_time
+        }
+
+
+async def _execute_claude_worker(prompt: str, progress_callback: Optional[Callable[[str], Awaitable[None]]] = None, session: Optional[ClaudeSession] = None, timeout: float = DEFAULT_TIMEOUT) -> Dict:
+    """常駐ワーカーでプロンプトを実行して結果を返す（WORKER_MODE時に使用）
+    
+    Args:
+        prompt: Claudeに送るプロンプト
+        progress_callback: 途中経過のテキストを受け取る非同期コールバック
+        session: 対象のセッション（省略時はデフォルトセッション）
+        timeout: タイムアウト時間（秒、枠の待ち時間は含まない）
+    """
+    start_time = time.time()
+    if session is None:
+        session = session_manager.get_session()
+    
+    logger.debug("Executing on worker, session_id: %s (session: %s)", session.before_session_id, session.name)
+    
+    try:
+        claude_cmd = await session_manager.get_claude_command()
+        async with session_manager.scheduler.slot(_scheduler_key(session.name)):
+            start_time = time.time()
+            result_event = await session_manager.worker_pool.execute(
+                claude_cmd,
+                session.before_session_id,
+                prompt,
+                progress_callback,
+                timeout
+            )
+        execution_time = time.time() - start_time
+        
+        return await _handle_claude_output(result_event, execution_time, 0, progress_callback, session)
+        
+    except ClaudeSchedulerFullError as e:
+        return {
+            "success": False,
+            "error": str(e),
+            "execution_time": 0
+        }
+    except asyncio.TimeoutError:
+        return {
+            "success": False,
+            "error": f"Timeout after {timeout} seconds",
+            "execution_time": timeout
+        }
+    except ClaudeWorkerError as e:
+        return {
+            "success": False,
+            "error": str(e),
+            "execution_time": time.time() - start_time
+        }
+    except Exception as e:
+        return {
+            "success": False,
+            "error": f"Unexpected error: {str(e)}",
+            "execution_time": time.time() - start_time
+        }
+
+
+class ClaudeExecutionCancelled(Exception):
+    """cancel_executionにより実行が中止された場合の例外"""
+    
+    def __init__(self, execution_time: float):
+        super().__init__("Cancelled by cancel_execution")
+        self.execution_time = execution_time
+
+
+# バックグラウンドジョブとして実行中の場合のジョブID（cancel_executionでジョブIDを指定できるようにする）
+_job_execution_id: ContextVar[Optional[str]] = ContextVar("job_execution_id", default=None)
+
+
+def _execution_id(ctx: Optional[Context]) -> str:
+    """実行IDを決める（ジョブIDまたはMCPのリクエストIDがあればそれを使い、なければ生成する）"""
+    job_id = _job_execution_id.get()
+    if job_id is not None:
+        return job_id
+    if ctx is not None:
+        try:
+            return _scoped_request_id(str(ctx.request_id))
+        except (AttributeError, ValueError):
+            pass
+    return uuid.uuid4().hex[:12]
+
+
+def _scoped_request_id(request_id: str) -> str:
+    """MCPのリクエストIDを実行IDにする（http・sseではクライアントごとに重複するためクライアントIDを付ける）"""
+    scope = _client_scope()
+    return request_id if scope is None else f"{scope}-{request_id}"
+
+
+async def _run_cancellable(execution_id: str, tool_name: str, session_name: Optional[str], prompt: str, coro: Awaitable):
+    """cancel_executionで中止できるように登録して実行する
+    
+    処理は別タスクで実行し、cancel_executionはそのタスクだけをキャンセルする。
+    キャンセルは実行中のCLIプロセスまで伝わり、プロセスグループごと終了される。
+    
+    Args:
+        execution_id: 実行ID
+        tool_name: ツール名（一覧表示用）
+        session_name: セッション名（一覧表示用）
+        prompt: プロンプト（一覧表示用）
+        coro: 実行する処理
+        
+    Returns:
+        coroの戻り値
+        
+    Raises:
+        ClaudeExecutionCancelled: cancel_executionにより中止された場合
+    """
+    start_time = time.time()
+    task = asyncio.ensure_future(coro)
+    session_manager.executions[execution_id] = {
+        "task": task,
+        "tool_name": tool_name,
+        "session": session_name,
+        "prompt": _truncate(prompt, 100),
+        "started_at": datetime.now().isoformat(),
+        "client": _client_scope()
+    }
+    try:
+        await asyncio.wait({task})
+    except asyncio.CancelledError:
+        # 呼び出し元がキャンセルされた場合も実行中の処理を残さない
+        task.cancel()
+        await asyncio.wait({task})
+        raise
+    finally:
+        session_manager.executions.pop(execution_id, None)
+    if task.cancelled():
+        raise ClaudeExecutionCancelled(time.time() - start_time)
+    return task.result()
+
+
+async def _execute_with_cache(cache: Optional[str], prompt: str, content_hash: Optional[str], claude_session: ClaudeSession, run: Callable[[ClaudeSession], Awaitable[Dict]]) -> Tuple[Dict, ClaudeSession]:
+    """応答キャッシュを考慮して実行する
+    
+    cacheがNoneの場合は、キャッシュを使わず通常どおりセッションのロック内で実行する。
+    "stateless"の場合は、セッションを再開せず、名前付きセッションの状態も変更しない。
+    "session"の場合は、現在の会話位置（before_session_id）もキーに含め、ヒット時は
+    キャッシュされた応答後のセッションIDに進める。
+    
+    Args:
+        cache: キャッシュスコープ（None、"stateless"、"session"）
+        prompt: Claudeに送るプロンプト
+        content_hash: コンテキストファイルの内容のハッシュ（ファイルなしの場合はNone）
+        claude_session: 名前付きセッション
+        run: 実行対象のセッションを受け取り、実行結果を返す非同期関数
+        
+    Returns:
+        (実行結果, 実行に使用したセッション) のタプル
+    """
+    if cache is None:
+        async with session_manager.hold(claude_session):
+            return await run(claude_session), claude_session
+    
+    response_cache = session_manager.response_cache
+    
+    if cache == "stateless":
+        # 名前付きセッションとは独立した使い捨てのセッションで実行
+        target_session = _throwaway_session(claude_session.name)
+        cache_key = response_cache.make_key(cache, prompt, content_hash)
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            return {"success": True, "response": cached["response"], "execution_time": 0.0, "cached": True}, target_session
+        result = await run(target_session)
+    else:
+        target_session = claude_session
+        async with session_manager.hold(claude_session):
+            cache_key = response_cache.make_key(cache, prompt, content_hash, claude_session.before_session_id)
+            cached = await response_cache.get(cache_key)
+            if cached is not None:
+                # 応答後の会話位置に進める
+                if cached.get("session_id"):
+                    claude_session.before_session_id = cached["session_id"]
+                    claude_session.is_manually_set = False
+                return {"success": True, "response": cached["response"], "execution_time": 0.0, "cached": True}, target_session
+            result = await run(claude_session)
+    
+    # 成功した空でない応答のみ保存
+    if result["success"] and result.get("response") and not result.get("error") and not result.get("warning"):
+        response_cache.put(cache_key, {
+            "response": result["response"],
+            "session_id": target_session.before_session_id
+        })
+    result["cached"] = False
+    return result, target_session
+
+
+@mcp.tool()
+async def execute_claude(prompt: str, session: Optional[str] = None, cache: Optional[str] = None, timeout: Optional[float] = None, ctx: Context = None) -> Dict:
+    """Claude CLIを実行して結果を返す
+    
+    クライアントがprogressTokenを指定した場合はストリーミングモードで実行し、
+    途中経過のテキストをMCPの進捗通知として送信する。
+    セッション名を指定すると、名前ごとに独立した会話として継続される。
+    同じセッションへの呼び出しは順番に、異なるセッションは並行して実行される。
+    
+    Args:
+        prompt: Claudeに送るプロンプト
+        session: セッション名（省略時は"default"）
+        cache: 応答キャッシュのスコープ（省略時はキャッシュしない）
+            "stateless": セッションを再開せず、同じプロンプトの応答を再利用
+            "session": 現在の会話位置が同じ場合のみ応答を再利用
+        timeout: タイムアウト時間（秒、省略時は300秒）
+        ctx: MCPリクエストコンテキスト（自動で渡される。リクエストIDでcancel_executionから中止できる）
+        
+    Returns:
+        実行結果を含む辞書
+    """
+    # Claude実行コマンドを取得
+    try:
+        claude_cmd = await session_manager.get_claude_command()
+    except FileNotFoundError as e:
+        return {
+            "tool_name": "execute_claude_with_context",
+            "success": False,
+            "prompt": prompt,
+            "response": None,
+            "execution_time": 0,
+            "timestamp": datetime.now().isoformat(),
+            "error": str(e)
+        }
+    
+    error = None
+    if cache is not None and cache not in CACHE_SCOPES:
+        error = f"Invalid cache scope: {cache} (expected one of {', '.join(CACHE_SCOPES)})"
+    elif timeout is not None and timeout <= 0:
+        error = f"Invalid timeout: {timeout} (must be positive)"
+    if error is not None:
+        return {
+            "tool_name": "execute_claude",
+            "success": False,
+            "prompt": prompt,
+            "response": None,
+            "execution_time": 0,
+            "timestamp": datetime.now().isoformat(),
+            "error": error
+        }
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+    
+    # 進捗通知が要求されている場合はストリーミングモードを使用
+    progress_callback = _make_progress_callback(ctx)
+    
+    claude_session = session_manager.get_session(session)
+    
+    async def run(target_session: ClaudeSession) -> Dict:
+        if WORKER_MODE and cache != "stateless" and not target_session.fork_on_resume:
+            # 常駐ワーカーで実行（プロセス起動コストを省く。分岐直後は元のセッションのワーカーを使わない）
+            return await _execute_claude_worker(prompt, progress_callback, target_session, timeout)
+        # コマンドを構築（共通関数を使用）
+        cmd = session_manager.build_claude_command(claude_cmd, prompt, stream=progress_callback is not None, session=target_session)
+        
+        # コマンド実行
+        return await _execute_claude_command(cmd, progress_callback=progress_callback, session=target_session, timeout=timeout)
+    
+    # 同じセッションへの呼び出しは1つずつ実行する
+    execution_id = _execution_id(ctx)
+    try:
+        result, target_session = await _run_cancellable(
+            execution_id, "execute_claude", claude_session.name, prompt,
+            _execute_with_cache(cache, prompt, None, claude_session, run)
+        )
+    except ClaudeExecutionCancelled as e:
+        result, target_session = {"success": False, "error": str(e), "execution_time": e.execution_time}, claude_session
+    
+    # 完全な返り値を構築
+    full_result = {
+        "tool_name": "execute_claude",
+        "success": result["success"],
+        "prompt": prompt,
+        "response": result.get("response"),
+        "execution_time": result["execution_time"],
+        "timestamp": datetime.now().isoformat(),
+        "error": result.get("error"),
+        "session": claude_session.name,
+        "session_id": target_session.before_session_id,
+        "execution_id": execution_id
+    }
+    if cache is not None:
+        full_result["cached"] = result.get("cached", False)
+    
+    # 履歴に追加
+    session_manager._add_history(full_result)
+    
+    return full_result
+
+
+@mcp.tool()
+async def execute_claude_batch(
+    items: List[Union[str, Dict]],
+    max_concurrency: Optional[int] = None,
+    timeout: Optional[float] = None,
+    ctx: Context = None
+) -> Dict:
+    """複数のプロンプトを並行して実行し、入力と同じ順序で結果を返す
+    
+    各項目は文字列（プロンプトのみ）または辞書で指定します。
+    sessionを指定しない項目は会話を再開しない独立した呼び出しとして実行され、
+    名前付きセッションの状態は変更しません。
+    
+    Args:
+        items: 実行する項目のリスト。辞書の場合のキー:
+            prompt: Claudeに送るプロンプト（必須）
+            session: セッション名（指定した場合はそのセッションの会話として実行、同じセッションの項目は順番に実行）
+            stateless: Trueの場合はsessionを指定していても会話を再開しない
+            cache: 応答キャッシュのスコープ（"stateless" / "session"）
+            timeout: この項目のタイムアウト時間（秒）
+        max_concurrency: 同時に実行する項目数の上限（省略時はCLAUDE_MCP_BATCH_CONCURRENCY。
+            サーバー全体の上限CLAUDE_MCP_MAX_CONCURRENCYを超える値はその値に切り詰め、結果のmax_concurrencyで返す）
+        timeout: 各項目のタイムアウト時間（秒、省略時は300秒）
+        ctx: MCPリクエストコンテキスト（自動で渡される。各項目は"<リクエストID>:<位置>"の実行IDで
+            cancel_executionから個別に、リクエストIDで全体を中止できる）
+        
+    Returns:
+        入力順の項目ごとの結果（results）と成功・失敗の件数を含む辞書
+    """
+    start_time = time.time()
+    concurrency = max_concurrency if max_concurrency is not None else BATCH_CONCURRENCY
+    error = None
+    if concurrency <= 0:
+        error = f"Invalid max_concurrency: {concurrency} (must be positive)"
+    elif timeout is not None and timeout <= 0:
+        error = f"Invalid timeout: {timeout} (must be positive)"
+    if error is not None:
+        return {
+            "tool_name": "execute_claude_batch",
+            "success": False,
+            "results": [],
+            "execution_time": 0,
+            "timestamp": datetime.now().isoformat(),
+            "error": error
+        }
+    
+    # Claude実行コマンドを取得
+    try:
+        claude_cmd = await session_manager.get_claude_command()
+    except FileNotFoundError as e:
+        return {
+            "tool_name": "execute_claude_batch",
+            "success": False,
+            "results": [],
+            "execution_time": 0,
+            "timestamp": datetime.now().isoformat(),
+            "error": str(e)
+        }
+    
+    concurrency = _clamp_concurrency(concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    execution_id = _execution_id(ctx)
+    
+    async def run_item(index: int, item: Union[str, Dict]) -> Dict:
+        async with semaphore:
+            return await _execute_batch_item(claude_cmd, index, item, timeout if timeout is not None else DEFAULT_TIMEOUT, f"{execution_id}:{index}")
+    
+    results = await asyncio.gather(*(run_item(index, item) for index, item in enumerate(items)))
+    
+    succeeded = sum(1 for result in results if result["success"])
+    return {
+        "tool_name": "execute_claude_batch",
+        "success": succeeded == len(results),
+        "results": results,
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "max_concurrency": concurrency,
+        "execution_id": execution_id,
+        "execution_time": time.time() - start_time,
+        "timestamp": datetime.now().isoformat(),
+        "error": None if succeeded == len(results) else f"{len(results) - succeeded} of {len(results)} items failed"
+    }
+
+
+async def _execute_batch_item(claude_cmd: Union[str, List[str]], index: int, item: Union[str, Dict], default_timeout: float, execution_id: str) -> Dict:
+    """execute_claude_batchの1項目を実行する
+    
+    Args:
+        claude_cmd: Claude実行コマンド（文字列またはリスト）
+        index: 入力での位置
+        item: プロンプト文字列または項目の辞書
+        default_timeout: 項目にtimeoutがない場合のタイムアウト時間（秒）
+        execution_id: cancel_executionで指定する実行ID
+        
+    Returns:
+        項目の実行結果を含む辞書
+    """
+    if isinstance(item, str):
+        item = {"prompt": item}
+    prompt = item.get("prompt")
+    session = item.get("session")
+    cache = item.get("cache")
+    item_timeout = item.get("timeout", default_timeout)
+    stateless = item.get("stateless", session is None)
+    
+    error = None
+    if not isinstance(prompt, str) or not prompt:
+        error = "Missing prompt"
+    elif cache is not None and cache not in CACHE_SCOPES:
+        error = f"Invalid cache scope: {cache} (expected one of {', '.join(CACHE_SCOPES)})"
+    elif stateless and cache == "session":
+        error = "cache='session' cannot be used with a stateless item"
+    elif isinstance(item_timeout, bool) or not isinstance(item_timeout, (int, float)) or item_timeout <= 0:
+        error = f"Invalid timeout: {item_timeout} (must be positive)"
+    if error is not None:
+        return {
+            "index": index,
+            "success": False,
+            "prompt": prompt,
+            "response": None,
+            "execution_time": 0,
+            "error": error
+        }
+    
+    claude_session = session_manager.get_session(session)
+    
+    async def run(target_session: ClaudeSession) -> Dict:
+        cmd = session_manager.build_claude_command(claude_cmd, prompt, session=target_session)
+        return await _execute_claude_command(cmd, session=target_session, priority="batch", timeout=item_timeout)
+    
+    async def execute() -> Tuple[Dict, ClaudeSession]:
+        if stateless and cache is None:
+            # 名前付きセッションとは独立した使い捨てのセッションで実行（ロック不要）
+            stateless_session = _throwaway_session(claude_session.name)
+            return await run(stateless_session), stateless_session
+        return await _execute_with_cache(cache, prompt, None, claude_session, run)
+    
+    try:
+        result, target_session = await _run_cancellable(
+            execution_id, "execute_claude_batch", None if stateless else claude_session.name, prompt, execute()
+        )
+    except ClaudeExecutionCancelled as e:
+        result, target_session = {"success": False, "error": str(e), "execution_time": e.execution_time}, ClaudeSession(claude_session.name)
+    
+    item_result = {
+        "index": index,
+        "success": result["success"],
+        "prompt": prompt,
+        "response": result.get("response"),
+        "execution_time": result["execution_time"],
+        "error": result.get("error"),
+        "session": None if stateless else claude_session.name,
+        "session_id": target_session.before_session_id
+    }
+    if cache is not None:
+        item_result["cached"] = result.get("cached", False)
+    
+    # 履歴に追加（項目ごと）
+    session_manager._add_history(dict(item_result, tool_name="execute_claude_batch", timestamp=datetime.now().isoformat()))
+    
+    return item_result
+
+
+@mcp.tool()
+async def execute_claude_fanout(
+    prompts: List[str],
+    session: Optional[str] = None,
+    session_id: Optional[str] = None,
+    max_concurrency: Optional[int] = None,
+    timeout: Optional[float] = None,
+    ctx: Context = None
+) -> Dict:
+    """同じ会話位置から複数のプロンプトを並行して実行する（分岐ごとに独立した会話）
+    
+    各プロンプトは元のセッションの会話を引き継いだ別々の分岐として実行され、
+    互いの応答は見えません。元のセッションの会話位置は変わりません。
+    分岐の続きを行うには、結果のsession_idをset_current_sessionで別のセッション名に設定します。
+    
+    Args:
+        prompts: 実行するプロンプトのリスト
+        session: 分岐元のセッション名（省略時は"default"）
+        session_id: 分岐元のセッションID（指定した場合はsessionの会話位置の代わりに使用）
+        max_concurrency: 同時に実行する分岐数の上限（省略時はCLAUDE_MCP_BATCH_CONCURRENCY。
+            サーバー全体の上限CLAUDE_MCP_MAX_CONCURRENCYを超える値はその値に切り詰め、結果のmax_concurrencyで返す）
+        timeout: 各分岐のタイムアウト時間（秒、省略時は300秒）
+        ctx: MCPリクエストコンテキスト（自動で渡される。各分岐は"<リクエストID>:<位置>"の実行IDで
+            cancel_executionから個別に、リクエストIDで全体を中止できる）
+        
+    Returns:
+        入力順の分岐ごとの結果（results、分岐後のsession_idを含む）と成功・失敗の件数を含む辞書
+    """
+    start_time = time.time()
+    claude_session = session_manager.get_session(session)
+    if session_id is None:
+        await session_manager.refresh(claude_session)
+    base_session_id = session_id or claude_session.before_session_id
+    concurrency = max_concurrency if max_concurrency is not None else BATCH_CONCURRENCY
+    
+    error = None
+    if not prompts:
+        error = "No prompts"
+    elif concurrency <= 0:
+        error = f"Invalid max_concurrency: {concurrency} (must be positive)"
+    elif timeout is not None and timeout <= 0:
+        error = f"Invalid timeout: {timeout} (must be positive)"
+    elif base_session_id is None:
+        error = f"Session '{claude_session.name}' has no conversation to fork (run execute_claude first or pass session_id)"
+    if error is None:
+        # Claude実行コマンドを取得
+        try:
+            claude_cmd = await session_manager.get_claude_command()
+        except FileNotFoundError as e:
+            error = str(e)
+    if error is not None:
+        return {
+            "tool_name": "execute_claude_fanout",
+            "success": False,
+            "session": claude_session.name,
+            "base_session_id": base_session_id,
+            "results": [],
+            "execution_time": 0,
+            "timestamp": datetime.now().isoformat(),
+            "error": error
+        }
+    
+    concurrency = _clamp_concurrency(concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    execution_id = _execution_id(ctx)
+    
+    async def run_branch(index: int, prompt: str) -> Dict:
+        async with semaphore:
+            return await _execute_fanout_branch(
+                claude_cmd, index, prompt, claude_session.name, base_session_id,
+                timeout if timeout is not None else DEFAULT_TIMEOUT, f"{execution_id}:{index}"
+            )
+    
+    results = await asyncio.gather(*(run_branch(index, prompt) for index, prompt in enumerate(prompts)))
+    
+    succeeded = sum(1 for result in results if result["success"])
+    return {
+        "tool_name": "execute_claude_fanout",
+        "success": succeeded == len(results),
+        "session": claude_session.name,
+        "base_session_id": base_session_id,
+        "results": results,
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "max_concurrency": concurrency,
+        "execution_id": execution_id,
+        "execution_time": time.time() - start_time,
+        "timestamp": datetime.now().isoformat(),
+        "error": None if succeeded == len(results) else f"{len(results) - succeeded} of {len(results)} branches failed"
+    }
+
+
+async def _execute_fanout_branch(claude_cmd: Union[str, List[str]], index: int, prompt: str, session_name: str, base_session_id: str, timeout: float, execution_id: str) -> Dict:
+    """execute_claude_fanoutの1分岐を実行する
+    
+    分岐ごとに使い捨てのセッションを作り、元のセッションIDから分岐して再開する。
+    名前付きセッションの状態は変更しない。
+    
+    Args:
+        claude_cmd: Claude実行コマンド（文字列またはリスト）
+        index: 入力での位置
+        prompt: Claudeに送るプロンプト
+        session_name: 分岐元のセッション名
+        base_session_id: 分岐元のセッションID
+        timeout: タイムアウト時間（秒）
+        execution_id: cancel_executionで指定する実行ID
+        
+    Returns:
+        分岐の実行結果を含む辞書
+    """
+    if not isinstance(prompt, str) or not prompt:
+        return {
+            "index": index,
+            "success": False,
+            "prompt": prompt,
+            "response": None,
+            "execution_time": 0,
+            "error": "Missing prompt",
+            "session_id": None
+        }
+    
+    # 分岐ごとに別のセッション名にする（スケジューラのセッションごとの上限で直列化されないように）
+    branch = _throwaway_session(session_name)
+    branch.before_session_id = base_session_id
+    branch.fork_on_resume = True
+    
+    async def run() -> Dict:
+        cmd = session_manager.build_claude_command(claude_cmd, prompt, session=branch)
+        return await _execute_claude_command(cmd, session=branch, timeout=timeout)
+    
+    try:
+        result = await _run_cancellable(execution_id, "execute_claude_fanout", branch.name, prompt, run())
+    except ClaudeExecutionCancelled as e:
+        result = {"success": False, "error": str(e), "execution_time": e.execution_time}
+    
+    branch_result = {
+        "index": index,
+        "success": result["success"],
+        "prompt": prompt,
+        "response": result.get("response"),
+        "execution_time": result["execution_time"],
+        "error": result.get("error"),
+        "session_id": None if branch.fork_on_resume else branch.before_session_id
+    }
+    
+    # 履歴に追加（分岐ごと）
+    session_manager._add_history(dict(
+        branch_result,
+        tool_name="execute_claude_fanout",
+        session=session_name,
+        base_session_id=base_session_id,
+        timestamp=datetime.now().isoformat()
+    ))
+    
+    return branch_result
+
+
+@mcp.tool()
+async def execute_claude_with_context(
+    prompt: str,
+    file_path: str,
+    session: Optional[str] = None,
+    cache: Optional[str] = None,
+    max_bytes: Optional[int] = None,
+    truncate: Optional[str] = None,
+    map_reduce: bool = False,
+    chunk_bytes: Optional[int] = None,
+    timeout: Optional[float] = None,
+    ctx: Context = None
+) -> Dict:
+    """ファイルコンテキスト付きでClaude CLIを実行
+    
+    ファイルの内容を読み込んで、その内容についてClaudeに質問できます。
+    例: README.mdについて質問する、コードファイルの説明を求める等
+    
+    Args:
+        prompt: Claudeに送るプロンプト（例: "このファイルの目的を説明して"）
+        file_path: コンテキストとして使用するファイルのパス（例: "README.md"）
+        session: セッション名（省略時は"default"）
+        cache: 応答キャッシュのスコープ（省略時はキャッシュしない）
+            "stateless": セッションを再開せず、同じプロンプトとファイル内容の応答を再利用
+            "session": 現在の会話位置が同じ場合のみ応答を再利用
+        max_bytes: 送信するファイル内容の最大サイズ（バイト、省略時はCLAUDE_MCP_CONTEXT_MAX_BYTES。
+            map_reduce時はtruncateを指定しない限りチャンクごとの上限）
+        truncate: 上限を超えた場合の切り詰め方法（省略時はエラー）
+            "head": 先頭のみ送信
+            "tail": 末尾のみ送信（ログファイル向け）
+            "head_tail": 先頭と末尾を半分ずつ送信
+        map_reduce: Trueの場合、ファイルを行境界で分割してチャンクごとに並行して問い合わせ、
+            最後に部分ごとの回答を統合する（1チャンクに収まる場合は通常どおり実行）
+        chunk_bytes: map_reduce時の1チャンクの最大サイズ（バイト、省略時はCLAUDE_MCP_MAP_CHUNK_BYTES）
+        timeout: タイムアウト時間（秒、省略時は300秒。map_reduce時は各CLI呼び出しごと）
+        ctx: MCPリクエストコンテキスト（自動で渡される。リクエストIDでcancel_executionから中止できる）
+        
+    Returns:
+        実行結果を含む辞書（map_reduce時はチャンクごとの結果をchunksに含む）
+    """
+    error = None
+    if cache is not None and cache not in CACHE_SCOPES:
+        error = f"Invalid cache scope: {cache} (expected one of {', '.join(CACHE_SCOPES)})"
+    elif truncate is not None and truncate not in CONTEXT_TRUNCATE_MODES:
+        error = f"Invalid truncate mode: {truncate} (expected one of {', '.join(CONTEXT_TRUNCATE_MODES)})"
+    elif max_bytes is not None and max_bytes <= 0:
+        error = f"Invalid max_bytes: {max_bytes} (must be positive)"
+    elif chunk_bytes is not None and chunk_bytes <= 0:
+        error = f"Invalid chunk_bytes: {chunk_bytes} (must be positive)"
+    elif timeout is not None and timeout <= 0:
+        error = f"Invalid timeout: {timeout} (must be positive)"
+    if error is not None:
+        return {
+            "tool_name": "execute_claude_with_context",
+            "success": False,
+            "prompt": prompt,
+            "response": None,
+            "execution_time": 0,
+            "timestamp": datetime.now().isoformat(),
+            "error": error
+        }
+    
+    # ファイルの存在確認
+    if not os.path.exists(file_path):
+        return {
+            "tool_name": "execute_claude_with_context",
+            "success": False,
+            "prompt": prompt,
+            "response": None,
+            "execution_time": 0,
+            "timestamp": datetime.now().isoformat(),
+            "error": f"File not found: {file_path}"
+        }
+    
+    # ファイルを検査する（内容は実行時にチャンク単位で読み出す）
+    # map-reduceではサイズ上限をファイル全体ではなくチャンクごとに適用する（truncate指定時を除く）
+    limit = max_bytes if max_bytes is not None else CONTEXT_MAX_BYTES
+    file_limit = sys.maxsize if map_reduce and truncate is None else limit
+    try:
+        loop = asyncio.get_event_loop()
+        context = await loop.run_in_executor(None, ContextFile.open, file_path, file_limit, truncate)
+    except ValueError as e:
+        return {
+            "tool_name": "execute_claude_with_context",
+            "success": False,
+            "prompt": prompt,
+            "response": None,
+            "execution_time": 0,
+            "timestamp": datetime.now().isoformat(),
+            "error": str(e)
+        }
+    except Exception as e:
+        return {
+            "tool_name": "execute_claude_with_context",
+            "success": False,
+            "prompt": prompt,
+            "response": None,
+            "execution_time": 0,
+            "timestamp": datetime.now().isoformat(),
+            "error": f"Failed to read file: {str(e)}"
+        }
+    
+    # Claude実行コマンドを取得
+    try:
+        claude_cmd = await session_manager.get_claude_command()
+    except FileNotFoundError as e:
+        return {
+            "tool_name": "execute_claude_with_context",
+            "success": False,
+            "prompt": prompt,
+            "response": None,
+            "execution_time": 0,
+            "timestamp": datetime.now().isoformat(),
+            "error": str(e)
+        }
     
-    async def _find_claude_windows(self) -> Optional[List[str]]:
-        """WindowsでWSL経由のClaude CLIを探す"""
-        # 1. WSL内でbashを起動してwhichコマンドを実行
-        try:
-            result = subprocess.run(
-                ["wsl", "--", "bash", "-lc", "which claude"],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-            if result.returncode == 0 and result.stdout:
-                path = result.stdout.strip()
-                return ["wsl", "--", path]
-        except (subprocess.SubprocessError, subprocess.TimeoutExpired, OSError):
-            pass
-        
-        # 2. よくあるnvmのパスを試す
-        # 一般的なnvmパスの例
-        nvm_paths = []
-        
-        # WSL内のユーザー名を取得して動的にパスを生成
-        try:
-            result = subprocess.run(
-                ["wsl", "--", "whoami"],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-            if result.returncode == 0 and result.stdout:
-                username = result.stdout.strip()
-                nvm_paths.append(f"/home/{username}/.nvm/versions/node/v22.17.0/bin/claude")
-        except (subprocess.SubprocessError, subprocess.TimeoutExpired, OSError):
-            pass
-        
-        for path in nvm_paths:
-            try:
-                result = subprocess.run(
-                    ["wsl", "--", "test", "-x", path],
-                    capture_output=True,
-                    timeout=5
-                )
-                if result.returncode == 0:
-                    return ["wsl", "--", path]
-            except (subprocess.SubprocessError, subprocess.TimeoutExpired, OSError):
-                pass
-        
-        return None
-
-
-# グローバルセッションマネージャー
-session_manager = ClaudeSessionManager()
+    claude_session = session_manager.get_session(session)
+    
+    # map-reduceモードではチャンクに分割する
+    chunks = None
+    if map_reduce:
+        chunk_limit = min(chunk_bytes if chunk_bytes is not None else MAP_CHUNK_BYTES, limit)
+        chunks = await loop.run_in_executor(None, context.split, chunk_limit, MAP_OVERLAP_BYTES)
+        if len(chunks) == 1:
+            chunks = None
+    
+    # キャッシュキー用に送信する内容のハッシュを計算（map-reduceの結果は通常の結果と区別する）
+    content_hash = None
+    if cache is not None:
+        content_hash = await context.sha256()
+        if chunks is not None:
+            content_hash = f"map_reduce:{len(chunks)}:{content_hash}"
+    
+    async def run(target_session: ClaudeSession) -> Dict:
+        if chunks is not None:
+            return await _execute_map_reduce(claude_cmd, prompt, chunks, target_session, timeout)
+        return await _execute_claude_with_input(claude_cmd, prompt, context, target_session, timeout=timeout)
+    
+    # 同じセッションへの呼び出しは1つずつ実行する
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+    execution_id = _execution_id(ctx)
+    try:
+        result, target_session = await _run_cancellable(
+            execution_id, "execute_claude_with_context", claude_session.name, prompt,
+            _execute_with_cache(cache, prompt, content_hash, claude_session, run)
+        )
+    except ClaudeExecutionCancelled as e:
+        result, target_session = {"success": False, "error": str(e), "execution_time": e.execution_time}, claude_session
+    
+    # 完全な返り値を構築
+    full_result = {
+        "tool_name": "execute_claude_with_context",
+        "success": result["success"],
+        "prompt": prompt,
+        "response": result.get("response"),
+        "execution_time": result["execution_time"],
+        "timestamp": datetime.now().isoformat(),
+        "error": result.get("error"),
+        "context_file": file_path,
+        "context_bytes": context.sent_bytes,
+        "truncated": context.truncated,
+        "session": claude_session.name,
+        "session_id": target_session.before_session_id,
+        "execution_id": execution_id
+    }
+    if "chunks" in result:
+        full_result["chunks"] = result["chunks"]
+    if cache is not None:
+        full_result["cached"] = result.get("cached", False)
+    
+    # 履歴に追加
+    session_manager._add_history(full_result)
+    
+    return full_result
 
 
-async def _execute_claude_command(cmd: List[str], retry_count: int = 0) -> Dict:
-    """Claude CLIコマンドを実行して結果を返す（内部は同期実行）
-    
-    MCPのasync関数として定義されているが、内部のCLI実行は同期的に行う。
+async def _execute_claude_with_input(claude_cmd: Union[str, List[str]], prompt: str, context: Union[bytes, ContextFile], session: ClaudeSession, priority: str = "interactive", timeout: float = DEFAULT_TIMEOUT, retry_count: int = 0) -> Dict:
+    """ファイル内容を標準入力として渡してClaude CLIを実行する
     
     Args:
-        cmd: 実行するコマンド
-        retry_count: 現在のリトライ回数（内部使用）
+        claude_cmd: Claude実行コマンド（文字列またはリスト）
+        prompt: Claudeに送るプロンプト
+        context: 標準入力に渡す内容（コンテキストファイルまたはバイト列）
+        session: 対象のセッション
+        priority: スケジューラの優先度（"interactive"または"batch"）
+        timeout: タイムアウト時間（秒、枠の待ち時間は含まない）
+        retry_count: 1以上の場合は空の結果についてClaudeに問い合わせない
+        
+    Returns:
+        実行結果を含む辞書
     """
-    start_time = time.time()
+    # コマンドを構築（共通関数を使用）
+    cmd = session_manager.build_claude_command(claude_cmd, prompt, session=session)
     
-    # デバッグ: 実行コマンドをログファイルに記録
-    debug_log_path = os.path.join(os.path.dirname(__file__), '..', 'claude_command_debug.log')
-    with open(debug_log_path, 'a', encoding='utf-8') as f:
-        f.write(f"\n[{datetime.now().isoformat()}] Executing command: {' '.join(cmd)}\n")
+    # コマンド実行（ファイル内容を標準入力として渡す）
+    start_time = time.time()
     
-    # 全環境で同期実行を使用（MCPは1対1通信のため非同期の必要なし）
+    # 非同期サブプロセスとして実行（イベントループをブロックしない）
     try:
-        # エンコーディング設定（Windows環境向け）
-        if platform.system() == "Windows":
-            # Windowsの場合、cmd は ['wsl', '--', '/path/to/claude', ...] の形式
-            encoding_kwargs = {'encoding': 'utf-8', 'errors': 'replace'}
-        else:
-            # Unix系の場合、cmd は ['/path/to/claude', ...] の形式
-            encoding_kwargs = {'encoding': 'utf-8'}
-        
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            timeout=DEFAULT_TIMEOUT,
-            stdin=subprocess.DEVNULL,
-            **encoding_kwargs
-        )
+        async with session_manager.scheduler.slot(_scheduler_key(session.name), priority):
+            start_time = time.time()
+            returncode, stdout, stderr = await _run_subprocess(cmd, input_data=context, timeout=timeout)
         
         execution_time = time.time() - start_time
         
-        # デバッグ: 結果をログに記録
-        with open(debug_log_path, 'a', encoding='utf-8') as f:
-            f.write(f"[{datetime.now().isoformat()}] Return code: {result.returncode}, Time: {execution_time:.2f}s\n")
-        
-        if result.returncode != 0:
-            error_msg = result.stderr.strip() if result.stderr else "Unknown error"
-            return {
+        if returncode != 0:
+            error_msg = _decode_output(stderr).strip() if stderr else "Unknown error"
+            result = {
                 "success": False,
-                "error": f"Command failed with code {result.returncode}: {error_msg}",
+                "error": f"Command failed with code {returncode}: {error_msg}",
                 "execution_time": execution_time
             }
-        
-        # 出力を処理
-        output = result.stdout.strip()
-        
-        # デバッグ: 生の出力をログに記録（最初の500文字のみ）
-        with open(debug_log_path, 'a', encoding='utf-8') as f:
-            f.write(f"[{datetime.now().isoformat()}] Raw output (first 500 chars): {output[:500]}\n")
-        
-        # JSON形式かチェック
-        if output.startswith('{'):
-            try:
-                response_json = json.loads(output)
-                
-                # デバッグ: JSONの構造をログに記録
-                with open(debug_log_path, 'a', encoding='utf-8') as f:
-                    f.write(f"[{datetime.now().isoformat()}] JSON keys: {list(response_json.keys())}\n")
-                    if "result" in response_json:
-                        f.write(f"[{datetime.now().isoformat()}] Result field: '{response_json['result']}'\n")
-                
-                # session_idがあれば保存
-                if "session_id" in response_json:
-                    new_session_id = response_json["session_id"]
-                    old_session_id = session_manager.before_session_id
-                    
-                    # 手動設定されたセッションの場合でも、新しいセッションIDに更新する
-                    if session_manager.is_manually_set:
-                        with open(debug_log_path, 'a', encoding='utf-8') as f:
-                            f.write(f"[{datetime.now().isoformat()}] Manual session used once: {old_session_id} -> {new_session_id}\n")
-                        # 手動設定フラグをリセット
-                        session_manager.is_manually_set = False
-                    else:
-                        with open(debug_log_path, 'a', encoding='utf-8') as f:
-                            f.write(f"[{datetime.now().isoformat()}] Session updated: {old_session_id} -> {new_session_id}\n")
-                    
-                    # セッションIDを更新（手動設定でも必ず更新）
-                    session_manager.before_session_id = new_session_id
-                
-                # resultフィールドの内容を確認
-                result_content = response_json.get("result", "")
-                
-                # resultフィールドの型を確認してログに記録
-                with open(debug_log_path, 'a', encoding='utf-8') as f:
-                    f.write(f"[{datetime.now().isoformat()}] Result type: {type(result_content).__name__}, value: {repr(result_content)[:200]}\n")
-                
-                # resultが文字列でない場合の処理
-                if isinstance(result_content, (list, dict)):
-                    # 配列やオブジェクトの場合はJSON文字列に変換
-                    result_str = json.dumps(result_content, ensure_ascii=False)
-                    with open(debug_log_path, 'a', encoding='utf-8') as f:
-                        f.write(f"[{datetime.now().isoformat()}] INFO: Result is {type(result_content).__name__}, converting to string: {result_str[:200]}\n")
-                elif result_content is None:
-                    # Noneの場合は空文字列にする
-                    result_str = ""
-                    with open(debug_log_path, 'a', encoding='utf-8') as f:
-                        f.write(f"[{datetime.now().isoformat()}] WARNING: Result is None, using empty string\n")
-                else:
-                    # 文字列の場合はそのまま使用
-                    result_str = str(result_content)
-                
-                # 空の応答の場合は警告をログに記録
-                if not result_str:
-                    with open(debug_log_path, 'a', encoding='utf-8') as f:
-                        f.write(f"[{datetime.now().isoformat()}] WARNING: Empty result detected. Full JSON: {json.dumps(response_json, ensure_ascii=False)[:1000]}\n")
-                        # エラーチェック
-                        if response_json.get("is_error", False):
-                            f.write(f"[{datetime.now().isoformat()}] ERROR: is_error=True, subtype={response_json.get('subtype', 'unknown')}\n")
-                        # 実行時間情報
-                        f.write(f"[{datetime.now().isoformat()}] Duration info: duration_ms={response_json.get('duration_ms', 'N/A')}, duration_api_ms={response_json.get('duration_api_ms', 'N/A')}\n")
-                
-                # 実行時間が長い場合も警告
-                if execution_time > 30:
-                    with open(debug_log_path, 'a', encoding='utf-8') as f:
-                        f.write(f"[{datetime.now().isoformat()}] WARNING: Long execution time: {execution_time:.2f}s\n")
-                
-                # 警告メッセージの構築
-                warning = None
-                if not result_str:
-                    subtype = response_json.get("subtype", "unknown")
-                    if response_json.get("is_error", False) or "error" in subtype:
-                        warning = f"Claude CLI error: subtype={subtype}"
-                        # error_during_executionの場合は特別な処理
-                        if subtype == "error_during_execution":
-                            output_tokens = response_json.get("usage", {}).get("output_tokens", 0)
-                            if output_tokens > 0:
-                                warning += f" (generated {output_tokens} tokens but no result returned)"
-                    else:
-                        warning = "Empty response from Claude CLI"
-                elif execution_time > 30:
-                    warning = f"Long execution time: {execution_time:.1f}s"
-                
-                # 手動設定セッションが見つからなかった場合の警告
-                if session_manager.is_manually_set and "session_id" in response_json:
-                    if session_manager.before_session_id != response_json["session_id"]:
-                        if warning:
-                            warning += "; "
-                        else:
-                            warning = ""
-                        warning += f"Manual session not found, new session created"
-                
-                # 空の応答でerror_during_executionの場合の処理
-                is_execution_error = not result_str and response_json.get("subtype") == "error_during_execution"
-                
-                if is_execution_error and retry_count < 1:
-                    # リトライの代わりに、Claude CLIに問題を報告して応答を求める
-                    with open(debug_log_path, 'a', encoding='utf-8') as f:
-                        f.write(f"[{datetime.now().isoformat()}] Empty result detected, asking Claude about it...\n")
-                    
-                    # 問題の詳細を含むプロンプトを構築
-                    output_tokens = response_json.get("usage", {}).get("output_tokens", 0)
-                    duration_ms = response_json.get("duration_ms", 0)
-                    
-                    error_prompt = (
-                        f"前回の実行でJSONレスポンスのresultフィールドが空でした。"
-                        f"ただし、{output_tokens}トークンが生成され、実行時間は{duration_ms/1000:.1f}秒でした。"
-                        f"ファイル出力などの処理を行いましたか？何を実行したか教えてください。"
-                    )
-                    
-                    # エラー報告用のコマンドを構築（セッションを維持）
-                    error_cmd = session_manager.build_claude_command(
-                        cmd[0] if isinstance(cmd[0], str) else cmd[:3],  # WSLコマンドを考慮
-                        error_prompt,
-                        include_resume=True  # セッションを維持
-                    )
-                    
-                    # Claude CLIに問題を報告
-                    error_result = await _execute_claude_command(error_cmd, retry_count + 1)
-                    
-                    # 元のエラー情報と組み合わせて返す
-                    return {
-                        "success": True,  # エラー報告は成功
-                        "response": f"[実行は完了しましたが、結果が空でした。Claudeからの説明:]\n{error_result.get('response', 'エラー報告も失敗しました')}",
-                        "execution_time": execution_time + error_result.get('execution_time', 0),
-                        "warning": f"Empty result with {output_tokens} tokens generated",
-                        "error": None
-                    }
-                
-                return {
-                    "success": not is_execution_error,
-                    "response": result_str,
-                    "execution_time": execution_time,
-                    "warning": warning,
-                    "error": "Claude CLI execution error" if is_execution_error else None
-                }
+        else:
+            # 出力を処理（_execute_claude_commandと共通）
+            result = await _handle_claude_output(stdout, execution_time, retry_count, None, session)
                 
-            except json.JSONDecodeError:
-                # JSONパースに失敗した場合は生の出力を返す
-                pass
-        
-        # JSON形式でない場合は生の出力を返す
-        return {
-            "success": True,
-            "response": output,
-            "execution_time": execution_time
+    except ClaudeSchedulerFullError as e:
+        result = {
+            "success": False,
+            "error": str(e),
+            "execution_time": 0
         }
-            
-    except subprocess.TimeoutExpired:
-        return {
+    except asyncio.TimeoutError:
+        result = {
             "success": False,
-            "error": f"Timeout after {DEFAULT_TIMEOUT} seconds",
-            "execution_time": DEFAULT_TIMEOUT
+            "error": f"Timeout after {timeout} seconds",
+            "execution_time": timeout
         }
     except Exception as e:
-        return {
+        result = {
             "success": False,
             "error": f"Unexpected error: {str(e)}",
             "execution_time": time.time() - start_time
         }
+    
+    return result
 
 
-@mcp.tool()
-async def execute_claude(prompt: str) -> Dict:
-    """Claude CLIを実行して結果を返す
+async def _execute_map_reduce(claude_cmd: Union[str, List[str]], prompt: str, chunks: List[ContextFile], session: ClaudeSession, timeout: float = DEFAULT_TIMEOUT) -> Dict:
+    """チャンクごとに並行して問い合わせ（map）、部分ごとの回答を統合する（reduce）
+    
+    mapは会話を再開しない使い捨てのセッションで実行し、失敗したチャンクのみ
+    MAP_RETRIES回まで再実行する。reduceは指定されたセッションで実行するため、
+    統合後の回答が会話の続きになる。
     
     Args:
+        claude_cmd: Claude実行コマンド（文字列またはリスト）
         prompt: Claudeに送るプロンプト
-        timeout: タイムアウト時間（秒）
+        chunks: 分割したコンテキストファイル
+        session: reduceを実行するセッション
+        timeout: 各CLI呼び出しのタイムアウト時間（秒）
         
     Returns:
-        実行結果を含む辞書
+        実行結果を含む辞書（チャンクごとの結果をchunksに含む）
     """
-    # Claude実行コマンドを取得
-    try:
-        claude_cmd = await session_manager.get_claude_command()
-    except FileNotFoundError as e:
+    start_time = time.time()
+    total = len(chunks)
+    semaphore = asyncio.Semaphore(max(1, MAP_CONCURRENCY))
+    reports = [
+        {
+            "index": index,
+            "offset": chunk.segments[0][0],
+            "bytes": chunk.sent_bytes,
+            "success": False,
+            "attempts": 0,
+            "execution_time": 0,
+            "error": None
+        }
+        for index, chunk in enumerate(chunks)
+    ]
+    responses: List[Optional[str]] = [None] * total
+    
+    async def run_chunk(index: int):
+        chunk = chunks[index]
+        offset, length = chunk.segments[0]
+        chunk_prompt = (
+            f"{prompt}\n\n"
+            f"（注意: 標準入力のファイルは大きいため{total}個に分割されています。"
+            f"これは{index + 1}番目の部分（{offset}〜{offset + length}バイト目）です。"
+            f"この部分の内容だけに基づいて回答してください。）"
+        )
+        async with semaphore:
+            # 空の応答はチャンクの再実行で扱うため、Claudeへの問い合わせは行わない
+            result = await _execute_claude_with_input(claude_cmd, chunk_prompt, chunk, _throwaway_session(session.name), priority="batch", timeout=timeout, retry_count=1)
+        report = reports[index]
+        report["attempts"] += 1
+        report["execution_time"] = result["execution_time"]
+        if result["success"] and result.get("response"):
+            report["success"] = True
+            report["error"] = None
+            responses[index] = result["response"]
+        else:
+            report["error"] = result.get("error") or "Empty response"
+    
+    # map: 失敗したチャンクのみ再実行する
+    pending = list(range(total))
+    for attempt in range(max(0, MAP_RETRIES) + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            logger.info("Retrying %d failed chunk(s) (attempt %d)", len(pending), attempt + 1)
+        await asyncio.gather(*(run_chunk(index) for index in pending))
+        pending = [index for index in pending if not reports[index]["success"]]
+    
+    if pending:
         return {
-            "tool_name": "execute_claude_with_context",
+            "success": False,
+            "error": f"{len(pending)} of {total} chunks failed",
+            "execution_time": time.time() - start_time,
+            "chunks": reports
+        }
+    
+    # reduce: 部分ごとの回答を標準入力に渡して統合する
+    partials = "".join(
+        f"===== 部分 {index + 1}/{total} =====\n{response}\n\n" for index, response in enumerate(responses)
+    )
+    reduce_prompt = (
+        f"{prompt}\n\n"
+        f"（注意: ファイルが大きいため{total}個に分割し、部分ごとに回答を得ました。"
+        f"標準入力の部分ごとの回答を統合して、元の質問に対する1つの最終回答を作成してください。）"
+    )
+    result = await _execute_claude_with_input(claude_cmd, reduce_prompt, partials.encode('utf-8'), session, timeout=timeout)
+    result["execution_time"] = time.time() - start_time
+    result["chunks"] = reports
+    return result
+
+
+@mcp.tool()
+async def execute_claude_with_files(
+    prompt: str,
+    file_paths: List[str],
+    session: Optional[str] = None,
+    cache: Optional[str] = None,
+    max_bytes: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    timeout: Optional[float] = None,
+    ctx: Context = None
+) -> Dict:
+    """複数ファイルのコンテキスト付きでClaude CLIを1回実行
+    
+    ファイルを並行して読み込み、ファイルごとの見出しを付けて1つのコンテキストにまとめます。
+    例: 複数のソースファイルをまとめてレビューしてもらう等
+    
+    Args:
+        prompt: Claudeに送るプロンプト（例: "これらのファイルの変更点をレビューして"）
+        file_paths: ファイルのパスまたはglobパターンのリスト（例: ["src/*.py", "README.md"]）
+        session: セッション名（省略時は"default"）
+        cache: 応答キャッシュのスコープ（省略時はキャッシュしない、指定方法はexecute_claude_with_contextと同じ）
+        max_bytes: コンテキスト全体の最大サイズ（バイト、省略時はCLAUDE_MCP_CONTEXT_MAX_BYTES）
+        max_tokens: コンテキスト全体の最大トークン数（1トークン=4バイトで概算、max_bytesと併用時は小さい方）
+        timeout: タイムアウト時間（秒、省略時は300秒）
+        ctx: MCPリクエストコンテキスト（自動で渡される。リクエストIDでcancel_executionから中止できる）
+        
+    Returns:
+        実行結果を含む辞書（含めたファイルはcontext_files、除外したファイルと理由はskipped_files）
+    """
+    def error_result(error: str) -> Dict:
+        return {
+            "tool_name": "execute_claude_with_files",
             "success": False,
             "prompt": prompt,
             "response": None,
             "execution_time": 0,
             "timestamp": datetime.now().isoformat(),
-            "error": str(e)
+            "error": error
         }
     
-    # コマンドを構築（共通関数を使用）
-    cmd = session_manager.build_claude_command(claude_cmd, prompt)
+    if cache is not None and cache not in CACHE_SCOPES:
+        return error_result(f"Invalid cache scope: {cache} (expected one of {', '.join(CACHE_SCOPES)})")
+    if not file_paths:
+        return error_result("No file paths specified")
+    if timeout is not None and timeout <= 0:
+        return error_result(f"Invalid timeout: {timeout} (must be positive)")
     
-    # コマンド実行
-    result = await _execute_claude_command(cmd)
+    budget = max_bytes if max_bytes is not None else CONTEXT_MAX_BYTES
+    if max_tokens is not None:
+        budget = min(budget, max_tokens * CONTEXT_BYTES_PER_TOKEN)
+    if budget <= 0:
+        return error_result(f"Invalid budget: {budget} bytes (max_bytes and max_tokens must be positive)")
+    
+    loop = asyncio.get_event_loop()
+    paths, skipped = await loop.run_in_executor(None, _expand_context_paths, file_paths)
+    
+    # 単独でも予算に収まらないファイルは読み込まずに除外する（サイズはstatで確認）
+    candidates = []
+    for path, size in paths:
+        if len(_context_file_header(path, size)) + size + 1 > budget:
+            skipped.append({"path": path, "reason": f"Exceeds budget ({size} bytes, {budget} bytes total)"})
+            continue
+        candidates.append((path, size))
+    
+    # 内容が同じファイルを先に除いてから予算を割り当てる（重複が予算を消費しないように）。
+    # 重複しうるのはサイズが同じファイルだけなので、それらのみ内容を保持せずにハッシュを計算する
+    size_counts: Dict[int, int] = {}
+    for _, size in candidates:
+        size_counts[size] = size_counts.get(size, 0) + 1
+    hash_targets = [path for path, size in candidates if size_counts[size] > 1]
+    digests = dict(zip(hash_targets, await asyncio.gather(
+        *(loop.run_in_executor(None, _hash_context_file, path) for path in hash_targets),
+        return_exceptions=True
+    )))
+    
+    # 入力順に予算内に収まるファイルを選ぶ（サイズはstatの値）
+    selected = []
+    seen = {}
+    remaining = budget
+    for path, size in candidates:
+        digest = digests.get(path)
+        if isinstance(digest, Exception):
+            skipped.append({"path": path, "reason": str(digest)})
+            continue
+        if digest is not None:
+            if (size, digest) in seen:
+                skipped.append({"path": path, "reason": f"Duplicate of {seen[(size, digest)]}"})
+                continue
+            seen[(size, digest)] = path
+        needed = len(_context_file_header(path, size)) + size + 1
+        if needed > remaining:
+            skipped.append({"path": path, "reason": f"Exceeds budget ({size} bytes, {remaining} bytes remaining)"})
+            continue
+        selected.append(path)
+        remaining -= needed
+    
+    # 選んだファイルだけを並行して読み込む
+    contents = await asyncio.gather(
+        *(loop.run_in_executor(None, _read_context_bytes, path) for path in selected),
+        return_exceptions=True
+    )
+    
+    parts = []
+    included = []
+    for path, content in zip(selected, contents):
+        if isinstance(content, Exception):
+            skipped.append({"path": path, "reason": str(content)})
+            continue
+        parts.append(_context_file_header(path, len(content)))
+        parts.append(content)
+        parts.append(b"\n")
+        included.append(path)
+    
+    if not included:
+        result = error_result("No files to send")
+        result["skipped_files"] = skipped
+        return result
+    
+    payload = b"".join(parts)
+    
+    # Claude実行コマンドを取得
+    try:
+        claude_cmd = await session_manager.get_claude_command()
+    except FileNotFoundError as e:
+        return error_result(str(e))
+    
+    claude_session = session_manager.get_session(session)
+    content_hash = hashlib.sha256(payload).hexdigest() if cache is not None else None
+    
+    async def run(target_session: ClaudeSession) -> Dict:
+        return await _execute_claude_with_input(claude_cmd, prompt, payload, target_session, timeout=timeout if timeout is not None else DEFAULT_TIMEOUT)
+    
+    execution_id = _execution_id(ctx)
+    try:
+        result, target_session = await _run_cancellable(
+            execution_id, "execute_claude_with_files", claude_session.name, prompt,
+            _execute_with_cache(cache, prompt, content_hash, claude_session, run)
+        )
+    except ClaudeExecutionCancelled as e:
+        result, target_session = {"success": False, "error": str(e), "execution_time": e.execution_time}, claude_session
     
-    # 完全な返り値を構築
     full_result = {
-        "tool_name": "execute_claude",
+        "tool_name": "execute_claude_with_files",
         "success": result["success"],
         "prompt": prompt,
         "response": result.get("response"),
         "execution_time": result["execution_time"],
         "timestamp": datetime.now().isoformat(),
-        "error": result.get("error")
+        "error": result.get("error"),
+        "context_files": included,
+        "skipped_files": skipped,
+        "context_bytes": len(payload),
+        "session": claude_session.name,
+        "session_id": target_session.before_session_id,
+        "execution_id": execution_id
+    }
+    if cache is not None:
+        full_result["cached"] = result.get("cached", False)
+    
+    # 履歴に追加
+    session_manager._add_history(full_result)
+    
+    return full_result
+
+
+def _expand_context_paths(patterns: List[str]) -> Tuple[List[Tuple[str, int]], List[Dict]]:
+    """パスとglobパターンを展開し、重複を除いた (パス, サイズ) のリストを返す（ブロッキング処理）
+    
+    Args:
+        patterns: ファイルのパスまたはglobパターンのリスト
+        
+    Returns:
+        (入力順の (パス, サイズ) のリスト, 除外したファイルと理由のリスト) のタプル
+    """
+    paths = []
+    skipped = []
+    seen = set()
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                skipped.append({"path": pattern, "reason": "No files matched"})
+        else:
+            matches = [pattern]
+        for path in matches:
+            real_path = os.path.realpath(path)
+            if real_path in seen:
+                continue
+            seen.add(real_path)
+            if not os.path.exists(path):
+                skipped.append({"path": path, "reason": "File not found"})
+            elif not os.path.isfile(path):
+                skipped.append({"path": path, "reason": "Not a file"})
+            else:
+                paths.append((path, os.path.getsize(path)))
+    return paths, skipped
+
+
+def _context_file_header(path: str, size: int) -> bytes:
+    """まとめたコンテキスト内で各ファイルの先頭に付ける見出し"""
+    return f"===== File: {path} ({size} bytes) =====\n".encode('utf-8')
+
+
+def _hash_context_file(path: str) -> str:
+    """ファイルの内容のSHA-256を、全体をメモリに読み込まずに計算する（ブロッキング処理）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CONTEXT_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_context_bytes(path: str) -> bytes:
+    """ファイルをバイト列として読み込む（ブロッキング処理、バイナリファイルはValueError）"""
+    with open(path, 'rb') as f:
+        content = f.read()
+    if b"\0" in content[:ContextFile._BINARY_SNIFF_BYTES]:
+        raise ValueError("Binary file is not supported")
+    return content
+
+
+@mcp.tool()
+async def submit_claude_job(
+    prompt: str,
+    file_path: Optional[str] = None,
+    session: Optional[str] = None,
+    cache: Optional[str] = None,
+    truncate: Optional[str] = None,
+    map_reduce: bool = False,
+    timeout: Optional[float] = None
+) -> Dict:
+    """Claude CLIの実行をバックグラウンドジョブとして投入し、すぐにジョブIDを返す
+    
+    MCPクライアントのリクエストタイムアウトより長くかかる呼び出しに使います。
+    file_pathを指定した場合はexecute_claude_with_context、それ以外はexecute_claudeとして実行し、
+    結果はget_job_status / get_job_resultで取得します（完了した結果は再接続後も取得可能）。
+    cancel_executionにジョブIDを指定すると中止できます。
+    
+    Args:
+        prompt: Claudeに送るプロンプト
+        file_path: コンテキストとして使用するファイルのパス（省略時はファイルなし）
+        session: セッション名（省略時は"default"）
+        cache: 応答キャッシュのスコープ（"stateless"または"session"、省略時は使用しない）
+        truncate: file_path指定時、上限を超えた場合の切り詰め方法（"head" / "tail" / "head_tail"）
+        map_reduce: file_path指定時、ファイルを分割して並行に問い合わせ、回答を統合する
+        timeout: タイムアウト時間（秒、省略時は300秒）
+        
+    Returns:
+        ジョブIDを含む辞書
+    """
+    job_id = uuid.uuid4().hex
+    tool_name = "execute_claude" if file_path is None else "execute_claude_with_context"
+    job = {
+        "job_id": job_id,
+        "tool_name": tool_name,
+        "status": "running",
+        "pid": os.getpid(),
+        "session": session or DEFAULT_SESSION_NAME,
+        "prompt": prompt,
+        "file_path": file_path,
+        "submitted": time.time(),
+        "submitted_at": datetime.now().isoformat(),
+        "finished": None,
+        "finished_at": None,
+        "result": None,
+        "client": _client_scope()
+    }
+    
+    async def run_job():
+        # このタスク内の実行IDをジョブIDにする（タスクごとにコンテキストがコピーされるため戻す必要はない）
+        _job_execution_id.set(job_id)
+        try:
+            if file_path is None:
+                result = await execute_claude(prompt, session=session, cache=cache, timeout=timeout)
+            else:
+                result = await execute_claude_with_context(
+                    prompt, file_path, session=session, cache=cache,
+                    truncate=truncate, map_reduce=map_reduce, timeout=timeout
+                )
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            result = {
+                "tool_name": tool_name,
+                "success": False,
+                "prompt": prompt,
+                "response": None,
+                "execution_time": time.time() - job["submitted"],
+                "timestamp": datetime.now().isoformat(),
+                "error": f"Job failed: {e}"
+            }
+        job.update({
+            "status": "succeeded" if result["success"] else "failed",
+            "finished": time.time(),
+            "finished_at": datetime.now().isoformat(),
+            "result": result
+        })
+        session_manager.job_store.put(job)
+        session_manager.jobs.pop(job_id, None)
+    
+    session_manager.job_store.put(job)
+    job["task"] = asyncio.ensure_future(run_job())
+    session_manager.jobs[job_id] = job
+    logger.info("Submitted job %s (%s)", job_id, tool_name)
+    
+    return {
+        "tool_name": "submit_claude_job",
+        "success": True,
+        "job_id": job_id,
+        "status": "running",
+        "submitted_at": job["submitted_at"],
+        "error": None
+    }
+
+
+def _pid_alive(pid: Optional[int]) -> Optional[bool]:
+    """プロセスが存在するか（確認できない場合はNone）"""
+    if pid is None:
+        return False
+    if platform.system() == "Windows":
+        return _pid_alive_windows(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _pid_alive_windows(pid: int) -> Optional[bool]:
+    """Windowsでプロセスが存在するか（OpenProcessとGetExitCodeProcessで確認、確認できない場合はNone）"""
+    try:
+        import ctypes
+        from ctypes import wintypes
+    except ImportError:
+        return None
+    PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+    STILL_ACTIVE = 259
+    ERROR_ACCESS_DENIED = 5
+    ERROR_INVALID_PARAMETER = 87  # 該当するプロセスがない
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    kernel32.GetExitCodeProcess.argtypes = (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+    handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        error = ctypes.get_last_error()
+        if error == ERROR_INVALID_PARAMETER:
+            return False
+        if error == ERROR_ACCESS_DENIED:
+            return True
+        return None
+    try:
+        exit_code = wintypes.DWORD()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+            return None
+        return exit_code.value == STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+async def _find_job(job_id: str) -> Optional[Dict]:
+    """実行中または保存済みのジョブを取得する
+    
+    実行中として保存されたまま実行していたプロセスが終了している場合（サーバーの再起動など）は
+    "interrupted"として保存し直す。別のプロセスが実行中の場合、結果はそのプロセスが書き込む。
+    http・sseでは他のクライアントが投入したジョブは見つからないものとして扱う。
+    """
+    scope = _client_scope()
+    job = session_manager.jobs.get(job_id)
+    if job is None:
+        job = await session_manager.job_store.get(job_id)
+    if job is None or (scope is not None and job.get("client") != scope):
+        return None
+    if job_id in session_manager.jobs:
+        return job
+    # 生存を確認できない場合は状態を変えない（実行中のジョブを中断扱いにしない）
+    if job is not None and job["status"] == "running" and job["pid"] != os.getpid() and _pid_alive(job["pid"]) is False:
+        job.update({
+            "status": "interrupted",
+            "finished": time.time(),
+            "finished_at": datetime.now().isoformat(),
+            "result": None
+        })
+        session_manager.job_store.put(job)
+    return job
+
+
+def _job_summary(job: Dict) -> Dict:
+    """ジョブの状態（結果の本文を除く）"""
+    result = job.get("result") or {}
+    finished = job.get("finished")
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "tool_name": job["tool_name"],
+        "session": job["session"],
+        "prompt": _truncate(job["prompt"], 100),
+        "submitted_at": job["submitted_at"],
+        "finished_at": job.get("finished_at"),
+        "elapsed": (finished if finished is not None else time.time()) - job["submitted"],
+        "error": result.get("error") if job["status"] != "interrupted" else "Interrupted by server shutdown"
+    }
+
+
+@mcp.tool()
+async def get_job_status(job_id: Optional[str] = None, limit: int = 20) -> Dict:
+    """バックグラウンドジョブの状態を取得
+    
+    Args:
+        job_id: ジョブID（省略時は新しい順にジョブの一覧を返す）
+        limit: 一覧の最大件数
+        
+    Returns:
+        ジョブの状態（job、一覧の場合はjobs）を含む辞書。statusはrunning / succeeded / failed / interrupted
+    """
+    if job_id is None:
+        # http・sseでは自分のクライアントが投入したジョブのみ返す
+        jobs = {job["job_id"]: job for job in await session_manager.job_store.list(limit, _client_scope())}
+        # このプロセスで実行中のジョブはメモリ上の状態を優先する
+        for running_id, job in session_manager.jobs.items():
+            if running_id in jobs:
+                jobs[running_id] = job
+        return {
+            "tool_name": "get_job_status",
+            "success": True,
+            "jobs": [_job_summary(job) for job in sorted(jobs.values(), key=lambda job: job["submitted"], reverse=True)],
+            "error": None
+        }
+    
+    job = await _find_job(job_id)
+    if job is None:
+        return {
+            "tool_name": "get_job_status",
+            "success": False,
+            "job_id": job_id,
+            "error": f"Job not found: {job_id}"
+        }
+    return {
+        "tool_name": "get_job_status",
+        "success": True,
+        "job": _job_summary(job),
+        "error": None
     }
+
+
+@mcp.tool()
+async def get_job_result(job_id: str, wait: Optional[float] = None) -> Dict:
+    """バックグラウンドジョブの結果を取得
+    
+    Args:
+        job_id: ジョブID
+        wait: 実行中の場合に完了を待つ最大時間（秒、省略時は待たない）
+        
+    Returns:
+        ジョブの状態と、完了している場合は実行ツールの返り値（result）を含む辞書
+    """
+    job = await _find_job(job_id)
+    if job is not None and job["status"] == "running" and wait and "task" in job:
+        # 待ち時間が過ぎてもジョブは中止しない
+        await asyncio.wait({job["task"]}, timeout=wait)
+        job = await _find_job(job_id)
     
-    # 履歴に追加
-    session_manager._add_history(full_result)
+    if job is None:
+        return {
+            "tool_name": "get_job_result",
+            "success": False,
+            "job_id": job_id,
+            "status": None,
+            "result": None,
+            "error": f"Job not found: {job_id}"
+        }
     
-    return full_result
+    error = None
+    if job["status"] == "running":
+        error = "Job is still running"
+    elif job["status"] == "interrupted":
+        error = "Interrupted by server shutdown"
+    elif not job["result"]["success"]:
+        error = job["result"].get("error")
+    return {
+        "tool_name": "get_job_result",
+        "success": job["status"] == "succeeded",
+        "job_id": job_id,
+        "status": job["status"],
+        "result": job.get("result"),
+        "error": error
+    }
 
 
 @mcp.tool()
-async def execute_claude_with_context(prompt: str, file_path: str) -> Dict:
-    """ファイルコンテキスト付きでClaude CLIを実行
+async def get_execution_history(
+    limit: int = 10,
+    cursor: Optional[int] = None,
+    session: Optional[str] = None,
+    session_id: Optional[str] = None,
+    tool_name: Optional[str] = None,
+    success: Optional[bool] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None
+) -> Dict:
+    """実行履歴を取得
     
-    ファイルの内容を読み込んで、その内容についてClaudeに質問できます。
-    例: README.mdについて質問する、コードファイルの説明を求める等
+    履歴はディスクに永続化されており、サーバー再起動後も参照できます。
+    続きを取得する場合は、返されたnext_cursorをcursorに指定してください。
     
     Args:
-        prompt: Claudeに送るプロンプト（例: "このファイルの目的を説明して"）
-        file_path: コンテキストとして使用するファイルのパス（例: "README.md"）
+        limit: 取得する履歴数（デフォルト: 10、0以下または上限を超える場合は1000件）
+        cursor: 前回のnext_cursor（これより古い履歴を取得）
+        session: セッション名で絞り込み
+        session_id: Claude CLIのセッションIDで絞り込み
+        tool_name: ツール名で絞り込み
+        success: 成功/失敗で絞り込み
+        since: この時刻（ISO形式）以降の履歴のみ
+        until: この時刻（ISO形式）より前の履歴のみ
         
     Returns:
-        実行結果を含む辞書
+        履歴情報を含む辞書
     """
-    # ファイルの存在確認
-    if not os.path.exists(file_path):
-        return {
-            "tool_name": "execute_claude_with_context",
-            "success": False,
-            "prompt": prompt,
-            "response": None,
-            "execution_time": 0,
-            "timestamp": datetime.now().isoformat(),
-            "error": f"File not found: {file_path}"
-        }
-    
-    # ファイル内容を読み込む
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            file_content = f.read()
-    except Exception as e:
+        # http・sseでは自分のクライアントの履歴のみ返す
+        page = await session_manager.history.query(
+            limit if 0 < limit <= HISTORY_MAX_LIMIT else HISTORY_MAX_LIMIT,
+            cursor,
+            session=session,
+            session_id=session_id,
+            tool_name=tool_name,
+            success=success,
+            since=since,
+            until=until,
+            client=_client_scope()
+        )
+    except sqlite3.Error as e:
         return {
-            "tool_name": "execute_claude_with_context",
+            "tool_name": "get_execution_history",
             "success": False,
-            "prompt": prompt,
-            "response": None,
-            "execution_time": 0,
-            "timestamp": datetime.now().isoformat(),
-            "error": f"Failed to read file: {str(e)}"
+            "error": f"Failed to read history: {str(e)}"
         }
     
-    # Claude実行コマンドを取得
+    return {
+        "tool_name": "get_execution_history",
+        "success": True,
+        "history": page["entries"],
+        "total_entries": page["total"],
+        "next_cursor": page["next_cursor"],
+        "current_session_id": session_manager.get_session(session).before_session_id
+    }
+
+
+@mcp.tool()
+async def clear_execution_history() -> Dict:
+    """実行履歴をクリア（http・sseでは自分のクライアントの履歴のみ）
+    
+    Returns:
+        操作結果を含む辞書
+    """
     try:
-        claude_cmd = await session_manager.get_claude_command()
-    except FileNotFoundError as e:
+        cleared_count = await session_manager.history.clear(_client_scope())
+    except sqlite3.Error as e:
         return {
-            "tool_name": "execute_claude_with_context",
+            "tool_name": "clear_execution_history",
             "success": False,
-            "prompt": prompt,
-            "response": None,
-            "execution_time": 0,
-            "timestamp": datetime.now().isoformat(),
-            "error": str(e)
+            "error": f"Failed to clear history: {str(e)}"
         }
     
-    # コマンドを構築（共通関数を使用）
-    cmd = session_manager.build_claude_command(claude_cmd, prompt)
+    return {
+        "tool_name": "clear_execution_history",
+        "success": True,
+        "message": f"Cleared {cleared_count} history entries",
+        "cleared_count": cleared_count
+    }
+
+
+@mcp.tool()
+async def get_cache_stats() -> Dict:
+    """応答キャッシュの統計情報を取得
     
-    # コマンド実行（ファイル内容を標準入力として渡す）
-    start_time = time.time()
+    Returns:
+        ヒット数・ミス数・エントリ数などを含む辞書
+    """
+    return {
+        "tool_name": "get_cache_stats",
+        "success": True,
+        "stats": await session_manager.response_cache.get_stats()
+    }
+
+
+@mcp.tool()
+async def get_metrics(format: str = "json") -> Dict:
+    """性能メトリクスを取得
     
-    # 全環境で同期実行を使用（MCPは1対1通信のため非同期の必要なし）
-    try:
-        # エンコーディング設定
-        if platform.system() == "Windows":
-            encoding_kwargs = {'encoding': 'utf-8', 'errors': 'replace'}
-        else:
-            encoding_kwargs = {'encoding': 'utf-8'}
-        
-        proc = subprocess.Popen(
-            cmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            **encoding_kwargs
-        )
-        
-        stdout, stderr = proc.communicate(input=file_content, timeout=DEFAULT_TIMEOUT)
-        
-        execution_time = time.time() - start_time
+    ツールごとのレイテンシ（p50/p95/p99）・エラー率・タイムアウト率・空の応答の割合、
+    CLI実行時間の内訳（起動などのオーバーヘッド / CLI内の処理 / API）、トークン数、
+    応答キャッシュとスケジューラの統計を返します。
+    
+    Args:
+        format: "json"（辞書で返す）または"prometheus"（Prometheusのテキスト形式をtextに入れて返す）
         
-        if proc.returncode != 0:
-            error_msg = stderr if stderr else "Unknown error"
-            result = {
-                "success": False,
-                "error": f"Command failed with code {proc.returncode}: {error_msg}",
-                "execution_time": execution_time
-            }
-        else:
-            # 出力を処理（JSONではない場合もある）
-            output = stdout.strip()
-            
-            # デバッグ: 生の出力をログに記録（最初の500文字のみ）
-            debug_log_path = os.path.join(os.path.dirname(__file__), '..', 'claude_command_debug.log')
-            with open(debug_log_path, 'a', encoding='utf-8') as f:
-                f.write(f"[{datetime.now().isoformat()}] execute_claude_with_context Raw output (first 500 chars): {output[:500]}\n")
-            
-            # JSON形式かチェック
-            if output.startswith('{'):
-                try:
-                    response_json = json.loads(output)
-                    
-                    # デバッグ: JSONの構造をログに記録
-                    with open(debug_log_path, 'a', encoding='utf-8') as f:
-                        f.write(f"[{datetime.now().isoformat()}] execute_claude_with_context JSON keys: {list(response_json.keys())}\n")
-                        if "result" in response_json:
-                            f.write(f"[{datetime.now().isoformat()}] execute_claude_with_context Result field: '{response_json['result']}'\n")
-                    
-                    # session_idがあれば保存
-                    if "session_id" in response_json:
-                        old_session_id = session_manager.before_session_id
-                        session_manager.before_session_id = response_json["session_id"]
-                        with open(debug_log_path, 'a', encoding='utf-8') as f:
-                            f.write(f"[{datetime.now().isoformat()}] Session updated: {old_session_id} -> {response_json['session_id']}\n")
-                    
-                    # resultフィールドの内容を確認
-                    result_content = response_json.get("result", "")
-                    
-                    # 空の応答の場合は警告をログに記録
-                    if not result_content:
-                        with open(debug_log_path, 'a', encoding='utf-8') as f:
-                            f.write(f"[{datetime.now().isoformat()}] WARNING: execute_claude_with_context - Empty result field detected. Full JSON: {json.dumps(response_json)}\n")
-                    
-                    result = {
-                        "success": True,
-                        "response": result_content,
-                        "execution_time": execution_time
-                    }
-                    
-                except json.JSONDecodeError:
-                    # JSONパースに失敗した場合は生の出力を返す
-                    result = {
-                        "success": True,
-                        "response": output,
-                        "execution_time": execution_time
-                    }
-            else:
-                # JSON形式でない場合は生の出力を返す
-                result = {
-                    "success": True,
-                    "response": output,
-                    "execution_time": execution_time
-                }
-                
-    except subprocess.TimeoutExpired:
-        result = {
-            "success": False,
-            "error": f"Timeout after {DEFAULT_TIMEOUT} seconds",
-            "execution_time": DEFAULT_TIMEOUT
-        }
-    except Exception as e:
-        result = {
+    Returns:
+        メトリクスを含む辞書
+    """
+    if format not in ("json", "prometheus"):
+        return {
+            "tool_name": "get_metrics",
             "success": False,
-            "error": f"Unexpected error: {str(e)}",
-            "execution_time": time.time() - start_time
+            "error": f"Invalid format: {format} (expected json or prometheus)"
         }
     
-    # 完全な返り値を構築
-    full_result = {
-        "tool_name": "execute_claude_with_context",
-        "success": result["success"],
-        "prompt": prompt,
-        "response": result.get("response"),
-        "execution_time": result["execution_time"],
-        "timestamp": datetime.now().isoformat(),
-        "error": result.get("error"),
-        "context_file": file_path
+    metrics = session_manager.metrics
+    cache_stats = await session_manager.response_cache.get_stats()
+    queue_stats = session_manager.scheduler.get_stats()
+    if format == "prometheus":
+        return {
+            "tool_name": "get_metrics",
+            "success": True,
+            "text": metrics.render_prometheus(cache_stats, queue_stats)
+        }
+    return {
+        "tool_name": "get_metrics",
+        "success": True,
+        "metrics": dict(metrics.snapshot(), cache=cache_stats, queue=queue_stats)
     }
+
+
+@mcp.tool()
+async def get_queue_stats() -> Dict:
+    """スケジューラの状態を取得
     
-    # 履歴に追加
-    session_manager._add_history(full_result)
+    実行中・待機中のClaude CLI呼び出し数、優先度ごとの待機数、待ち時間の統計を返します。
     
-    return full_result
+    Returns:
+        スケジューラの統計情報を含む辞書
+    """
+    return {
+        "tool_name": "get_queue_stats",
+        "success": True,
+        "stats": session_manager.scheduler.get_stats()
+    }
 
 
 @mcp.tool()
-async def get_execution_history(limit: int = 10) -> Dict:
-    """実行履歴を取得
+async def cancel_execution(request_id: Optional[str] = None) -> Dict:
+    """実行中のClaude CLI呼び出しを中止
+    
+    中止した呼び出しのCLIプロセスは子プロセスも含めて終了し、呼び出し元には
+    "Cancelled by cancel_execution"のエラーが返ります。
+    request_idを省略した場合は、実行中の呼び出しの一覧を返します。
     
     Args:
-        limit: 取得する履歴数（デフォルト: 10）
+        request_id: 中止する呼び出しのMCPリクエストID（execute_claude_batchの場合は全体、
+            または"<リクエストID>:<位置>"で項目ごと）
         
     Returns:
-        履歴情報を含む辞書
+        中止した実行IDと、実行中の呼び出しの一覧を含む辞書
     """
-    # 最新のlimit件を取得
-    history_slice = session_manager.history[-limit:] if limit > 0 else session_manager.history
+    # http・sseでは自分のクライアントの呼び出し（自分が投入したジョブを含む）のみ対象にする
+    scope = _client_scope()
+    
+    def in_flight() -> List[Dict]:
+        return [
+            {"request_id": execution_id, **{k: v for k, v in info.items() if k not in ("task", "client")}}
+            for execution_id, info in session_manager.executions.items()
+            if info["client"] == scope
+        ]
+    
+    if request_id is None:
+        return {
+            "tool_name": "cancel_execution",
+            "success": True,
+            "cancelled": [],
+            "in_flight": in_flight()
+        }
+    
+    targets = {request_id, _scoped_request_id(request_id)}
+    if request_id.startswith("compact:"):
+        targets.add(_compact_execution_id(request_id[len("compact:"):]))
+    cancelled = []
+    for execution_id, info in list(session_manager.executions.items()):
+        if info["client"] != scope:
+            continue
+        if execution_id in targets or execution_id.partition(":")[0] in targets:
+            info["task"].cancel()
+            cancelled.append(execution_id)
+    
+    # キャンセルがCLIプロセスの終了まで伝わるのを待つ
+    tasks = [info["task"] for execution_id, info in session_manager.executions.items() if execution_id in cancelled]
+    if tasks:
+        await asyncio.wait(tasks)
     
     return {
-        "tool_name": "get_execution_history",
-        "success": True,
-        "history": history_slice,
-        "total_entries": len(session_manager.history),
-        "current_session_id": session_manager.before_session_id
+        "tool_name": "cancel_execution",
+        "success": bool(cancelled),
+        "cancelled": cancelled,
+        "in_flight": in_flight(),
+        "error": None if cancelled else f"No running execution: {request_id}"
     }
 
 
 @mcp.tool()
-async def clear_execution_history() -> Dict:
-    """実行履歴をクリア
+async def clear_response_cache() -> Dict:
+    """応答キャッシュをクリア
     
     Returns:
         操作結果を含む辞書
     """
-    cleared_count = len(session_manager.history)
-    session_manager.history = []
+    try:
+        cleared_count = await session_manager.response_cache.clear()
+    except sqlite3.Error as e:
+        return {
+            "tool_name": "clear_response_cache",
+            "success": False,
+            "error": f"Failed to clear cache: {str(e)}"
+        }
     
     return {
-        "tool_name": "clear_execution_history",
+        "tool_name": "clear_response_cache",
         "success": True,
-        "message": f"Cleared {cleared_count} history entries",
+        "message": f"Cleared {cleared_count} cache entries",
         "cleared_count": cleared_count
     }
 
 
 @mcp.tool()
-async def get_current_session() -> Dict:
+async def get_current_session(session: Optional[str] = None) -> Dict:
     """現在のセッションIDを取得
     
+    Args:
+        session: セッション名（省略時は"default"）
+        
     Returns:
         セッション情報を含む辞書
     """
+    claude_session = session_manager.get_session(session)
+    await session_manager.refresh(claude_session)
     return {
         "tool_name": "get_current_session",
         "success": True,
-        "session_id": session_manager.before_session_id,
-        "has_session": session_manager.before_session_id is not None
+        "session": claude_session.name,
+        "session_id": claude_session.before_session_id,
+        "has_session": claude_session.before_session_id is not None,
+        "usage": claude_session.usage_summary(),
+        "sessions": sorted(session_manager.sessions.keys())
     }
 
 
@@ -703,29 +4909,16 @@ async def test_claude_cli() -> Dict:
         # コマンドを構築（--versionオプションで簡単なテスト）
         cmd = session_manager.build_claude_version_command(claude_cmd)
         
-        # 全環境で同期実行を使用（MCPは1対1通信のため非同期の必要なし）
+        # 非同期サブプロセスとして実行（イベントループをブロックしない）
         try:
-            # エンコーディング設定
-            if platform.system() == "Windows":
-                encoding_kwargs = {'encoding': 'utf-8', 'errors': 'replace'}
-            else:
-                encoding_kwargs = {'encoding': 'utf-8'}
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=5,  # 短いタイムアウト
-                stdin=subprocess.DEVNULL,
-                **encoding_kwargs
-            )
+            returncode, stdout, stderr = await _run_subprocess(cmd, timeout=5)  # 短いタイムアウト
             
-            if result.returncode == 0:
+            if returncode == 0:
                 return {
                     "tool_name": "test_claude_cli",
                     "success": True,
                     "command": " ".join(cmd),
-                    "output": result.stdout.strip(),
+                    "output": _decode_output(stdout).strip(),
                     "message": "Claude CLI found and working!"
                 }
             else:
@@ -733,11 +4926,11 @@ async def test_claude_cli() -> Dict:
                     "tool_name": "test_claude_cli",
                     "success": False,
                     "command": " ".join(cmd),
-                    "error": result.stderr.strip() if result.stderr else "Command failed",
+                    "error": _decode_output(stderr).strip() if stderr else "Command failed",
                     "message": "Claude CLI found but not working properly"
                 }
                 
-        except subprocess.TimeoutExpired:
+        except asyncio.TimeoutError:
             return {
                 "tool_name": "test_claude_cli",
                 "success": False,
@@ -773,26 +4966,34 @@ async def test_claude_cli() -> Dict:
 
 
 @mcp.tool()
-async def reset_session() -> Dict:
+async def reset_session(session: Optional[str] = None) -> Dict:
     """セッションをリセット
     
+    Args:
+        session: セッション名（省略時は"default"）
+        
     Returns:
         操作結果を含む辞書
     """
-    old_session_id = session_manager.before_session_id
-    session_manager.before_session_id = None
-    session_manager.is_manually_set = False  # 手動設定フラグもリセット
+    claude_session = session_manager.get_session(session)
+    async with session_manager.update(claude_session):
+        old_session_id = claude_session.before_session_id
+        claude_session.before_session_id = None
+        claude_session.is_manually_set = False  # 手動設定フラグもリセット
+        claude_session.fork_on_resume = False
+        claude_session.reset_context_stats()
     
     return {
         "tool_name": "reset_session",
         "success": True,
         "message": "Session reset successfully",
+        "session": claude_session.name,
         "old_session_id": old_session_id
     }
 
 
 @mcp.tool()
-async def set_current_session(session_id: str) -> Dict:
+async def set_current_session(session_id: str, session: Optional[str] = None) -> Dict:
     """セッションIDを即座に設定（実行は一瞬で完了）
     
     単に内部変数を更新するだけの軽量な処理です。
@@ -800,24 +5001,28 @@ async def set_current_session(session_id: str) -> Dict:
     
     Args:
         session_id: 設定するセッションID（文字列）
+        session: セッション名（省略時は"default"）
         
     Returns:
         操作結果を含む辞書（即座に返される）
     """
+    claude_session = session_manager.get_session(session)
     try:
-        old_session_id = session_manager.before_session_id
-        session_manager.before_session_id = session_id
-        session_manager.is_manually_set = True  # 手動設定フラグを立てる
+        async with session_manager.update(claude_session):
+            old_session_id = claude_session.before_session_id
+            claude_session.before_session_id = session_id
+            claude_session.is_manually_set = True  # 手動設定フラグを立てる
+            claude_session.fork_on_resume = False
+            claude_session.reset_context_stats()
         
         # デバッグログに記録
-        debug_log_path = os.path.join(os.path.dirname(__file__), '..', 'claude_command_debug.log')
-        with open(debug_log_path, 'a', encoding='utf-8') as f:
-            f.write(f"[{datetime.now().isoformat()}] Session manually set: {old_session_id} -> {session_id} (manual flag ON)\n")
+        logger.info("Session manually set (%s): %s -> %s (manual flag ON)", claude_session.name, old_session_id, session_id)
         
         return {
             "tool_name": "set_current_session",
             "success": True,
             "message": f"Session ID set to: {session_id}",
+            "session": claude_session.name,
             "old_session_id": old_session_id,
             "new_session_id": session_id
         }
@@ -826,18 +5031,312 @@ async def set_current_session(session_id: str) -> Dict:
             "tool_name": "set_current_session",
             "success": False,
             "error": f"Failed to set session: {str(e)}",
-            "old_session_id": session_manager.before_session_id,
+            "old_session_id": claude_session.before_session_id,
             "new_session_id": None
         }
 
 
+def _compact_execution_id(session_name: str) -> str:
+    """圧縮の実行ID（http・sseでは同じセッション名でもクライアントごとに分ける）"""
+    return f"compact:{_scheduler_key(session_name)}"
+
+
+async def _compact_session(session: ClaudeSession, reason: str) -> Dict:
+    """セッションを圧縮して、以降のターンで読み込む会話を小さくする
+    
+    現在の会話から分岐して要約を作らせ、その要約で始めた新しいセッションに
+    before_session_idを切り替える（元の会話の記録は変更しない）。
+    途中で失敗した場合は元のセッションをそのまま使い続ける。
+    セッションのロック内で実行し、履歴には"compact_session"として記録する。
+    
+    Args:
+        session: 対象の名前付きセッション
+        reason: 圧縮する理由（履歴・ログ用）
+        
+    Returns:
+        圧縮の結果（success、old_session_id、session_id、error）を含む辞書
+    """
+    async def compact() -> Dict:
+        claude_cmd = await session_manager.get_claude_command()
+        # 元の会話から分岐して要約させる
+        source_session_id = session.before_session_id
+        branch = _throwaway_session(session.name)
+        branch.before_session_id = source_session_id
+        branch.fork_on_resume = True
+        cmd = session_manager.build_claude_command(claude_cmd, COMPACT_SUMMARY_PROMPT, session=branch)
+        result = await _execute_claude_command(cmd, session=branch, priority="batch")
+        if not result["success"] or not result.get("response"):
+            return {"success": False, "error": f"Summary failed: {result.get('error') or 'empty response'}", "execution_time": result["execution_time"]}
+        
+        # 要約を最初のプロンプトとして新しいセッションを始める
+        fresh = _throwaway_session(session.name)
+        cmd = session_manager.build_claude_command(claude_cmd, COMPACT_SEED_PROMPT.format(summary=result["response"]), session=fresh)
+        seeded = await _execute_claude_command(cmd, session=fresh, priority="batch")
+        seeded["execution_time"] += result["execution_time"]
+        if not seeded["success"] or fresh.before_session_id is None:
+            seeded["success"] = False
+            seeded["error"] = f"Starting the compacted session failed: {seeded.get('error') or 'no session id'}"
+            return seeded
+        if session.before_session_id != source_session_id:
+            # 圧縮中にreset_session / set_current_sessionで切り替えられた場合はそちらを優先する
+            return {"success": False, "error": "Session changed during compaction", "execution_time": seeded["execution_time"]}
+        session.before_session_id = fresh.before_session_id
+        session.is_manually_set = False
+        session.fork_on_resume = False
+        session.context_tokens = fresh.context_tokens
+        seeded["summary"] = result["response"]
+        return seeded
+    
+    async with session_manager.hold(session):
+        old_session_id = session.before_session_id
+        if old_session_id is None:
+            result = {"success": False, "error": "No conversation to compact", "execution_time": 0}
+        else:
+            try:
+                result = await _run_cancellable(_compact_execution_id(session.name), "compact_session", session.name, reason, compact())
+            except ClaudeExecutionCancelled as e:
+                result = {"success": False, "error": str(e), "execution_time": e.execution_time}
+            except FileNotFoundError as e:
+                result = {"success": False, "error": str(e), "execution_time": 0}
+        if result["success"]:
+            session.compactions += 1
+            session.recent_latencies.clear()
+        # 失敗した場合もすぐに再試行しないよう記録する
+        session.last_compaction_turn = session.turns
+    
+    entry = {
+        "tool_name": "compact_session",
+        "success": result["success"],
+        "prompt": None,
+        "response": result.get("summary") or result.get("response"),
+        "execution_time": result["execution_time"],
+        "timestamp": datetime.now().isoformat(),
+        "error": result.get("error"),
+        "session": session.name,
+        "session_id": session.before_session_id,
+        "old_session_id": old_session_id,
+        "mode": "summary",
+        "reason": reason
+    }
+    session_manager._add_history(entry)
+    if result["success"]:
+        logger.info("Session compacted (%s): %s -> %s", session.name, old_session_id, session.before_session_id)
+    else:
+        logger.warning("Session compaction failed (%s): %s", session.name, result.get("error"))
+    return entry
+
+
+@mcp.tool()
+async def compact_session(session: Optional[str] = None) -> Dict:
+    """セッションを今すぐ圧縮する
+    
+    長い会話は--resumeのたびに全体を読み込むため、ターンごとに遅く高くなります。
+    圧縮すると会話の要約から始めた新しいセッションに切り替わります。
+    CLAUDE_MCP_COMPACT_MODE="summary"の場合は、しきい値（CLAUDE_MCP_COMPACT_TOKENS /
+    CLAUDE_MCP_COMPACT_LATENCY）を超えた時点で自動でも行われます。
+    
+    Args:
+        session: セッション名（省略時は"default"）
+        
+    Returns:
+        圧縮前後のセッションIDと使用量を含む辞書
+    """
+    claude_session = session_manager.get_session(session)
+    await session_manager.refresh(claude_session)
+    if claude_session.before_session_id is None and (claude_session.compact_task is None or claude_session.compact_task.done()):
+        return {
+            "tool_name": "compact_session",
+            "success": False,
+            "session": claude_session.name,
+            "error": "No conversation to compact"
+        }
+    entry = await session_manager.start_compaction(claude_session, "manual")
+    return dict(entry, usage=claude_session.usage_summary())
+
+
+@mcp.tool()
+async def fork_session(new_session: str, session: Optional[str] = None) -> Dict:
+    """セッションを分岐して新しい名前付きセッションを作る（実行は一瞬で完了）
+    
+    元のセッションの現在の会話位置を新しいセッション名にコピーします。
+    新しいセッションの最初の呼び出しは元の会話を引き継いだ独立した分岐として実行され、
+    元のセッションの会話位置や記録は変わりません。
+    
+    Args:
+        new_session: 作成するセッション名
+        session: 分岐元のセッション名（省略時は"default"）
+        
+    Returns:
+        操作結果を含む辞書
+    """
+    claude_session = session_manager.get_session(session)
+    await session_manager.refresh(claude_session)
+    
+    error = None
+    if not new_session:
+        error = "Missing new_session"
+    elif new_session == claude_session.name:
+        error = "new_session must differ from the source session"
+    elif claude_session.before_session_id is None:
+        error = f"Session '{claude_session.name}' has no conversation to fork"
+    else:
+        # コピー先の確認と書き込みは、他のプロセスと競合しないようコピー先を使用中にして行う
+        forked = session_manager.get_session(new_session)
+        async with session_manager.update(forked):
+            if forked.before_session_id is not None:
+                error = f"Session '{new_session}' already has a conversation (reset it first)"
+            else:
+                forked.before_session_id = claude_session.before_session_id
+                forked.is_manually_set = False
+                forked.fork_on_resume = True
+    if error is not None:
+        return {
+            "tool_name": "fork_session",
+            "success": False,
+            "session": claude_session.name,
+            "new_session": new_session,
+            "error": error
+        }
+    
+    logger.info("Session forked: %s -> %s (%s)", claude_session.name, forked.name, forked.before_session_id)
+    
+    return {
+        "tool_name": "fork_session",
+        "success": True,
+        "message": f"Forked session '{claude_session.name}' as '{forked.name}'",
+        "session": claude_session.name,
+        "new_session": forked.name,
+        "session_id": forked.before_session_id,
+        "error": None
+    }
+
+
+@mcp.tool()
+async def list_sessions(limit: int = 20, project: Optional[str] = None, since: Optional[str] = None) -> Dict:
+    """Claude CLIが記録した過去のセッションを最終活動時刻の新しい順に一覧表示
+    
+    セッションの記録（~/.claude/projects/*/<セッションID>.jsonl）の増分インデックスを使います。
+    前回から追記された行だけを解析するため、記録が多くても高速です。
+    再開するにはset_current_sessionにsession_idを指定します。
+    
+    Args:
+        limit: 取得する件数
+        project: プロジェクト（記録のサブディレクトリ名）で絞り込み
+        since: 最終活動時刻の下限（ISO形式、例: "2025-01-01"）
+        
+    Returns:
+        セッションの一覧（最初と最後のプロンプト、開始・最終活動時刻、ターン数、トークン数）を含む辞書
+    """
+    return await _query_sessions("list_sessions", None, project, since, limit)
+
+
+@mcp.tool()
+async def search_sessions(query: str, limit: int = 20, project: Optional[str] = None, since: Optional[str] = None) -> Dict:
+    """Claude CLIが記録した過去のセッションを検索
+    
+    最初と最後のプロンプト、要約、作業ディレクトリ、セッションIDに含まれる文字列で検索します
+    （大文字小文字を区別しない）。結果は最終活動時刻の新しい順です。
+    
+    Args:
+        query: 検索する文字列
+        limit: 取得する件数
+        project: プロジェクト（記録のサブディレクトリ名）で絞り込み
+        since: 最終活動時刻の下限（ISO形式）
+        
+    Returns:
+        条件に合うセッションの一覧を含む辞書
+    """
+    if not query:
+        return {
+            "tool_name": "search_sessions",
+            "success": False,
+            "sessions": [],
+            "error": "Empty query"
+        }
+    return await _query_sessions("search_sessions", query, project, since, limit)
+
+
+async def _query_sessions(tool_name: str, query: Optional[str], project: Optional[str], since: Optional[str], limit: int) -> Dict:
+    """list_sessions / search_sessionsの共通処理"""
+    base = _transcript_dir()
+    if base is None:
+        return {
+            "tool_name": tool_name,
+            "success": False,
+            "sessions": [],
+            "error": "Set CLAUDE_MCP_TRANSCRIPT_DIR to the Claude CLI transcript directory in WSL (e.g. \\\\wsl$\\Ubuntu\\home\\<user>\\.claude\\projects)"
+        }
+    try:
+        sessions, stats = await session_manager.transcript_index.search(base, query, project, since, max(1, limit))
+    except sqlite3.Error as e:
+        return {
+            "tool_name": tool_name,
+            "success": False,
+            "sessions": [],
+            "error": f"Session index error: {e}"
+        }
+    return {
+        "tool_name": tool_name,
+        "success": True,
+        "sessions": sessions,
+        "total": stats.pop("total"),
+        "index": stats,
+        "transcript_dir": base,
+        "error": None
+    }
+
+
 # Windows環境用の設定
 if platform.system() == "Windows":
     # WindowsでのProactorEventLoopポリシー設定
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
 
 
+async def _main(transport: str = TRANSPORT):
+    """サーバーを起動する
+    
+    Args:
+        transport: "stdio"（デフォルト）、"http"（Streamable HTTP）、"sse"
+    """
+    # 最初のプロンプトで探索を待たないよう、起動時にバックグラウンドで探索を開始
+    session_manager.start_discovery()
+    if METRICS_FILE:
+        session_manager.metrics.start_export(METRICS_FILE)
+    try:
+        if transport == "stdio":
+            # stdio経由でサーバーを起動
+            await mcp.run_stdio_async()
+        else:
+            # 1つのプロセスで複数のクライアントに応答する
+            # セッション名はクライアントごとに分け、CLIの探索結果・ワーカー・キャッシュ・実行枠・メトリクスは共有
+            session_manager.client_scoped = True
+            logger.info("Serving %s on %s:%d", transport, mcp.settings.host, mcp.settings.port)
+            if transport == "http":
+                await mcp.run_streamable_http_async()
+            else:
+                await mcp.run_sse_async()
+    finally:
+        await session_manager.worker_pool.shutdown()
+        await session_manager.bridge.shutdown()
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """コマンドライン引数を解析する（省略時は環境変数の値を使う）"""
+    parser = argparse.ArgumentParser(description="Claude CLI MCP Server")
+    parser.add_argument("--transport", choices=TRANSPORTS, default=TRANSPORT if TRANSPORT in TRANSPORTS else "stdio",
+                        help="stdio: one server per client (default), http: Streamable HTTP, sse: HTTP with SSE")
+    parser.add_argument("--host", default=HTTP_HOST, help="address to listen on for http/sse")
+    parser.add_argument("--port", type=int, default=HTTP_PORT, help="port to listen on for http/sse")
+    return parser.parse_args(argv)
+
+
 # メインエントリーポイント
 if __name__ == "__main__":
-    # stdio経由でサーバーを起動
-    asyncio.run(mcp.run_stdio_async())
\ No newline at end of file
+    args = _parse_args()
+    if args.host != mcp.settings.host:
+        mcp.settings.host = args.host
+        if args.host not in ("127.0.0.1", "localhost", "::1"):
+            # localhost以外で待ち受ける場合はFastMCPと同様にHostヘッダーの制限を外す
+            mcp.settings.transport_security = None
+    mcp.settings.port = args.port
+    asyncio.run(_main(args.transport))
\ No newline at end of file